@@ -32,7 +32,9 @@ DAMAGE.
 import unittest
 import struct, os, re
 import operator
+import bisect
 import numpy
+from multiprocessing.pool import ThreadPool
 # import psfasc
 from copy import copy
 
@@ -331,6 +333,11 @@ class DataTypeDef(Chunk):
         TYPESTRING: "STRING *",
         TYPEINTLONG: "INT LONG"
     }
+    NumpyDtypeDict = {
+        TYPEFLOATDOUBLE: numpy.dtype(">f8"),
+        TYPECOMPLEXDOUBLE: numpy.dtype(">c16"),
+        TYPEINTLONG: numpy.dtype(">i4")
+    }
     
     def __init__(self, psf, id=0, name=None, datatypeid=0, structdef=None):
         Chunk.__init__(self, psf, type)
@@ -369,6 +376,10 @@ class DataTypeDef(Chunk):
             return self.structdef.getDataSize()
         else:
             return self.ClassDict[self.datatypeid].size
+
+    def getNumpyDtype(self):
+        """Returns the big endian numpy dtype of the data or None if it has none"""
+        return self.NumpyDtypeDict.get(self.datatypeid)
             
     def deSerializeFile(self, file):
         start = file.tell()
@@ -403,7 +414,11 @@ class DataTypeDef(Chunk):
 
 class DataTypeRef(Chunk):
     type=16
-    """Class representing link to data type"""
+    """Class representing link to data type
+
+    The names of traces are not stored in the chunk but in the TraceNameTable
+    of the trace section, they are looked up by the trace number traceno.
+    """
     def __init__(self, psf, type=None):
         Chunk.__init__(self, psf, type)
         self.id = None
@@ -411,6 +426,11 @@ class DataTypeRef(Chunk):
         self.datatypeid = 0
         self.properties = []
 
+    def __getattr__(self, attr):
+        if attr == 'name' and 'traceno' in self.__dict__:
+            return String(self.psf.traces.nameIndex.getName(self.traceno))
+        raise AttributeError(attr)
+
     def getDataObj(self):
         """Get a data object described by the DataType"""
         return self.psf.types.idMap[self.datatypeid].getDataObj()
@@ -426,6 +446,9 @@ class DataTypeRef(Chunk):
 
     def getDataSize(self):
         return self.psf.types.idMap[self.datatypeid].getDataSize()
+
+    def getNumpyDtype(self):
+        return self.psf.types.idMap[self.datatypeid].getNumpyDtype()
         
     def deSerializeFile(self, file):
         start = file.tell()
@@ -754,40 +777,228 @@ class TypeSection(HashContainer):
         return r
 
 
+class TraceNameTable(object):
+    """Compact read-only mapping from trace names to hierarchical trace indices
+
+    Names are split at the last hierarchy separator into a prefix and a leaf.
+    Unique prefixes are stored once and all leaves are packed into a single
+    string buffer with an offset array. Entries are kept sorted by name so
+    lookups are binary searches, and the original trace order is kept to
+    rebuild the name list on demand. The table is the only copy of the trace
+    names, the DataTypeRef chunks of a TraceSection look their name up by
+    trace number with getName.
+
+    >>> table = TraceNameTable([("I0.M1.d", (0, 0)), ("I0.M1.g", (0, 1)), ("VOUT", (1,))])
+    >>> table["I0.M1.g"]
+    (0, 1)
+    >>> "I0.M1.s" in table
+    False
+    >>> table.getNames()
+    ('I0.M1.d', 'I0.M1.g', 'VOUT')
+    >>> table.getPrefixes()
+    ('', 'I0.M1.')
+    >>> table.getName(2)
+    'VOUT'
+    """
+    separators = '.:'
+
+    def __init__(self, items=()):
+        names = []
+        indices = []
+        for name, index in items:
+            names.append(str(name))
+            indices.append(tuple(index))
+
+        n = len(names)
+        # Sort by (name, trace position) so the last duplicate wins on lookup
+        # like the dict this replaces
+        order = sorted(range(n), key=lambda i: (names[i], i))
+
+        prefixes = {}
+        prefixid = numpy.empty(n, dtype=numpy.int32)
+        leaves = []
+        for pos, i in enumerate(order):
+            prefix, leaf = self._splitName(names[i])
+            prefixid[pos] = prefixes.setdefault(prefix, len(prefixes))
+            leaves.append(leaf)
+
+        # Renumber the prefixes in sorted order
+        sortedprefixes = sorted(prefixes)
+        renumber = numpy.empty(len(prefixes), dtype=numpy.int32)
+        for newid, prefix in enumerate(sortedprefixes):
+            renumber[prefixes[prefix]] = newid
+        self._prefixid = renumber[prefixid] if n else prefixid
+        self._prefixbuf, self._prefixoffsets = self._pack(sortedprefixes)
+        self._leafbuf, self._leafoffsets = self._pack(leaves)
+
+        depth = max([len(index) for index in indices] + [1])
+        self._index = numpy.empty((n, depth), dtype=numpy.int32)
+        self._index.fill(-1)
+        for pos, i in enumerate(order):
+            self._index[pos, :len(indices[i])] = indices[i]
+
+        # Maps trace position to sorted position
+        self._order = numpy.empty(n, dtype=numpy.int32)
+        self._order[order] = numpy.arange(n, dtype=numpy.int32)
+
+    @classmethod
+    def _splitName(cls, name):
+        split = max([name.rfind(sep) for sep in cls.separators]) + 1
+        return name[:split], name[split:]
+
+    @staticmethod
+    def _pack(strings):
+        offsets = numpy.zeros(len(strings)+1, dtype=numpy.int64)
+        if strings:
+            offsets[1:] = numpy.cumsum([len(s) for s in strings])
+        return ''.join(strings), offsets
+
+    def _prefix(self, id):
+        return self._prefixbuf[self._prefixoffsets[id]:self._prefixoffsets[id+1]]
+
+    def _name(self, pos):
+        leaf = self._leafbuf[self._leafoffsets[pos]:self._leafoffsets[pos+1]]
+        return self._prefix(self._prefixid[pos]) + leaf
+
+    def _compare(self, name, pos):
+        """Compares name with the name at sorted position pos like cmp
+
+        The prefix and the leaf are compared in place in their buffers,
+        without building the name.
+        """
+        id = self._prefixid[pos]
+        start, end = self._prefixoffsets[id], self._prefixoffsets[id+1]
+        n = end - start
+        c = cmp(name[:n], self._prefixbuf[start:end])
+        if c:
+            return c
+        return cmp(name[n:], self._leafbuf[self._leafoffsets[pos]:self._leafoffsets[pos+1]])
+
+    def _find(self, name):
+        """Returns the sorted position of name or -1 if missing"""
+        lo, hi = 0, len(self._prefixid)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._compare(name, mid) < 0:
+                hi = mid
+            else:
+                lo = mid+1
+        if lo > 0 and self._compare(name, lo-1) == 0:
+            return lo-1
+        return -1
+
+    def _indexAt(self, pos):
+        return tuple([int(i) for i in self._index[pos] if i >= 0])
+
+    def __len__(self):
+        return len(self._prefixid)
+
+    def __contains__(self, name):
+        return self._find(str(name)) >= 0
+
+    def __getitem__(self, name):
+        pos = self._find(str(name))
+        if pos < 0:
+            raise KeyError(name)
+        return self._indexAt(pos)
+
+    def get(self, name, default=None):
+        pos = self._find(str(name))
+        if pos < 0:
+            return default
+        return self._indexAt(pos)
+
+    def has_key(self, name):
+        return name in self
+
+    def __iter__(self):
+        for pos in xrange(len(self)):
+            yield self._name(pos)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(self._name(pos), self._indexAt(pos)) for pos in xrange(len(self))]
+
+    def getNames(self):
+        """Returns the names in trace order"""
+        return tuple([self._name(pos) for pos in self._order])
+
+    def getName(self, traceno):
+        """Returns the name of trace number traceno in trace order"""
+        return self._name(self._order[traceno])
+
+    def getPrefixes(self):
+        """Returns the unique hierarchical prefixes in sorted order"""
+        return tuple([self._prefix(id) for id in xrange(len(self._prefixoffsets)-1)])
+
+    def nbytes(self):
+        """Returns the number of bytes used by the table buffers"""
+        return len(self._prefixbuf) + len(self._leafbuf) + \
+               sum([a.nbytes for a in (self._prefixoffsets, self._leafoffsets,
+                                       self._prefixid, self._index, self._order)])
+
 class TraceSection(HashContainer):
     hashclass = HashTableTrace
     def __init__(self, psf):
         HashContainer.__init__(self, psf, childrenclslist=[GroupDef, DataTypeRef])
         self.idMap = {}
-        self.nameIndex = {}
-        
+        self.nameIndex = TraceNameTable()
+        self.windowlayout = None
+
     def deSerializeFile(self, file):
         HashContainer.deSerializeFile(self, file)
 
         self.idMap = {}
-        
+        self.windowlayout = None
+
+        items = []
+        traces = []
         for index, chunk in enumerate(self.children):
             self.idMap[chunk.id] = chunk
             if isinstance(chunk, GroupDef):
-                self.nameIndex.update(dict([(par, (index,)+value) for par,value in chunk.getNameIndex().items()]))
+                items += [(child.name, (index, i)) for i, child in enumerate(chunk.children)]
+                traces += chunk.children
             else:
-                self.nameIndex[chunk.name] = (index,)
+                items.append((chunk.name, (index,)))
+                traces.append(chunk)
+        self.nameIndex = TraceNameTable(items)
+
+        # The names are kept in the table only
+        for traceno, trace in enumerate(traces):
+            del trace.name
+            trace.traceno = traceno
 
     def getNameIndex(self):
         return self.nameIndex
+
+    def getWindowLayout(self, windowsize):
+        """Returns a dict of the offsets of the traces in the trace data of a window by
+        trace index and the size of the trace data of a window
+
+        Every trace takes a whole window, the table is built once for the file.
+        """
+        if self.windowlayout is None or self.windowlayout[0] != windowsize:
+            offsets = {}
+            size = 0
+            for index, chunk in enumerate(self.children):
+                offsets[(index,)] = size
+                if isinstance(chunk, GroupDef):
+                    for i in xrange(len(chunk.children)):
+                        offsets[(index, i)] = size
+                        size += windowsize
+                else:
+                    size += windowsize
+            self.windowlayout = (windowsize, offsets, size)
+        return self.windowlayout[1:]
             
     def toPSFasc(self, prec=None):
         r="TRACE\n"
         r+="\n".join([child.toPSFasc(prec) for child in self.children])
         return r
     def getTraceNames(self):
-        result = []
-        for trace in self.children:
-            if isinstance(trace,GroupDef):
-                result += trace.getNames()
-            else:
-                result.append(trace.name)
-        return tuple(map(str, result))
+        return self.nameIndex.getNames()
     def getTraceIndexByName(self, name):
         """Returns an index to the given trace name
         
@@ -822,8 +1033,40 @@ class ValuesSectionNonSweep(HashContainer):
         self.nameMap[value.name] = value
         self.children.append(value)
 
-    def deSerializeFile(self, file):
-        HashContainer.deSerializeFile(self, file)
+    def deSerializeFile(self, file, filesize=None):
+        """Read the values section
+
+        If filesize is given the section may be cut off at filesize, in that
+        case the values that were completely written are kept and the
+        PSFReader is flagged as truncated.
+        """
+        start = file.tell()
+        try:
+            HashContainer.deSerializeFile(self, file)
+        except TruncationErrors:
+            if filesize is None:
+                raise
+            self.psf.truncated = True
+            self.children = []
+            # Skip the section and Container22 type and end position words
+            file.seek(start + 3*UInt32.size)
+            try:
+                endpos = UInt32.fromFile(file).value
+            except TruncationErrors:
+                endpos = 0
+            if endpos <= file.tell():  # not written yet
+                endpos = filesize
+            pos = file.tell()
+            while pos < min(endpos, filesize):
+                try:
+                    chunk = readChunk(self.psf, file, expectedclasses=self.childrenclslist)
+                except TruncationErrors:
+                    break
+                if file.tell() > filesize:
+                    break
+                self.children.append(chunk)
+                pos = file.tell()
+            file.seek(pos)
 
         for child in self.children:
             self.nameMap[child.name] = child
@@ -844,7 +1087,13 @@ class ValuesSectionNonSweep(HashContainer):
 
 class ValuesSectionSweep(SimpleContainer):
     type=21
-    def deSerializeFile(self, file):
+    def deSerializeFile(self, file, filesize=None):
+        """Read the values section
+
+        If filesize is given the section may be cut off at filesize, in that
+        case the sweep points that were completely written are kept and the
+        PSFReader is flagged as truncated.
+        """
         Chunk.deSerializeFile(self, file)
         self.endpos = UInt32.fromFile(file).value
 
@@ -852,7 +1101,19 @@ class ValuesSectionSweep(SimpleContainer):
 
         if windowedsweep:
             el = ZeroPad(self.psf)
-            el.deSerializeFile(file)
+            start = file.tell()
+            try:
+                el.deSerializeFile(file)
+            except TruncationErrors:
+                if filesize is None:
+                    raise
+                el.endpos = filesize + 1
+            if filesize is not None and el.endpos > filesize:
+                # The file ends before the first window
+                self.psf.truncated = True
+                file.seek(start)
+                self.endpos = start
+                return
 
         isweep=0
         while isweep < self.psf.header.properties['PSF sweep points']:
@@ -861,9 +1122,37 @@ class ValuesSectionSweep(SimpleContainer):
             else:
                 value = SweepValueSimple(self.psf)
 
-            isweep += value.deSerializeFile(file, n=self.psf.header.properties['PSF sweep points']-isweep)
+            start = file.tell()
+            try:
+                if windowedsweep:
+                    # Windows are only indexed here, their data is decoded on demand
+                    n = value.deSerializeFile(file, n=self.psf.header.properties['PSF sweep points']-isweep,
+                                              lazy=True)
+                    end = value.dataoffset + n*value.paramtype.getDataSize() + value.getTraceDataSize()
+                else:
+                    n = value.deSerializeFile(file, n=self.psf.header.properties['PSF sweep points']-isweep)
+                    end = file.tell()
+            except TruncationErrors:
+                if filesize is None:
+                    raise
+                end = filesize + 1
+
+            if filesize is not None and end > filesize:
+                # The file ends inside this sweep point or window
+                self.psf.truncated = True
+                file.seek(start)
+                self.endpos = start
+                return
+
+            isweep += n
+            if n > 0:
+                self.children.append(value)
 
-            self.children.append(value)
+        if filesize is not None and file.tell() + UInt32.size > filesize:
+            # All sweep points were written but the end of the section was not
+            self.psf.truncated = True
+            self.endpos = file.tell()
+            return
 
         self.section = UInt32.fromFile(file)
 
@@ -874,8 +1163,14 @@ class ValuesSectionSweep(SimpleContainer):
 
         file.seek(self.endpos)
 
-    def getSweepParamValues(self):
-        return reduce(operator.__add__, [child.getSweepParamValues() for child in self.children])
+    def getSweepParamValues(self, start=None, stop=None):
+        children = self.getChildrenInRange(start, stop)
+        if not children:
+            return []
+        result = reduce(operator.__add__, [child.getSweepParamValues() for child in children])
+        if start is None and stop is None:
+            return result
+        return [x for x in result if self._inRange(x, start, stop)]
 
     def getValueNames(self):
         return self.psf.traces.getTraceNames()
@@ -883,30 +1178,319 @@ class ValuesSectionSweep(SimpleContainer):
     def __len__(self):
         return len(self.psf.traces)
 
-    def getValueByName(self, name):
+    def getChildrenInRange(self, start=None, stop=None):
+        """Returns the sweep values that may hold sweep parameter values in [start, stop]
+
+        For windowed sweeps only the first and last sweep parameter value of each
+        window is known before decoding, so the windows are found by binary search
+        on those and no window data is read.
+        """
+        windowedsweep = self.psf.header.properties.has_key('PSF window size')
+        if (start is None and stop is None) or not windowedsweep:
+            return self.children
+
+        first = 0
+        last = len(self.children)
+        if start is not None:
+            first = bisect.bisect_left([child.lastparamvalue for child in self.children], start)
+        if stop is not None:
+            last = bisect.bisect_right([child.firstparamvalue for child in self.children], stop)
+        return self.children[first:last]
+
+    @staticmethod
+    def _inRange(x, start, stop):
+        return (start is None or x >= start) and (stop is None or x <= stop)
+
+    def readWindows(self, children, indices):
+        """Decode the traces at indices from the windows in children
+
+        Returns the sweep parameter values and a list with one array per trace.
+        If the PSFReader has more than one thread the windows are split into
+        contiguous ranges that are decoded concurrently, each with its own
+        file object, and the per-trace arrays are stitched together in order.
+        """
+        threads = self.psf.threads or 1
+        if threads > 1 and len(children) > 1:
+            nranges = min(threads, len(children))
+            bounds = [len(children)*i//nranges for i in range(nranges+1)]
+            ranges = [children[bounds[i]:bounds[i+1]] for i in range(nranges)]
+            pool = ThreadPool(nranges)
+            try:
+                parts = pool.map(lambda windows: self._readWindowRange(windows, indices), ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            parts = [self._readWindowRange(children, indices, self.psf.file)]
+
+        x = numpy.concatenate([part[0] for part in parts])
+        ys = [numpy.concatenate([part[1][i] for part in parts]) for i in range(len(indices))]
+        return x, ys
+
+    def _readWindowRange(self, windows, indices, file=None):
+        ownfile = file is None
+        if ownfile:
+            file = open(self.psf.filename, "rb")
+        try:
+            xs = []
+            ys = [[] for index in indices]
+            for window in windows:
+                x, values = window.readTraces(indices, file=file)
+                xs.append(x)
+                for i, y in enumerate(values):
+                    ys[i].append(y)
+        finally:
+            if ownfile:
+                file.close()
+        if not xs:
+            return numpy.array([]), [numpy.array([]) for index in indices]
+        return numpy.concatenate(xs), [numpy.concatenate(y) for y in ys]
+
+    def getValuesByNames(self, names, start=None, stop=None):
+        """Returns a dictionary of numpy arrays with the values of the named traces
+
+        Windowed sweeps are decoded in one pass over the windows for all traces.
+        """
+        windowedsweep = self.psf.header.properties.has_key('PSF window size')
+        if not windowedsweep:
+            return dict([(name, self.getValueByName(name, start=start, stop=stop)) for name in names])
+
+        indices = [self.psf.traces.getTraceIndexByName(name) for name in names]
+        x, ys = self.readWindows(self.getChildrenInRange(start, stop), indices)
+        if start is not None or stop is not None:
+            mask = numpy.ones(len(x), dtype=bool)
+            if start is not None:
+                mask &= x >= start
+            if stop is not None:
+                mask &= x <= stop
+            ys = [y[mask] for y in ys]
+        return dict(zip(names, ys))
+
+    def getValueByName(self, name, start=None, stop=None):
         windowedsweep = self.psf.header.properties.has_key('PSF window size')
 
+        if windowedsweep:
+            return self.getValuesByNames([name], start=start, stop=stop)[name]
+
         index = self.psf.traces.getTraceIndexByName(name)
 
+        children = self.getChildrenInRange(start, stop)
+
         result = []
-        for child in self.children:
+        sweepvalues = []
+        for child in children:
             obj=child
             for i in index:
                 obj = obj.children[i]
+            result.append(obj.getValue())
+
+            if start is not None or stop is not None:
+                sweepvalues += child.getSweepParamValues()
+
+        if start is not None or stop is not None:
+            result = [y for x, y in zip(sweepvalues, result) if self._inRange(x, start, stop)]
 
-            # If windowed sweep, each child will be a list of values in the window
-            if windowedsweep:
-                result += [v.getValue() for v in obj]
-            else:
-                result.append(obj.getValue())
-                
         return numpy.array(result)
 
+    def iterValueArraysByName(self, name, start=None, stop=None):
+        """Yields (sweep values, trace values) numpy array pairs window by window
+
+        Windowed sweeps are read one window at a time without being kept in
+        memory. Other sweeps are yielded as a single pair.
+        """
+        windowedsweep = self.psf.header.properties.has_key('PSF window size')
+        if windowedsweep:
+            index = self.psf.traces.getTraceIndexByName(name)
+            pairs = (child.readTrace(index) for child in self.getChildrenInRange(start, stop))
+        else:
+            pairs = [(numpy.array(self.getSweepParamValues()), self.getValueByName(name))]
+
+        for x, y in pairs:
+            if start is not None or stop is not None:
+                mask = numpy.ones(len(x), dtype=bool)
+                if start is not None:
+                    mask &= x >= start
+                if stop is not None:
+                    mask &= x <= stop
+                x, y = x[mask], y[mask]
+            if len(x):
+                yield x, y
+
+    def getDecimatedValueByName(self, name, max_points, method='minmax', start=None, stop=None):
+        """Returns sweep values and trace values reduced to at most max_points
+
+        method is 'minmax', which keeps the minimum and maximum of each bucket
+        of the sweep axis, or 'lttb' (largest triangle three buckets). The
+        windows are streamed through and the full trace is never built.
+        """
+        if method not in DECIMATORS:
+            raise ValueError("Unknown decimation method %s, use one of %s" % (method, sorted(DECIMATORS)))
+        _checkMaxPoints(method, max_points)
+
+        windowedsweep = self.psf.header.properties.has_key('PSF window size')
+        children = self.getChildrenInRange(start, stop)
+        if not children:
+            return numpy.array([]), numpy.array([])
+
+        if windowedsweep:
+            npoints = sum([child.n for child in children])
+            x0 = children[0].firstparamvalue
+            x1 = children[-1].lastparamvalue
+        else:
+            sweepvalues = numpy.array(self.getSweepParamValues())
+            npoints = len(sweepvalues)
+            x0, x1 = sweepvalues[0], sweepvalues[-1]
+        if start is not None:
+            x0 = max(x0, start)
+        if stop is not None:
+            x1 = min(x1, stop)
+
+        chunks = self.iterValueArraysByName(name, start=start, stop=stop)
+        if npoints <= max_points:
+            pairs = list(chunks)
+            if not pairs:
+                return numpy.array([]), numpy.array([])
+            return numpy.concatenate([x for x, y in pairs]), numpy.concatenate([y for x, y in pairs])
+
+        return DECIMATORS[method](chunks, x0, x1, max_points)
+
     def toPSFasc(self, prec=None):
         r="VALUE\n"
         r+="\n".join([child.toPSFasc(prec) for child in self.children])
         return r
 
+def _bucketIds(x, x0, x1, nbuckets):
+    if x1 > x0:
+        ids = numpy.floor((x - x0)/float(x1 - x0)*nbuckets).astype(int)
+    else:
+        ids = numpy.zeros(len(x), dtype=int)
+    return numpy.clip(ids, 0, nbuckets-1)
+
+def _checkMaxPoints(method, max_points):
+    if max_points < DECIMATION_MIN_POINTS[method]:
+        raise ValueError("%s decimation keeps at least %d points, max_points is %d" %
+                         (method, DECIMATION_MIN_POINTS[method], max_points))
+
+def decimateMinMax(chunks, x0, x1, max_points):
+    """Min/max decimation of a stream of (x, y) array pairs with increasing x
+
+    The range [x0, x1] is divided into max_points//2 equal buckets and the
+    minimum and maximum point of every bucket are kept in x order, so peaks
+    survive the decimation. max_points must be at least 2.
+
+    >>> x = numpy.arange(10.)
+    >>> y = numpy.array([0., 5., 1., 1., -3., 2., 2., 2., 9., 0.])
+    >>> decimateMinMax([(x[:5], y[:5]), (x[5:], y[5:])], 0., 9., 4)
+    (array([ 1.,  4.,  8.,  9.]), array([ 5., -3.,  9.,  0.]))
+    """
+    _checkMaxPoints('minmax', max_points)
+    nbuckets = max_points//2
+    minx = numpy.zeros(nbuckets)
+    miny = numpy.empty(nbuckets)
+    miny.fill(numpy.inf)
+    maxx = numpy.zeros(nbuckets)
+    maxy = numpy.empty(nbuckets)
+    maxy.fill(-numpy.inf)
+    for x, y in chunks:
+        if numpy.iscomplexobj(y):
+            raise ValueError("minmax decimation requires real valued traces")
+        ids = _bucketIds(x, x0, x1, nbuckets)
+        # x is increasing so the bucket ids form contiguous segments
+        starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        ends = numpy.r_[starts[1:], len(ids)]
+        for first, last in zip(starts, ends):
+            bucket = ids[first]
+            segment = y[first:last]
+            imin = first + numpy.argmin(segment)
+            imax = first + numpy.argmax(segment)
+            if y[imin] < miny[bucket]:
+                minx[bucket], miny[bucket] = x[imin], y[imin]
+            if y[imax] > maxy[bucket]:
+                maxx[bucket], maxy[bucket] = x[imax], y[imax]
+
+    xs = []
+    ys = []
+    for bucket in numpy.flatnonzero(numpy.isfinite(miny)):
+        points = sorted(set([(minx[bucket], miny[bucket]), (maxx[bucket], maxy[bucket])]))
+        xs += [p[0] for p in points]
+        ys += [p[1] for p in points]
+    return numpy.array(xs), numpy.array(ys)
+
+def decimateLTTB(chunks, x0, x1, max_points):
+    """Largest triangle three buckets decimation of a stream of (x, y) array pairs
+
+    The first and last points are kept and the range [x0, x1] is divided into
+    max_points-2 equal buckets. From each bucket the point forming the largest
+    triangle with the previously selected point and the mean of the next
+    bucket is kept. Only two buckets of points are held at a time. max_points
+    must be at least 3.
+
+    >>> x = numpy.arange(10.)
+    >>> y = numpy.array([0., 5., 1., 1., -3., 2., 2., 2., 9., 0.])
+    >>> decimateLTTB([(x[:5], y[:5]), (x[5:], y[5:])], 0., 9., 5)
+    (array([ 0.,  1.,  4.,  8.,  9.]), array([ 0.,  5., -3.,  9.,  0.]))
+    """
+    _checkMaxPoints('lttb', max_points)
+    nbuckets = max_points-2
+    selectedx = []
+    selectedy = []
+    state = {'first': None, 'last': None, 'pending': None, 'bucket': None, 'points': []}
+
+    def select(points, cx, cy):
+        px, py = points
+        ax, ay = selectedx[-1], selectedy[-1]
+        area = numpy.abs((ax - cx)*(py - ay) - (ax - px)*(cy - ay))
+        i = numpy.argmax(area)
+        selectedx.append(px[i])
+        selectedy.append(py[i])
+
+    def close(points):
+        # A bucket is complete, the pending bucket can now be decided
+        px = numpy.concatenate([p[0] for p in points])
+        py = numpy.concatenate([p[1] for p in points])
+        if state['pending'] is not None:
+            select(state['pending'], px.mean(), py.mean())
+        state['pending'] = (px, py)
+
+    for x, y in chunks:
+        if numpy.iscomplexobj(y):
+            raise ValueError("lttb decimation requires real valued traces")
+        if state['first'] is None:
+            state['first'] = True
+            selectedx.append(x[0])
+            selectedy.append(y[0])
+            x, y = x[1:], y[1:]
+        if not len(x):
+            continue
+        state['last'] = (x[-1], y[-1])
+        ids = _bucketIds(x, x0, x1, nbuckets)
+        starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        ends = numpy.r_[starts[1:], len(ids)]
+        for first, last in zip(starts, ends):
+            if state['bucket'] is not None and ids[first] != state['bucket']:
+                close(state['points'])
+                state['points'] = []
+            state['bucket'] = ids[first]
+            state['points'].append((x[first:last], y[first:last]))
+
+    if state['last'] is None:
+        return numpy.array(selectedx), numpy.array(selectedy)
+
+    # The last point is always kept, it must not be selected from a bucket too
+    lastx, lasty = state['last']
+    points = state['points']
+    points[-1] = (points[-1][0][:-1], points[-1][1][:-1])
+    if sum([len(p[0]) for p in points]):
+        close(points)
+    if state['pending'] is not None:
+        select(state['pending'], lastx, lasty)
+    selectedx.append(lastx)
+    selectedy.append(lasty)
+    return numpy.array(selectedx), numpy.array(selectedy)
+
+DECIMATORS = {'minmax': decimateMinMax, 'lttb': decimateLTTB}
+DECIMATION_MIN_POINTS = {'minmax': 2, 'lttb': 3}
+
 class NonSweepValue(Chunk):
     type=16
     def __init__(self, psf, id=None, typeid=None, name=None, value=None):
@@ -990,6 +1574,9 @@ class SweepValue(Chunk):
     def deSerializeFile(self, file, n=None):
         pass
 
+    def load(self):
+        pass
+
     def getSweepParamValues(self):
         pass
     
@@ -998,6 +1585,7 @@ class SweepValue(Chunk):
         return len(self.children)
     
     def __repr__(self):
+        self.load()
         return self.__class__.__name__ + "(" + str(self.paramtype.name) + "=" + str(self.paramvalue) +","+ \
                "children="+str(self.children) +")\n"
 
@@ -1047,7 +1635,20 @@ class SweepValueSimple(SweepValue):
             
 
 class SweepValueWindowed(SweepValue):
-    def deSerializeFile(self, file, n=None):
+    def __init__(self, psf, type=None):
+        SweepValue.__init__(self, psf, type)
+        self.n = 0
+        self.dataoffset = None
+        self.loaded = False
+        self.firstparamvalue = None
+        self.lastparamvalue = None
+
+    def deSerializeFile(self, file, n=None, lazy=False):
+        """Read a window, returns the number of sweep points in it
+
+        If lazy is True only the first and last sweep parameter values are
+        read and the rest of the window is decoded by load() when needed.
+        """
         bufferstart = file.tell()
 
         Chunk.deSerializeFile(self, file)
@@ -1068,6 +1669,124 @@ class SweepValueWindowed(SweepValue):
         if n > windowlen:
             n = windowlen
 
+        self.n = n = int(n)
+        self.dataoffset = file.tell()
+
+        if lazy and n == 0:
+            # A window without room for any sweep point only holds padding
+            file.seek(self.dataoffset + self.getTraceDataSize())
+        elif lazy:
+            paramvalue = self.paramtype.getDataObj()
+            paramvalue.deSerializeFile(file)
+            self.firstparamvalue = paramvalue.getValue()
+            file.seek(self.dataoffset + (n-1)*paramvaluesize)
+            paramvalue.deSerializeFile(file)
+            self.lastparamvalue = paramvalue.getValue()
+            file.seek(self.dataoffset + n*paramvaluesize + self.getTraceDataSize())
+        else:
+            self._deSerializeData(file)
+
+        # Skip trailing padding bytes
+        padsize = int((self.psf.header.properties['PSF buffer size'] - (file.tell()-bufferstart))% \
+                  self.psf.header.properties['PSF buffer size'])
+        file.seek(padsize, 1)
+
+        return n
+
+    def getTraceDataSize(self):
+        """Returns the number of bytes of trace data in the window"""
+        windowsize = self.psf.header.properties['PSF window size'].value
+        return self.psf.traces.getWindowLayout(windowsize)[1]
+
+    def load(self):
+        """Decode the window data if it was skipped by a lazy read"""
+        if not self.loaded:
+            file = self.psf.file
+            pos = file.tell()
+            file.seek(self.dataoffset)
+            self._deSerializeData(file)
+            file.seek(pos)
+
+    def getTraceOffset(self, index):
+        """Returns the file offset and data type of the trace values at index"""
+        windowsize = self.psf.header.properties['PSF window size'].value
+        offsets = self.psf.traces.getWindowLayout(windowsize)[0]
+        offset = self.dataoffset + self.n*self.paramtype.getDataSize() + offsets[tuple(index)]
+        element = self.psf.traces.children[index[0]]
+        if len(index) > 1:
+            element = element.children[index[1]]
+        # The values are aligned to the end of the window
+        return offset + windowsize - self.n*element.getDataSize(), element
+
+    def readTrace(self, index, file=None):
+        """Returns numpy arrays of the sweep parameter values and the values of
+        the trace at index.
+
+        Unlike load() only the requested trace is read and nothing is kept in
+        memory, so windows can be streamed through.
+        """
+        x, ys = self.readTraces([index], file=file)
+        return x, ys[0]
+
+    def readTraces(self, indices, file=None):
+        """Returns a numpy array of the sweep parameter values and a list of
+        numpy arrays with the values of the traces at indices.
+
+        The trace data of the window is read with a single read. If file is
+        given it is used instead of the file of the PSFReader, which allows
+        windows to be decoded concurrently with one file object per thread.
+        """
+        if self.loaded:
+            ys = []
+            for index in indices:
+                obj = self
+                for i in index:
+                    obj = obj.children[i]
+                ys.append(numpy.array([v.getValue() for v in obj]))
+            return numpy.array(self.getSweepParamValues()), ys
+
+        if file is None:
+            file = self.psf.file
+        pos = file.tell()
+        file.seek(self.dataoffset)
+        x = self._readArray(file, self.paramtype, self.n)
+
+        tracestart = file.tell()
+        block = None
+        ys = []
+        for index in indices:
+            offset, element = self.getTraceOffset(index)
+            dtype = element.getNumpyDtype()
+            if dtype is None:
+                file.seek(offset)
+                ys.append(self._readArray(file, element, self.n))
+                continue
+            if block is None:
+                # Traces without a dtype before this one moved the file position
+                file.seek(tracestart)
+                block = file.read(self.getTraceDataSize())
+            data = numpy.frombuffer(block, dtype=dtype, count=self.n, offset=offset-tracestart)
+            ys.append(data.astype(dtype.newbyteorder('=')))
+        file.seek(pos)
+        return x, ys
+
+    @staticmethod
+    def _readArray(file, datatype, n):
+        dtype = datatype.getNumpyDtype()
+        if dtype is None:
+            values = []
+            for i in xrange(n):
+                value = datatype.getDataObj()
+                value.deSerializeFile(file)
+                values.append(value.getValue())
+            return numpy.array(values)
+        data = numpy.frombuffer(file.read(n*dtype.itemsize), dtype=dtype)
+        return data.astype(dtype.newbyteorder('='))
+
+    def _deSerializeData(self, file):
+        n = self.n
+        self.paramvalue = []
+        self.children = []
         for j in xrange(n):
             paramvalue = self.paramtype.getDataObj()
             paramvalue.deSerializeFile(file)
@@ -1081,17 +1800,28 @@ class SweepValueWindowed(SweepValue):
                                   windowsize=self.psf.header.properties['PSF window size'].value)
             self.children.append(value)
 
-        # Skip trailing padding bytes
-        padsize = int((self.psf.header.properties['PSF buffer size'] - (file.tell()-bufferstart))% \
-                  self.psf.header.properties['PSF buffer size'])
-        file.seek(padsize, 1)
+        if self.paramvalue:
+            self.firstparamvalue = self.paramvalue[0].getValue()
+            self.lastparamvalue = self.paramvalue[-1].getValue()
+        self.loaded = True
 
-        return n
+    def __len__(self):
+        self.load()
+        return len(self.children)
 
     def getSweepParamValues(self):
-        return [v.getValue() for v in self.paramvalue]
+        if self.loaded:
+            return [v.getValue() for v in self.paramvalue]
+        # Only the sweep parameter values are read, the traces are left in the file
+        file = self.psf.file
+        pos = file.tell()
+        file.seek(self.dataoffset)
+        values = self._readArray(file, self.paramtype, self.n)
+        file.seek(pos)
+        return values.tolist()
 
     def toPSFasc(self, prec=None):
+        self.load()
         r=''
         for i, paramvalue in enumerate(self.paramvalue):
             r+=self.paramtype.name.toPSFasc(prec) + " " + paramvalue.toPSFasc(prec) + "\n"
@@ -1203,6 +1933,10 @@ class IncorrectChunk(Exception):
 
 class LastValue(Exception):
     pass
+
+# Errors raised when reading past the end of a truncated file, struct.error
+# by a short read and IncorrectChunk by a chunk that was not written yet
+TruncationErrors = (struct.error, IncorrectChunk)
     
 def readChunk(psf, file, expectedclasses=None):
     type = UInt32.fromFile(file)
@@ -1246,7 +1980,12 @@ def readChunk(psf, file, expectedclasses=None):
     return chunk
 
 class PSFReader(object):
-    def __init__(self, filename=None, asc=None):
+    """Reader for binary PSF files
+
+    If threads is larger than one, windowed sweeps are decoded by that many
+    threads in parallel.
+    """
+    def __init__(self, filename=None, asc=None, threads=None):
         self.header = None
         self.types = TypeSection(self)
         self.sweeps = None
@@ -1257,10 +1996,17 @@ class PSFReader(object):
         self.file = None
         self.values = None
         self.asc = asc
+        self.threads = threads
+        self.truncated = False
         
-    def open(self):
+    def open(self, recover=False):
         """Open a PSF file and read its headers.
 
+        If recover is True a file without a valid trailer, for example from a
+        simulation that was killed, is read by scanning the sections from the
+        start of the file. All completely written sweep points are available
+        and the truncated attribute is set to True.
+
         Example:
         Trying to open a valid psf file
         >>> psf=PSFReader('./test/psf/srcSweep')
@@ -1275,6 +2021,8 @@ class PSFReader(object):
             
             if self.validate():
                 self.deSerializeFile(self.file)
+            elif recover:
+                self.deSerializeTruncatedFile(self.file)
             else:
                 raise PSFInvalid("Invalid PSF file")
         else:
@@ -1304,6 +2052,9 @@ class PSFReader(object):
             file = self.file
             
         # Read Clarissa signature
+        file.seek(0,2)
+        if file.tell() < 4+8:
+            return False
         file.seek(-4-8,2)
         clarissa = file.read(8)
         return clarissa == "Clarissa"
@@ -1356,9 +2107,11 @@ class PSFReader(object):
     def getSweepParamNames(self):
         return self.sweeps.getNames()
     
-    def getSweepParamValues(self, dim=0):
+    def getSweepParamValues(self, dim=0, start=None, stop=None):
         """Returns a numpy.array of sweep parameter values for sweep dimension dim.
 
+        If start or stop is given only the values in [start, stop] are returned.
+
         >>> psf=PSFReader('./test/psf/srcSweep')
         >>> psf.open()
         >>> psf.getSweepParamValues(0)
@@ -1371,7 +2124,9 @@ class PSFReader(object):
         array([  0.00000000e+00,   2.00000000e-11,   5.33333333e-11])
 
         """
-        return numpy.array(self.values.getSweepParamValues())
+        if start is None and stop is None:
+            return numpy.array(self.values.getSweepParamValues())
+        return numpy.array(self.values.getSweepParamValues(start=start, stop=stop))
 
     def getValuePropertiesByName(self, name):
         """Returns the properties associated with value
@@ -1384,9 +2139,17 @@ class PSFReader(object):
         """
         return self.values.getValuePropertiesByName(name)
 
-    def getValuesByName(self, name):
+    def getValuesByName(self, name, start=None, stop=None, max_points=None, method='minmax'):
         """Returns a numpy.array of trace values for swept results and a scalar for non swept.
 
+        For swept results start and stop select the values whose sweep parameter
+        lies in [start, stop]. Windowed results only decode the windows that
+        overlap the range.
+
+        If max_points is given the swept trace is decimated while reading with
+        method 'minmax' or 'lttb' and a tuple of numpy.arrays (sweep values,
+        trace values) with at most max_points points is returned.
+
         Example:
         swept psf file
         >>> psf=PSFReader('./test/psf/srcSweep')
@@ -1431,7 +2194,24 @@ class PSFReader(object):
                 0.+0.j,  0.+0.j])
 
         """
-        return self.values.getValueByName(name)
+        if start is None and stop is None and max_points is None:
+            return self.values.getValueByName(name)
+        if not self.sweeps:
+            raise ValueError("start, stop and max_points are only supported for swept results")
+        if max_points is not None:
+            return self.values.getDecimatedValueByName(name, max_points, method=method,
+                                                       start=start, stop=stop)
+        return self.values.getValueByName(name, start=start, stop=stop)
+
+    def getValuesByNames(self, names, start=None, stop=None):
+        """Returns a dictionary with the values of several traces
+
+        Windowed results are decoded in a single pass over the windows, in
+        parallel if the reader was created with threads > 1.
+        """
+        if not self.sweeps:
+            return dict([(name, self.values.getValueByName(name)) for name in names])
+        return self.values.getValuesByNames(names, start=start, stop=stop)
         
     def nTraces(self):
         """Returns number of traces
@@ -1547,6 +2327,70 @@ class PSFReader(object):
                 self.values = ValuesSectionNonSweep(self)
             self.values.deSerializeFile(file)
 
+    def deSerializeTruncatedFile(self, file):
+        """Read a PSF file without using the section index at the end of the file
+
+        The sections are read in file order from the start of the file. The
+        values section may be cut off, see ValuesSectionSweep.deSerializeFile.
+        """
+        file.seek(0,2)
+        filesize = file.tell()
+        file.seek(0)
+
+        self.truncated = True
+        self.unk1 = UInt32.fromFile(file)
+
+        try:
+            self.header = HeaderSection(self)
+            self.header.deSerializeFile(file)
+
+            if not self._seekNextSection(file, filesize, [Container22.type]):
+                raise PSFInvalid("PSF file is truncated before its values section")
+            self.types.deSerializeFile(file)
+
+            if self.header.properties.get('PSF sweeps', 0) > 0:
+                if not self._seekNextSection(file, filesize, [DataTypeRef.type]):
+                    raise PSFInvalid("PSF file is truncated before its values section")
+                self.sweeps = SweepSection(self)
+                self.sweeps.deSerializeFile(file)
+
+                if not self._seekNextSection(file, filesize, [Container22.type]):
+                    raise PSFInvalid("PSF file is truncated before its values section")
+                self.traces = TraceSection(self)
+                self.traces.deSerializeFile(file)
+        except TruncationErrors:
+            raise PSFInvalid("PSF file is truncated before its values section")
+
+        # The end position of the values section is only written at the end
+        if self.sweeps:
+            if not self._seekNextSection(file, filesize, [ZeroPad.type, SweepValue.type], bounded=False):
+                return
+            self.values = ValuesSectionSweep(self)
+        else:
+            if not self._seekNextSection(file, filesize, [Container22.type], bounded=False):
+                return
+            self.values = ValuesSectionNonSweep(self)
+        self.values.deSerializeFile(file, filesize=filesize)
+
+    @staticmethod
+    def _seekNextSection(file, filesize, childtypes, bounded=True):
+        """Skip to the start of the next section, returns False at the end of file
+
+        A section starts with the section type, its end position and the type
+        of its first chunk, which must be one of childtypes. If bounded the
+        end position must lie after the start and within the file.
+        """
+        while file.tell() + 3*UInt32.size <= filesize:
+            pos = file.tell()
+            if UInt32.fromFile(file).value == SimpleContainer.type:
+                endpos = UInt32.fromFile(file).value
+                childtype = UInt32.fromFile(file).value
+                if childtype in childtypes and (not bounded or pos < endpos <= filesize):
+                    file.seek(pos)
+                    return True
+            file.seek(pos + UInt32.size)
+        return False
+
     def printme(self):
         print "HEADER"
         print self.header
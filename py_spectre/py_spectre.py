@@ -19,9 +19,27 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import __future__
+import atexit
+import bisect
 import copy
+import gc
+import hashlib
+import io
+import marshal
+import math
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
 
 class NetlistStatement(object):
     """ Holds the contents of a Spectre netlist statement.
@@ -32,6 +50,23 @@ class NetlistStatement(object):
     but not always determined by the name. The method 'ns_match' is the best
     way to identify NetlistStatment objects.
 
+    Statements keep weak references to the search indexes and write caches
+    that contain them and update them when they are modified through their
+    methods. Assigning to the attributes directly bypasses them, call
+    PySpectreScript.reindex afterwards. Statements shared by cloned scripts
+    belong to the script they were cloned from. The modification methods
+    and attribute setters of a shared statement first give the other
+    scripts holding it copies of it, see PySpectreScript.clone. Statements
+    of the include cache can not be modified, their modification methods
+    raise TypeError. Editing the lists and dictionaries a statement hands
+    out is not detected.
+
+    Statements are kept compact for large netlists: the attributes are
+    slots, names, nodes and parameter names are interned, the nodes are
+    held in a tuple that is copied into a list when nodes is first accessed,
+    and statements without parameters or subnetlist share an empty one that
+    is replaced when parameters or subnetlist is accessed.
+
     Attributes:
         name: A string holding the name of the netlist statement.
         nodes: A list of strings that contains the nodes. 
@@ -40,78 +75,229 @@ class NetlistStatement(object):
         subnetlist: A list of NetlistStatement objects. It is a representation
         of a sprectre subnetlist contained in curly braces.
     """
+    __slots__ = ('name', '_nodes', '_params', '_subnetlist', '_indexes', '_frozen')
+    _NO_PARAMETERS = {}  # shared, never modified
+    _NO_SUBNETLIST = ()
+
     def __init__(self, name='', nodes=None, parameters=None, subnetlist=None):
-        if nodes is None:
-            nodes = []
-        if parameters is None:
-            parameters = {}
-        if subnetlist is None:
-            subnetlist = []
-        self.name = name
-        self.nodes = nodes
-        self.parameters = parameters
-        self.subnetlist = subnetlist
+        self.name = _interned(name)
+        if type(nodes) is not tuple:  # tuples come from copies and NetlistCache, already interned
+            nodes = _interned_tuple(nodes) if nodes else ()
+        self._nodes = nodes
+        self._params = parameters if parameters else self._NO_PARAMETERS
+        self._subnetlist = subnetlist if subnetlist else self._NO_SUBNETLIST
+        self._indexes = None
+        self._frozen = False
+
+    def __getstate__(self):
+        # copies are not part of the indexes of the original and not shared
+        return (self.name, self._nodes, self._parameters, self._subnetlist)
+
+    def __setstate__(self, state):
+        name, nodes, parameters, subnetlist = state
+        self.__init__(name, nodes, parameters, subnetlist)
+
+    def get_nodes(self):
+        nodes = self._nodes
+        if type(nodes) is not list:  # copy on write
+            nodes = self._nodes = list(nodes)
+        return nodes
+
+    def set_nodes(self, value):
+        self._unshare()
+        self._nodes = value
+
+    nodes = property(get_nodes, set_nodes)
+
+    def _get_parameters(self):
+        # the values scaled in ParameterColumns are written back before they are read
+        if _pending_columns:
+            _flush_pending_columns()
+        return self._params
+
+    def _set_parameters(self, value):
+        self._params = value
+
+    _parameters = property(_get_parameters, _set_parameters)
+
+    def get_parameters(self):
+        parameters = self._parameters
+        if parameters is self._NO_PARAMETERS:
+            parameters = self._params = {}
+        return parameters
+
+    def set_parameters(self, value):
+        self._unshare()
+        self._params = value
+
+    parameters = property(get_parameters, set_parameters)
+
+    def get_subnetlist(self):
+        subnetlist = self._subnetlist
+        if subnetlist is self._NO_SUBNETLIST:
+            subnetlist = self._subnetlist = []
+        return subnetlist
+
+    def set_subnetlist(self, value):
+        self._unshare()
+        self._subnetlist = value
+
+    subnetlist = property(get_subnetlist, set_subnetlist)
+
+    def _set_nodes(self, nodes):
+        """ Sets the nodes, in place if the list returned by nodes was handed out. """
+        if type(self._nodes) is list:
+            self._nodes[:] = nodes
+        else:
+            self._nodes = _interned_tuple(nodes)
+
+    def _unshare(self):
+        """Gives the other scripts sharing the statement copies of it before it is modified."""
+        shared = self._frozen
+        if not shared:
+            return
+        if shared is True:
+            raise TypeError('statement %s is shared by the include cache, modify it through '
+                            'the PySpectreScript methods' % self.name)
+        owner_ref, family = shared
+        self._frozen = False
+        owner = owner_ref()
+        if owner is not None:
+            owner._all_frozen = False
+        for pss in list(family):
+            if pss is not owner:
+                position = pss._position(self)
+                if position is not None:
+                    pss._thaw(self, position)
+
+    def _borrowed_by(self, pss):
+        """Returns True if the statement is shared with pss and belongs to another script."""
+        shared = self._frozen
+        return shared is True or (shared is not False and shared[0]() is not pss)
+
+    def _modified_by(self, method, args):
+        """Returns False if calling method with args leaves the statement unchanged."""
+        if method == 'change':
+            key = args[0]
+            return key in ('name', 'master') or key in self._nodes or key in self._parameters
+        if method == 'replace':
+            old = args[0]
+            if old in self.name:
+                return True
+            for node in self._nodes:
+                if old in node:
+                    return True
+            for key, value in self._parameters.items():
+                if old in key or old in str(value):
+                    return True
+            return False
+        if method == 'scale':
+            p_name = args[0]
+            if p_name not in self._parameters:
+                return False
+            p_val = string_to_float(self._parameters[p_name])
+            if not isinstance(p_val, str):
+                return True
+            evaluate = args[2] if len(args) > 2 else None
+            return evaluate is not None and evaluate(self, p_val) is not None
+        if method == 'del_param':
+            return args[0] in self._parameters
+        return True
+
+    def _add_index(self, ref):
+        """Registers the weak reference of an index, dropping those of dead indexes."""
+        if self._indexes is None:
+            self._indexes = [ref]
+        else:
+            self._indexes[:] = [r for r in self._indexes if r() is not None]
+            self._indexes.append(ref)
+
+    def _update_indexes(self):
+        """Tells the indexes containing this statement that it changed."""
+        if self._indexes:
+            for ref in list(self._indexes):
+                index = ref()
+                if index is None:
+                    self._indexes.remove(ref)
+                else:
+                    index.update(self)
 
     def get_master(self):
-        if self.nodes:
-            return self.nodes[-1]
+        if self._nodes:
+            return self._nodes[-1]
         else:
             return ''
 
     def set_master(self, value):
-        if self.nodes and value:
-            self.nodes[-1] = value
+        self._unshare()
+        if self._nodes and value:
+            self._set_nodes(list(self._nodes[:-1]) + [value])
         elif value:
-            self.nodes = [value]
+            self._set_nodes([value])
+        self._update_indexes()
 
     master = property(get_master, set_master)
     
     def replace(self, old, new):
-        self.name = self.name.replace(old, new)
-        for j, node in enumerate(self.nodes):
-            self.nodes[j] = self.nodes[j].replace(old, new)
-        for key in self.parameters:
-            new_key = key.replace(old, new)
-            val = self.parameters.pop(key)
-            new_val = val.replace(old, new)
-            self.parameters[new_key] = new_val
+        self._unshare()
+        self.name = _interned(self.name.replace(old, new))
+        self._set_nodes([node.replace(old, new) for node in self._nodes])
+        if self._parameters:
+            for key in self._parameters:
+                new_key = _interned(key.replace(old, new))
+                val = self._parameters.pop(key)
+                new_val = val.replace(old, new)
+                self._parameters[new_key] = new_val
+        self._update_indexes()
 
     def change(self, key, value):
+        self._unshare()
         if key == 'name':
-            self.name = value
+            self.name = _interned(value)
         elif key == 'master':
             self.master = value
-        elif key in self.nodes:
-            for index, node in enumerate(self.nodes):
-                if key == node:
-                    self.nodes[index] = value
-        elif key in self.parameters:
-            self.parameters[key] = value
+        elif key in self._nodes:
+            self._set_nodes([value if node == key else node for node in self._nodes])
+        elif key in self._parameters:
+            self._parameters[key] = value
+        self._update_indexes()
 
-    def scale(self, p_name, alpha):
-        if p_name in self.parameters:
-            p_val = string_to_float(self.parameters[p_name])
+    def scale(self, p_name, alpha, evaluate=None):
+        """ Scales a numeric parameter value.
+
+        evaluate is an optional function returning the value of an expression
+        or None, expressions it can evaluate are scaled as '(expression)*alpha'.
+        """
+        self._unshare()
+        if p_name in self._parameters:
+            p_val = string_to_float(self._parameters[p_name])
             if not isinstance(p_val, str): 
-                self.parameters[p_name] = p_val * alpha
+                self._parameters[p_name] = p_val * alpha
+                self._update_indexes()
+            elif evaluate is not None and evaluate(self, p_val) is not None:
+                self._parameters[p_name] = '(%s)*%r' % (p_val, alpha)
+                self._update_indexes()
 
     def del_param(self, key):
-        if key in self.parameters:
-            del self.parameters[key]
+        self._unshare()
+        if key in self._parameters:
+            del self._parameters[key]
+            self._update_indexes()
 
     def add_param(self, param_name, param_value):
-        self.parameters[param_name] = param_value
+        self._unshare()
+        self.parameters[_interned(param_name)] = param_value
+        self._update_indexes()
            
     def __str__(self):
-        string = self.name + ' '
-        for node in self.nodes:
-            string += node + ' '
-        for p_name, p_val in sorted(self.parameters.items()):
-            string += ' ' + p_name + '=' + str(p_val)
+        string = self.name + ' ' + ''.join([node + ' ' for node in self._nodes])
+        if self._parameters:
+            string += ''.join([' %s=%s' % item for item in sorted(self._parameters.items())])
         return string
 
     def __repr__(self):
         string = str(self) 
-        if self.subnetlist:
+        if self._subnetlist:
             string += ' { ... }'
         return string
 
@@ -121,48 +307,10 @@ class NetlistStatement(object):
         This method will return true is there is a match for all inputs
         provided. The method supports the '*' wild card character. Regular
         expressions are supported through the regex flag. Comparison functions
-        are supported for the p_val input. 
+        are supported for the p_val input. The conditions are compiled into
+        a Query, which is cached for repeated calls with the same conditions.
         """
-        match = True
-        if name and not self.name: match = False
-        if master and not self.master: match = False
-        if node and not self.nodes: match = False
-        if p_name and not self.parameters: match = False
-        if p_val and not self.parameters: match = False 
-        if name: match &= self.compare(name, self.name, regex) 
-        if master: match &= self.compare(master, self.master, regex) 
-        if node:
-            node_match = False
-            for node_name in self.nodes:
-                node_match |= self.compare(node, node_name, regex)  
-            match &= node_match
-        if p_name and p_val:
-            param_match = False
-            for key in self.parameters:
-                if self.compare(p_name, key, regex):
-                    value = self.parameters[key]
-                    if hasattr(p_val, '__call__'):
-                        value_float = string_to_float(value)
-                        if isinstance(value_float, str): 
-                            param_match = False
-                        else:
-                            param_match |= p_val(value_float) 
-                        if not isinstance(param_match, bool):
-                            param_match = False
-                    else:
-                        param_match |= self.compare(p_val, value, regex) 
-            match &= param_match
-        elif p_name:
-            param_name_match = False
-            for key in self.parameters:
-                param_name_match |= self.compare(p_name, key, regex) 
-            match &= param_name_match
-        elif p_val:
-            param_value_match = False
-            for value in self.parameters.values():
-                param_value_match |= self.compare(str(p_val), str(value), regex) 
-            match &= param_value_match
-        return match
+        return Query.compile(name, master, node, p_name, p_val, regex).matches(self)
 
     @staticmethod
     def compare(match_string, string, regex):
@@ -206,33 +354,1706 @@ class NetlistStatement(object):
         """
 
         split_param_list = ns_string.split('=')
-        parameters = {}
-        nodes = []
-        if len(split_param_list) != 1:  # if there are parameters
-            # split_statement = [name, [node0, node1,...], first_param]
-            split_statement = split_param_list.pop(0).split()
-            if len(split_statement) >= 3:  # if there are nodes
-                nodes = split_statement[1:-1]
-            # start parsing parameters
-            param_name = split_statement[-1]
-            for n, split_param in enumerate(split_param_list):
-                param_list_part = split_param.split()
-                if n == len(split_param_list)-1:  # if last split_parameter
-                    param_value = split_param
-                else:
-                    param_value = ' '.join(param_list_part[:-1]) # join except param_name
-                parameters[param_name.strip()] = param_value.strip()
-                param_name = param_list_part[-1]
-        else:  # there are no parameters
+        if len(split_param_list) == 1:  # there are no parameters
             # split_statement = [name, [node0, node1,...]]
             split_statement = ns_string.split()
-            if len(split_statement) > 1:  # if there are nodes
-                nodes = split_statement[1:]
-        name = split_statement[0]
-        return cls(name, nodes, parameters)
+            return cls(split_statement[0], split_statement[1:], {})
+        # split_statement = [name, [node0, node1,...], first_param]
+        split_statement = split_param_list[0].split()
+        nodes = split_statement[1:-1]
+        # start parsing parameters
+        parameters = {}
+        param_name = split_statement[-1]
+        for split_param in split_param_list[1:-1]:
+            param_list_part = split_param.split()
+            parameters[_interned(param_name)] = ' '.join(param_list_part[:-1]) # join except param_name
+            param_name = param_list_part[-1]
+        parameters[_interned(param_name)] = split_param_list[-1].strip()
+        return cls(split_statement[0], nodes, parameters)
+
+
+class Query(object):
+    """ Compiled netlist statement conditions.
+
+    Holds the conditions of _ns_match with the patterns compiled once.
+    Patterns without wildcards are compared as plain strings, 'prefix*' and
+    '*suffix' patterns with startswith and endswith, everything else with a
+    precompiled regular expression. The cheapest conditions are checked
+    first. A Query can be passed instead of the name argument to
+    PySpectreScript.search and remove, and reused across calls and scripts.
+
+    If values is set to a function (ns, value) returning a float or None,
+    it is used for parameter values string_to_float can not convert, see
+    ParameterEvaluator.value.
+
+    With vectorized set, a callable p_val also accepts a numpy array of the
+    values of p_name, NaN where they are not numeric, and returns a bool
+    array. ParameterColumns then calls it once for the whole column.
+
+    Example:
+        q = Query(name='M*', master='nmos', p_name='w', p_val=lambda w: w > 1e-6)
+        pss.search(q)
+        pss.search(Query(p_name='w', p_val=lambda w: w > 1e-6, vectorized=True))
+    """
+    _SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+    _CACHE_SIZE = 256
+    _cache = {}
+
+    def __init__(self, name='', master='', node='', p_name='', p_val='', regex=False, descend=False,
+                 vectorized=False):
+        self.name = name
+        self.master = master
+        self.node = node
+        self.p_name = p_name
+        self.p_val = p_val
+        self.regex = regex
+        self.descend = descend
+        self.vectorized = vectorized
+        self.values = None
+        self._name = self.compile_pattern(name, regex) if name else None
+        self._master = self.compile_pattern(master, regex) if master else None
+        self._node = self.compile_pattern(node, regex) if node else None
+        self._p_name = self.compile_pattern(p_name, regex) if p_name else None
+        self._p_val_callable = hasattr(p_val, '__call__')
+        if p_val and p_name and not self._p_val_callable:
+            self._p_val = self.compile_pattern(p_val, regex)
+        elif p_val and not p_name:
+            self._p_val = self.compile_pattern(str(p_val), regex)
+        else:
+            self._p_val = None
+        if isinstance(descend, str):
+            self._descend = self.compile_pattern(descend, regex)
+        else:
+            self._descend = None
+
+    @classmethod
+    def compile(cls, name='', master='', node='', p_name='', p_val='', regex=False):
+        """ Returns a cached Query for the conditions. """
+        key = (name, master, node, p_name, p_val, regex)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable conditions are not cached
+            return cls(name, master, node, p_name, p_val, regex)
+        if len(cls._cache) >= cls._CACHE_SIZE:
+            cls._cache.clear()
+        query = cls._cache[key] = cls(name, master, node, p_name, p_val, regex)
+        return query
+
+    @classmethod
+    def compile_pattern(cls, pattern, regex=False):
+        """ Returns a function testing a string like NetlistStatement.compare. """
+        if regex:
+            return lambda string, match=re.compile(pattern).match: bool(match(string))
+        special = cls._SPECIAL_CHARS.intersection(pattern)
+        if not special:
+            return lambda string: string == pattern
+        if special == set('*'):
+            if pattern == '*':
+                return lambda string: True
+            if pattern.count('*') == 1 and pattern[-1] == '*':
+                prefix = pattern[:-1]
+                return lambda string: string.startswith(prefix)
+            if pattern.count('*') == 1 and pattern[0] == '*':
+                suffix = pattern[1:]
+                return lambda string: string.endswith(suffix)
+        match = re.compile('^' + pattern.replace('*', '.*?') + '$').match
+        return lambda string: bool(match(string))
+
+    def matches_section(self, section_name):
+        """ Returns True if a subnetlist section named section_name is searched. """
+        if self._descend is None:
+            return bool(self.descend)
+        return self._descend(section_name)
+
+    def matches(self, ns):
+        """ Returns the same result as ns._ns_match with these conditions. """
+        if self._name is not None and not (ns.name and self._name(ns.name)):
+            return False
+        if self._master is not None:
+            master = ns.master
+            if not (master and self._master(master)):
+                return False
+        if self._node is not None:
+            node_match = False
+            for node_name in ns._nodes:
+                if self._node(node_name):
+                    node_match = True
+                    break
+            if not node_match:
+                return False
+        p_name, p_val = self.p_name, self.p_val
+        parameters = ns._parameters
+        if (p_name or p_val) and not parameters:
+            return False
+        if p_name and p_val:
+            param_match = False
+            for key in parameters:
+                if self._p_name(key):
+                    value = parameters[key]
+                    if self._p_val_callable:
+                        value_float = string_to_float(value)
+                        if isinstance(value_float, str) and self.values is not None:
+                            value_float = self.values(ns, value_float)
+                            if value_float is None:
+                                value_float = value
+                        if isinstance(value_float, str):
+                            param_match = False
+                        else:
+                            param_match |= p_val(value_float)
+                        if not isinstance(param_match, bool):
+                            param_match = False
+                    else:
+                        param_match |= self._p_val(value)
+            return param_match
+        elif p_name:
+            for key in parameters:
+                if self._p_name(key):
+                    return True
+            return False
+        elif p_val:
+            for value in parameters.values():
+                if self._p_val(str(value)):
+                    return True
+            return False
+        return True
+
+    __call__ = matches
+
+
+class NetlistIndex(object):
+    """ Hash indexes over the statements of a netlist statement list.
+
+    The statements at the top level of nsl and in its subnetlist sections are
+    indexed by name, master, node and parameter name. Exact patterns are
+    dictionary lookups and wildcard patterns are matched against the sorted
+    keys that share the literal prefix of the pattern. The index only narrows
+    down the candidates, PySpectreScript.search still checks every candidate
+    with _ns_match, so stale entries can not cause wrong results.
+    """
+    FIELDS = ('name', 'master', 'node', 'p_name')
+    _SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
+    def __init__(self, nsl):
+        self.nsl = nsl
+        self.length = len(nsl)
+        self.keys = dict((field, {}) for field in self.FIELDS)
+        self._key_dicts = [self.keys[field] for field in self.FIELDS]
+        self._sorted_keys = {}
+        self._snapshots = {}
+        self._positions = None
+        self._ref = weakref.ref(self)
+        for ns in self._statements(nsl):
+            self.add(ns)
+
+    @staticmethod
+    def _statements(nsl):
+        for ns in nsl:
+            if isinstance(ns, NetlistStatement):
+                yield ns
+            elif isinstance(ns, list):
+                for subns in ns:
+                    if isinstance(subns, NetlistStatement):
+                        yield subns
+
+    @staticmethod
+    def _snapshot(ns):
+        """ Returns the keys of ns for each of the FIELDS. """
+        return ((ns.name,), (ns.master,), tuple(ns._nodes), tuple(ns._parameters))
+
+    def add(self, ns):
+        snapshot = self._snapshot(ns)
+        self._snapshots[ns] = snapshot
+        self._add_keys(ns, snapshot)
+        ns._add_index(self._ref)
+
+    def discard(self, ns):
+        snapshot = self._snapshots.pop(ns, None)
+        if snapshot is None:
+            return
+        self._remove_keys(ns, snapshot)
+        self._positions = None
+        if ns._indexes:
+            ns._indexes[:] = [ref for ref in ns._indexes if ref is not self._ref and ref() is not None]
+
+    def replace(self, old, new):
+        """ Indexes new instead of old at the same position. """
+        snapshot = self._snapshots.pop(old, None)
+        if snapshot is None:
+            return
+        self._remove_keys(old, snapshot)
+        self.add(new)
+        if self._positions is not None and old in self._positions:
+            self._positions[new] = self._positions.pop(old)
+
+    def update(self, ns):
+        """ Reindexes a statement that was modified. """
+        old = self._snapshots.get(ns)
+        if old is None:
+            return
+        new = self._snapshot(ns)
+        if new != old:
+            self._remove_keys(ns, old)
+            self._add_keys(ns, new)
+            self._snapshots[ns] = new
+
+    def _add_keys(self, ns, snapshot):
+        for keys, field_keys in zip(self._key_dicts, snapshot):
+            for key in field_keys:
+                statements = keys.get(key)
+                if statements is not None:
+                    statements.add(ns)
+                elif key != '':
+                    keys[key] = set([ns])
+                    self._sorted_keys.clear()
+
+    def _remove_keys(self, ns, snapshot):
+        for keys, field_keys in zip(self._key_dicts, snapshot):
+            for key in field_keys:
+                statements = keys.get(key)
+                if statements is not None:
+                    statements.discard(ns)
+                    if not statements:
+                        del keys[key]
+                        self._sorted_keys.clear()
+
+    def invalidate_positions(self):
+        self._positions = None
+
+    def position(self, ns):
+        """ Returns (index, subindex) of ns in nsl, subindex is -1 at the top level. """
+        if self._positions is None:
+            self._positions = {}
+            for i, top in enumerate(self.nsl):
+                if isinstance(top, NetlistStatement):
+                    self._positions[top] = (i, -1)
+                elif isinstance(top, list):
+                    for j, subns in enumerate(top):
+                        if isinstance(subns, NetlistStatement):
+                            self._positions[subns] = (i, j)
+        return self._positions.get(ns)
+
+    @classmethod
+    def literal_prefix(cls, pattern):
+        """ Returns the prefix every string matching the wildcard pattern starts with. """
+        if '|' in pattern:
+            return ''
+        for i, char in enumerate(pattern):
+            if char in cls._SPECIAL_CHARS:
+                if char in '?+{':  # quantifiers make the previous char optional
+                    return pattern[:i-1]
+                return pattern[:i]
+        return pattern
+
+    def candidates(self, field, pattern, regex=False, matcher=None):
+        """ Returns the set of statements with a key in field that may match pattern.
+
+        matcher is an optional function compiled from pattern, see
+        Query.compile_pattern.
+        """
+        keys = self.keys[field]
+        if not regex and not self._SPECIAL_CHARS.intersection(pattern):
+            return keys.get(pattern, set())
+        if field not in self._sorted_keys:
+            self._sorted_keys[field] = sorted(keys)
+        sorted_keys = self._sorted_keys[field]
+        prefix = '' if regex else self.literal_prefix(pattern)
+        if matcher is None:
+            matcher = Query.compile_pattern(pattern, regex)
+        result = set()
+        for k in xrange(bisect.bisect_left(sorted_keys, prefix), len(sorted_keys)):
+            key = sorted_keys[k]
+            if not key.startswith(prefix):
+                break
+            if matcher(key):
+                result |= keys[key]
+        return result
+
+
+class ParameterColumns(object):
+    """ Columnar view of the numeric parameter values of a netlist.
+
+    Every statement of nsl and its subnetlist sections is a row. For each
+    parameter name that is used, a numpy float array holds the value of the
+    parameter in each row, NaN if it is missing or not a number. Columns are
+    built on first use and kept up to date through the same statement
+    notifications as NetlistIndex. Scaling is done on the arrays and written
+    back to the statements by flush() when parameters of a statement are
+    read next.
+    """
+    def __init__(self, nsl):
+        import numpy
+        self.numpy = numpy
+        self.nsl = nsl
+        self.length = len(nsl)
+        self.statements = []
+        sections = []
+        section_names = {}
+        for i, ns in enumerate(nsl):
+            if isinstance(ns, NetlistStatement):
+                self.statements.append(ns)
+                sections.append(-1)
+            elif isinstance(ns, list):
+                section_names[i] = ns[0]._nodes[0]
+                for subns in ns:
+                    if isinstance(subns, NetlistStatement):
+                        self.statements.append(subns)
+                        sections.append(i)
+        self.rows = dict((ns, row) for row, ns in enumerate(self.statements))
+        self.sections = numpy.array(sections, dtype=int)
+        self.section_names = section_names
+        self._columns = {}
+        self._pending = {}
+        self._ref = weakref.ref(self)
+        for ns in self.statements:
+            ns._add_index(self._ref)
+
+    @staticmethod
+    def _value(ns, p_name):
+        value = ns._parameters.get(p_name)
+        if value is None:
+            return float('nan')
+        value = string_to_float(value)
+        if isinstance(value, str):
+            return float('nan')
+        return value
+
+    def column(self, p_name):
+        """ Returns the float array of the values of parameter p_name. """
+        if p_name not in self._columns:
+            self._columns[p_name] = string_to_float_array(
+                [ns._parameters.get(p_name) for ns in self.statements])
+        return self._columns[p_name]
+
+    def replace(self, old, new):
+        """ Moves the row of old to new. """
+        row = self.rows.pop(old, None)
+        if row is None:
+            return
+        self.rows[new] = row
+        self.statements[row] = new
+        new._add_index(self._ref)
+        self.update(new)
+
+    def update(self, ns):
+        """ Refreshes the row of a statement that was modified. """
+        row = self.rows.get(ns)
+        if row is None:
+            return
+        for p_name, column in self._columns.items():
+            column[row] = self._value(ns, p_name)
+            if p_name in self._pending:
+                self._pending[p_name][row] = False
+
+    def section_mask(self, query):
+        """ Returns a bool array of the rows searched with query.descend. """
+        numpy = self.numpy
+        if isinstance(query.descend, str):
+            mask = numpy.zeros(len(self.statements), dtype=bool)
+        else:
+            mask = self.sections < 0
+        if query.descend:
+            for i, name in self.section_names.items():
+                if query.matches_section(name):
+                    mask |= self.sections == i
+        return mask
+
+    def candidates(self, query):
+        """ Returns the candidate rows for query or None if it can not be vectorized.
+
+        This is the case for a vectorized query with a callable p_val and a
+        p_name without wildcards, p_val is then called once with the whole
+        column.
+        """
+        if not (query.vectorized and query.p_name and query._p_val_callable) or query.regex or \
+                Query._SPECIAL_CHARS.intersection(query.p_name):
+            return None
+        numpy = self.numpy
+        column = self.column(query.p_name)
+        old_settings = numpy.seterr(invalid='ignore')
+        try:
+            mask = numpy.asarray(query.p_val(column), dtype=bool)
+        finally:
+            numpy.seterr(**old_settings)
+        if mask.shape != column.shape:
+            raise ValueError('vectorized p_val returned shape %s for %s values' % (mask.shape, len(column)))
+        return numpy.flatnonzero(mask & self.section_mask(query))
+
+    def scale(self, p_name, alpha):
+        """ Scales the numeric values of p_name of the top level statements. """
+        numpy = self.numpy
+        column = self.column(p_name)
+        rows = ~numpy.isnan(column) & (self.sections < 0)
+        column[rows] *= alpha
+        if p_name in self._pending:
+            self._pending[p_name] |= rows
+        else:
+            self._pending[p_name] = rows
+        _pending_columns.add(self)
+
+    def flush(self):
+        """ Writes scaled values back to the statements. """
+        pending = self._pending
+        self._pending = {}
+        _pending_columns.discard(self)
+        for p_name, rows in pending.items():
+            column = self._columns[p_name]
+            for row in self.numpy.flatnonzero(rows):
+                ns = self.statements[row]
+                ns._params[p_name] = float(column[row])
+                ns._update_indexes()
+
+
+# The ParameterColumns with scaled values that were not written back yet
+_pending_columns = set()
+
+def _flush_pending_columns():
+    """ Writes the scaled values of all ParameterColumns back to the statements.
+
+    Called when the parameters of any statement are read, which is where
+    statements leave the columnar representation.
+    """
+    while _pending_columns:
+        _pending_columns.pop().flush()
+
+
+class Expression(object):
+    """ A Spectre parameter expression compiled to Python code.
+
+    Supports numbers with scale factors, parameter names, the operators
+    + - * / ** ^ (power), comparisons, && || ! and ?:, parentheses and the
+    functions in FUNCTIONS. The expression is parsed once, compile caches
+    the compiled expressions by text. names holds the parameter names it
+    depends on.
+
+    Example:
+        Expression.compile('R0 * 1k / 42').evaluate({'R0': 2})
+    """
+    FUNCTIONS = {'sqrt': math.sqrt, 'exp': math.exp, 'log': math.log, 'ln': math.log,
+                 'log10': math.log10, 'pow': math.pow, 'abs': abs, 'fabs': abs, 'min': min,
+                 'max': max, 'sin': math.sin, 'cos': math.cos, 'tan': math.tan,
+                 'asin': math.asin, 'acos': math.acos, 'atan': math.atan, 'atan2': math.atan2,
+                 'sinh': math.sinh, 'cosh': math.cosh, 'tanh': math.tanh, 'hypot': math.hypot,
+                 'floor': math.floor, 'ceil': math.ceil, 'int': lambda x: float(int(x))}
+    CONSTANTS = {'M_PI': math.pi, 'M_E': math.e, 'M_TWO_PI': 2 * math.pi,
+                 'M_LN2': math.log(2), 'M_LN10': math.log(10), 'M_SQRT2': math.sqrt(2)}
+    _TOKEN = re.compile(r'\s*(?:((?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)([A-Za-z_%]*)|'
+                        r'([A-Za-z_]\w*)|(\*\*|&&|\|\||[<>=!]=|[-+*/^()<>!?:,]))')
+    _FLAGS = __future__.division.compiler_flag
+    _GLOBALS = dict(FUNCTIONS, __builtins__={})
+    _CACHE_SIZE = 4096
+    _cache = {}
+
+    def __init__(self, text):
+        self.text = text
+        self.names = set()
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+        source = self._ternary()
+        if self._pos != len(self._tokens):
+            raise ValueError('invalid expression: %s' % text)
+        del self._tokens
+        self.source = source
+        self.code = compile(source, '<expression>', 'eval', self._FLAGS, True)
+
+    @classmethod
+    def compile(cls, text):
+        """ Returns the cached Expression for text. """
+        try:
+            return cls._cache[text]
+        except KeyError:
+            pass
+        if len(cls._cache) >= cls._CACHE_SIZE:
+            cls._cache.clear()
+        expression = cls._cache[text] = cls(text)
+        return expression
+
+    @staticmethod
+    def scope_name(name):
+        """ Returns the name of a parameter in the scope of evaluate_scope. """
+        return '_p_' + name
+
+    def evaluate(self, values):
+        """ Returns the value of the expression for a dictionary of parameter values. """
+        return self.evaluate_scope(dict((self.scope_name(name), float(value))
+                                        for name, value in values.items()))
+
+    def evaluate_scope(self, scope):
+        """ Returns the value for a scope keyed by scope_name, raises NameError for missing names. """
+        return float(eval(self.code, self._GLOBALS, scope))
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = self._TOKEN.match(text, pos)
+            if not match:
+                raise ValueError('invalid expression: %s' % text)
+            number, suffix, name, op = match.groups()
+            if number is not None:
+                value = float(number)
+                if suffix:
+                    if suffix[0] not in _SCALE_FACTOR_DICT:
+                        raise ValueError('invalid expression: %s' % text)
+                    value *= _SCALE_FACTOR_DICT[suffix[0]]
+                tokens.append(('number', repr(value)))
+            elif name is not None:
+                tokens.append(('name', name))
+            else:
+                tokens.append(('op', op))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _accept(self, *ops):
+        kind, value = self._peek()
+        if kind == 'op' and value in ops:
+            self._pos += 1
+            return value
+        return None
+
+    def _expect(self, op):
+        if self._accept(op) is None:
+            raise ValueError('invalid expression: %s' % self.text)
+
+    def _ternary(self):
+        condition = self._binary(0)
+        if self._accept('?'):
+            true_value = self._ternary()
+            self._expect(':')
+            false_value = self._ternary()
+            return '(%s if %s else %s)' % (true_value, condition, false_value)
+        return condition
+
+    # binary operators by increasing precedence and their python equivalents
+    _BINARY = [{'||': ' or '}, {'&&': ' and '},
+               {'<': '<', '>': '>', '<=': '<=', '>=': '>=', '==': '==', '!=': '!='},
+               {'+': '+', '-': '-'}, {'*': '*', '/': '/'}]
+
+    def _binary(self, level):
+        if level == len(self._BINARY):
+            return self._unary()
+        operators = self._BINARY[level]
+        left = self._binary(level + 1)
+        while True:
+            op = self._accept(*operators)
+            if op is None:
+                return left
+            right = self._binary(level + 1)
+            left = '(%s%s%s)' % (left, operators[op], right)
+
+    def _unary(self):
+        op = self._accept('-', '+', '!')
+        if op == '!':
+            return '(not %s)' % self._unary()
+        if op is not None:
+            return '(%s%s)' % (op, self._unary())
+        return self._power()
+
+    def _power(self):
+        base = self._atom()
+        if self._accept('**', '^'):
+            return '(%s**%s)' % (base, self._unary())
+        return base
+
+    def _atom(self):
+        kind, value = self._peek()
+        self._pos += 1
+        if kind == 'number':
+            return value
+        if kind == 'name':
+            if self._accept('('):
+                if value not in self.FUNCTIONS:
+                    raise ValueError('unknown function %s in %s' % (value, self.text))
+                args = []
+                if not self._accept(')'):
+                    args.append(self._ternary())
+                    while self._accept(','):
+                        args.append(self._ternary())
+                    self._expect(')')
+                return '%s(%s)' % (value, ', '.join(args))
+            if value in self.CONSTANTS:
+                return repr(self.CONSTANTS[value])
+            self.names.add(value)
+            return self.scope_name(value)
+        if kind == 'op' and value == '(':
+            inner = self._ternary()
+            self._expect(')')
+            return inner
+        raise ValueError('invalid expression: %s' % self.text)
+
+
+class ParameterEvaluator(object):
+    """ Values of the top level parameters of a netlist and of expressions using them.
+
+    The parameters statements at the top level of nsl define the parameters,
+    later definitions override earlier ones. Every definition is compiled
+    once into an Expression and the values are evaluated in dependency
+    order. Modified parameters statements notify the evaluator through the
+    same statement notifications as NetlistIndex, and only the changed
+    parameters and those depending on them are evaluated again. Parameters
+    that can not be evaluated, because of a missing parameter, a cycle or
+    an invalid expression, have the value None.
+    """
+    def __init__(self, nsl):
+        self.nsl = nsl
+        self.length = len(nsl)
+        self.values = {}
+        self.expressions = {}
+        self.dependents = {}
+        self._definitions = {}  # parameters statement -> {name: text}
+        self._owner = {}  # parameter name -> defining parameters statement
+        self._scope = {}
+        self._cache = {}  # expression text -> value
+        self._section_statements = set()
+        self._ref = weakref.ref(self)
+        for ns in nsl:
+            if isinstance(ns, NetlistStatement) and ns.name == 'parameters':
+                self._definitions[ns] = {}
+                ns._add_index(self._ref)
+            elif isinstance(ns, list):
+                self._section_statements.update(ns)
+        self._order = [ns for ns in nsl if isinstance(ns, NetlistStatement) and ns in self._definitions]
+        changed = set()
+        for ns in self._order:
+            changed |= self._define(ns)
+        self._evaluate(changed)
+
+    def _define(self, ns):
+        """ Compiles the changed definitions of a parameters statement, returns their names. """
+        old = self._definitions[ns]
+        new = dict((name, str(text)) for name, text in ns._parameters.items())
+        changed = set()
+        for name in set(old) | set(new):
+            if old.get(name) == new.get(name) and self._owner.get(name) is ns:
+                continue
+            if name not in new:
+                if self._owner.get(name) is not ns:
+                    continue
+                # fall back to an earlier definition
+                owner = None
+                for other in self._order:
+                    if other is not ns and name in other._parameters:
+                        owner = other
+                self._set_expression(name, owner, self._definitions[owner][name] if owner else None)
+            else:
+                owner = self._owner.get(name)
+                if owner is not None and owner is not ns and \
+                        self._order.index(owner) > self._order.index(ns):
+                    continue  # overridden by a later definition
+                self._set_expression(name, ns, new[name])
+            changed.add(name)
+        self._definitions[ns] = new
+        return changed
+
+    def _set_expression(self, name, owner, text):
+        old = self.expressions.pop(name, None)
+        if old is not None:
+            for dependency in old.names:
+                self.dependents.get(dependency, set()).discard(name)
+        self._owner.pop(name, None)
+        if owner is None:
+            return
+        self._owner[name] = owner
+        try:
+            expression = Expression.compile(text)
+        except (ValueError, SyntaxError):
+            expression = None
+        if expression is not None:
+            self.expressions[name] = expression
+            for dependency in expression.names:
+                self.dependents.setdefault(dependency, set()).add(name)
+
+    def _evaluate(self, changed):
+        """ Evaluates the changed parameters and all parameters depending on them. """
+        affected = set()
+        stack = list(changed)
+        while stack:
+            name = stack.pop()
+            if name not in affected:
+                affected.add(name)
+                stack.extend(self.dependents.get(name, ()))
+        invalid = frozenset(affected)
+        for name in affected:
+            self.values.pop(name, None)
+            self._scope.pop(Expression.scope_name(name), None)
+        visiting = set()
+        def visit(name):
+            if name not in affected:
+                return
+            affected.discard(name)
+            visiting.add(name)
+            expression = self.expressions.get(name)
+            value = None
+            if expression is not None:
+                for dependency in expression.names:
+                    if dependency in visiting:  # cycle
+                        break
+                    visit(dependency)
+                else:
+                    value = self._evaluate_expression(expression)
+            visiting.discard(name)
+            if name in self._owner:
+                self.values[name] = value
+            if value is not None:
+                self._scope[Expression.scope_name(name)] = value
+        for name in list(affected):
+            visit(name)
+        for text in [text for text, (names, value) in self._cache.items() if names & invalid]:
+            del self._cache[text]
+
+    def _evaluate_expression(self, expression):
+        try:
+            return expression.evaluate_scope(self._scope)
+        except (NameError, ArithmeticError, ValueError, TypeError):
+            return None
+
+    def update(self, ns):
+        if ns in self._definitions:
+            self._evaluate(self._define(ns))
+
+    def replace(self, old, new):
+        """ Moves the definitions of old to new. """
+        if old in self._section_statements:
+            self._section_statements.discard(old)
+            self._section_statements.add(new)
+        if old not in self._definitions:
+            return
+        self._definitions[new] = self._definitions.pop(old)
+        self._order[self._order.index(old)] = new
+        for name, owner in self._owner.items():
+            if owner is old:
+                self._owner[name] = new
+        new._add_index(self._ref)
+        self.update(new)
+
+    def value(self, ns, text):
+        """ Returns the value of a parameter expression of a top level statement ns or None. """
+        if ns in self._section_statements:
+            return None  # may depend on subcircuit parameters
+        text = str(text)
+        cached = self._cache.get(text)
+        if cached is not None:
+            return cached[1]
+        try:
+            expression = Expression.compile(text)
+        except (ValueError, SyntaxError):
+            self._cache[text] = (frozenset(), None)
+            return None
+        value = self._evaluate_expression(expression)
+        self._cache[text] = (frozenset(expression.names), value)
+        return value
+
+    def evaluate(self, text):
+        """ Returns the value of an expression using the parameters or None. """
+        return self.value(None, text)
+
+
+class HierarchyIndex(object):
+    """ Flattened view of the subcircuit hierarchy of a netlist.
+
+    The subckt sections of nsl are the cells and the statements at the top
+    level of nsl the top cell, named None. A statement whose master is a
+    cell is an instance of it. For each cell the number of statements of
+    each master and the sums of numeric parameters in its flattened
+    contents are computed once from those of the instantiated cells, so
+    queries on the flattened design do not expand the hierarchy. The
+    index is rebuilt on the first query after a statement was modified
+    through the same statement notifications as NetlistIndex.
+
+    Example:
+        hierarchy = pss.hierarchy()
+        hierarchy.count('nmos')
+        hierarchy.total('w', master='nmos')
+        list(hierarchy.paths('I0.*', master='spectre_test_RC'))
+    """
+    STRUCTURE = ('subckt', 'ends', 'parameters', 'section', 'endsection')
+
+    def __init__(self, nsl):
+        self.nsl = nsl
+        self.length = len(nsl)
+        self._ref = weakref.ref(self)
+        self._stale = True
+        for ns in NetlistIndex._statements(nsl):
+            ns._add_index(self._ref)
+
+    def _build(self):
+        self.cells = {None: []}
+        for ns in self.nsl:
+            if isinstance(ns, NetlistStatement):
+                if ns.name not in self.STRUCTURE:
+                    self.cells[None].append(ns)
+            elif isinstance(ns, list) and ns and ns[0].name in ('subckt', 'inline'):
+                header = ns[0]._nodes
+                name = header[1] if ns[0].name == 'inline' and len(header) > 1 else header[0]
+                self.cells[name] = [subns for subns in ns[1:] if isinstance(subns, NetlistStatement)
+                                    and subns.name not in self.STRUCTURE]
+        self._counts = {}
+        self._totals = {}
+        self._reaches = {}
+        self._stale = False
+
+    def update(self, ns):
+        self._stale = True
+
+    def replace(self, old, new):
+        new._add_index(self._ref)
+        self._stale = True
+
+    def _cell(self, cell):
+        if self._stale:
+            self._build()
+        if cell not in self.cells:
+            raise KeyError('no subckt named %s' % cell)
+        return cell
+
+    def _flatten(self, cell, memo, own, visiting=()):
+        """ Returns the dictionary master -> own(ns) summed over the flattened cell. """
+        result = memo.get(cell)
+        if result is not None:
+            return result
+        if cell in visiting:
+            raise ValueError('subckt %s instantiates itself' % cell)
+        visiting = visiting + (cell,)
+        result = {}
+        for ns in self.cells[cell]:
+            master = ns.master
+            value = own(ns)
+            if value:
+                result[master] = result.get(master, 0) + value
+            if master in self.cells:
+                for sub_master, sub_value in self._flatten(master, memo, own, visiting).items():
+                    result[sub_master] = result.get(sub_master, 0) + sub_value
+        memo[cell] = result
+        return result
+
+    def _flat_counts(self, cell):
+        return self._flatten(self._cell(cell), self._counts, lambda ns: 1)
+
+    def _flat_totals(self, p_name, cell):
+        cell = self._cell(cell)
+        def own(ns):
+            value = ns._parameters.get(p_name)
+            if value is None:
+                return 0
+            value = string_to_float(value)
+            return 0 if isinstance(value, str) else value
+        return self._flatten(cell, self._totals.setdefault(p_name, {}), own)
+
+    def counts(self, cell=None):
+        """ Returns a dictionary master -> number of statements in the flattened cell. """
+        return dict(self._flat_counts(cell))
+
+    def totals(self, p_name, cell=None):
+        """ Returns a dictionary master -> sum of the numeric values of p_name in the flattened cell. """
+        return dict(self._flat_totals(p_name, cell))
+
+    def count(self, master, cell=None, regex=False):
+        """ Returns the number of statements with a master matching master in the flattened cell. """
+        match = Query.compile_pattern(master, regex)
+        return sum(n for name, n in self._flat_counts(cell).items() if match(name))
+
+    def total(self, p_name, master='*', cell=None, regex=False):
+        """ Returns the sum of the numeric values of p_name in the flattened cell.
+
+        Only statements with a master matching master are summed, values
+        that are expressions are skipped.
+        """
+        match = Query.compile_pattern(master, regex)
+        return sum(value for name, value in self._flat_totals(p_name, cell).items() if match(name))
+
+    def paths(self, pattern='*', master='*', cell=None, regex=False):
+        """ Yields the hierarchical names of the statements in the flattened cell.
+
+        Names are the instance names from cell down joined by '.', like
+        'I0.I5.R0'. Only statements with a master matching master and names
+        matching pattern are yielded, and instances of cells without such
+        statements are not expanded.
+        """
+        match_master = Query.compile_pattern(master, regex)
+        match_path = Query.compile_pattern(pattern, regex)
+        cell = self._cell(cell)
+        reaches = self._reaches.setdefault((master, regex), {})
+        def reaches_master(cell):
+            if cell not in reaches:
+                reaches[cell] = any(match_master(name) for name in self._flat_counts(cell))
+            return reaches[cell]
+        def walk(cell, prefix):
+            for ns in self.cells[cell]:
+                path = prefix + ns.name
+                master = ns.master
+                if match_master(master) and match_path(path):
+                    yield path
+                if master in self.cells and reaches_master(master):
+                    for sub_path in walk(master, path + '.'):
+                        yield sub_path
+        return walk(cell, '')
+
+
+class NetlistCache(object):
+    """ On-disk cache of parsed netlists.
+
+    Each netlist is stored in directory as a marshal file named after the
+    sha1 of its absolute path, with a header holding the size, mtime and
+    sha1 content digest of the netlist. An entry is used if size and mtime
+    match, or if only the mtime changed and the content digest still
+    matches. Statements are stored as (name, nodes, parameters, subnetlist)
+    tuples and subnetlist sections as lists. When the entries take up more
+    than max_bytes, the least recently used ones are removed.
+
+    Example:
+        PySpectreScript.netlist_cache = NetlistCache('/tmp/py_spectre_cache')
+    """
+    VERSION = 1
+    SUFFIX = '.nsl'
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entry_path(self, path):
+        """ Returns the path of the cache entry of the netlist at path. """
+        key = hashlib.sha1(os.path.abspath(path)).hexdigest()
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    @staticmethod
+    def digest(path, block_size=1 << 20):
+        """ Returns the sha1 hex digest of the contents of the file at path. """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fin:
+            block = fin.read(block_size)
+            while block:
+                sha1.update(block)
+                block = fin.read(block_size)
+        return sha1.hexdigest()
+
+    def get(self, path, parse):
+        """ Returns the nsl of the netlist at path, calling parse(fin) on a miss. """
+        stat = os.stat(path)
+        entry = self.entry_path(path)
+        header = self._read_header(entry)
+        digest = None
+        if header is not None and header[1] == stat.st_size:
+            if header[2] == stat.st_mtime:
+                nsl = self._load(entry)
+            else:
+                digest = self.digest(path)
+                nsl = self._load(entry) if digest == header[3] else None
+                if nsl is not None:  # only touched, store the new mtime
+                    self._write(entry, (self.VERSION, stat.st_size, stat.st_mtime, digest), nsl)
+            if nsl is not None:
+                os.utime(entry, None)
+                self.hits += 1
+                return self.unpack(nsl)
+        self.misses += 1
+        if digest is None:
+            digest = self.digest(path)
+        with open(path, 'r') as fin:
+            nsl = parse(fin)
+        self._write(entry, (self.VERSION, stat.st_size, stat.st_mtime, digest), self.pack(nsl))
+        self.evict()
+        return nsl
+
+    def _read_header(self, entry):
+        try:
+            with open(entry, 'rb') as fin:
+                header = marshal.load(fin)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(header, tuple) or len(header) != 4 or header[0] != self.VERSION:
+            return None
+        return header
+
+    def _load(self, entry):
+        try:
+            with open(entry, 'rb') as fin:
+                marshal.load(fin)  # header
+                return marshal.load(fin)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _write(self, entry, header, packed):
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                marshal.dump(header, fout)
+                marshal.dump(packed, fout)
+            os.rename(tmp_path, entry)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        """ Removes the least recently used entries until they fit in max_bytes. """
+        entries = []
+        total = 0
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(self.SUFFIX):
+                continue
+            entry = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """ Removes all entries. """
+        for fname in os.listdir(self.directory):
+            if fname.endswith(self.SUFFIX):
+                os.remove(os.path.join(self.directory, fname))
+
+    @classmethod
+    def pack(cls, nsl):
+        """ Converts an nsl into tuples and lists of strings. """
+        packed = []
+        for ns in nsl:
+            if isinstance(ns, NetlistStatement):
+                subnetlist = cls.pack(ns._subnetlist) if ns._subnetlist else None
+                packed.append((ns.name, ns._nodes, ns._parameters, subnetlist))
+            else:
+                packed.append(cls.pack(ns))
+        return packed
+
+    @classmethod
+    def unpack(cls, packed):
+        """ Inverse of pack. """
+        nsl = []
+        for item in packed:
+            if isinstance(item, tuple):
+                name, nodes, parameters, subnetlist = item
+                if subnetlist is not None:
+                    subnetlist = cls.unpack(subnetlist)
+                nsl.append(NetlistStatement(name, nodes, parameters, subnetlist))
+            else:
+                nsl.append(cls.unpack(item))
+        return nsl
+
+
+class ResultCache(object):
+    """ On-disk cache of simulation results.
+
+    Results are stored in directory under a key that is the sha1 of the
+    netlist as written, the contents of the files it includes, recursively,
+    and the command line arguments, so the same simulation is found again
+    whatever its netlist and results paths. Included files are identified
+    by their contents and their normalized path relative to the directory
+    of the netlist, or their absolute path if they are included by one, so
+    checkouts of the same design in different directories share entries
+    and different spellings of the same path hit. PySpectreScript.run and
+    SimulationRunner copy the results of a hit to path_to_results instead of
+    running Spectre, and store the results of successful runs. With link,
+    results are hard linked instead of copied, which is only safe if
+    nothing writes to the result files afterwards. When the entries take
+    up more than max_bytes, the least recently used ones are removed. The
+    sizes of the entries are counted once and then kept up to date by put,
+    entries that other processes add meanwhile are only counted by the
+    next ResultCache on the directory.
+
+    Example:
+        PySpectreScript.result_cache = ResultCache('/tmp/py_spectre_results')
+    """
+    VERSION = 1
+    SUFFIX = '.psf'
+
+    def __init__(self, directory, max_bytes=10 << 30, link=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}  # (path, size, mtime) -> sha1 of the contents
+        self._sizes = None  # entry path -> size in bytes
+        self._total = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, pss):
+        """ Returns the key of the results of simulating pss. """
+        sha1 = hashlib.sha1('%s %d\n' % (self.__class__.__name__, self.VERSION))
+        path = pss.path_to_script_out or pss.path_to_script_in
+        directory = os.path.dirname(os.path.abspath(path)) if path else os.getcwd()
+        includes = hashlib.sha1()
+        lines = {}  # include statement line -> the line with the normalized path
+        self._update_includes(includes, pss.nsl, directory, directory, set(), lines)
+        for line in PySpectreScript._section_lines(pss.nsl):
+            sha1.update(lines.get(line, line))
+        sha1.update(includes.digest())
+        for args in pss.command_line_args:
+            sha1.update('\0' + args)
+        return sha1.hexdigest()
+
+    def _update_includes(self, sha1, nsl, root, directory, visited, lines=None):
+        for ns in NetlistIndex._statements(nsl):
+            target = PySpectreScript._include_target(ns)
+            if target is None:
+                continue
+            written = os.path.expanduser(target[0])
+            path = os.path.normpath(os.path.join(directory, written))
+            name = path if os.path.isabs(written) else os.path.relpath(path, root)
+            if lines is not None:
+                lines[str(ns) + '\n'] = '%s "%s" %s\n' % (ns.name, name, target[1])
+            if path in visited:
+                continue
+            visited.add(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                sha1.update('\0%s missing' % name)
+                continue
+            digest_key = (path, stat.st_size, stat.st_mtime)
+            if digest_key not in self._digests:
+                self._digests[digest_key] = NetlistCache.digest(path)
+            sha1.update('\0%s %s' % (name, self._digests[digest_key]))
+            self._update_includes(sha1, read_include(path), root, os.path.dirname(path), visited)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key, path_to_results):
+        """ Puts the results stored under key at path_to_results, returns False on a miss. """
+        entry = self.entry_path(key)
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return False
+        if os.path.isdir(path_to_results):
+            shutil.rmtree(path_to_results)
+        try:
+            self._copy_tree(entry, path_to_results, self.link)
+        except (IOError, OSError):  # evicted meanwhile
+            shutil.rmtree(path_to_results, ignore_errors=True)
+            self.misses += 1
+            return False
+        os.utime(entry, None)
+        self.hits += 1
+        return True
+
+    def put(self, key, path_to_results):
+        """ Stores the results at path_to_results under key. """
+        entry = self.entry_path(key)
+        if os.path.isdir(entry) or not os.path.isdir(path_to_results):
+            return
+        # copy to a temporary directory first so readers never see a partial entry
+        tmp_path = tempfile.mkdtemp(dir=self.directory)
+        try:
+            self._copy_tree(path_to_results, os.path.join(tmp_path, 'psf'), self.link)
+            os.rename(os.path.join(tmp_path, 'psf'), entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+            return  # stored by another process meanwhile
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        if self._sizes is not None:
+            self._sizes[entry] = size = self._size(entry)
+            self._total += size
+        self.evict()
+
+    @staticmethod
+    def _copy_tree(source, destination, link):
+        os.makedirs(destination)
+        for fname in os.listdir(source):
+            source_path = os.path.join(source, fname)
+            destination_path = os.path.join(destination, fname)
+            if os.path.isdir(source_path):
+                ResultCache._copy_tree(source_path, destination_path, link)
+                continue
+            if link:
+                try:
+                    os.link(source_path, destination_path)
+                    continue
+                except OSError:  # e.g. another file system
+                    pass
+            shutil.copy2(source_path, destination_path)
+
+    @staticmethod
+    def _size(directory):
+        size = 0
+        for dirpath, dirnames, fnames in os.walk(directory):
+            for fname in fnames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, fname))
+                except OSError:
+                    pass
+        return size
+
+    def _count_sizes(self):
+        self._sizes = {}
+        self._total = 0
+        for fname in os.listdir(self.directory):
+            if fname.endswith(self.SUFFIX):
+                entry = os.path.join(self.directory, fname)
+                self._sizes[entry] = size = self._size(entry)
+                self._total += size
+
+    def evict(self):
+        """ Removes the least recently used entries until they fit in max_bytes. """
+        if self._sizes is None:
+            self._count_sizes()
+        if self._total <= self.max_bytes:
+            return
+        entries = []
+        for entry, size in self._sizes.items():
+            try:
+                entries.append((os.stat(entry).st_mtime, entry))
+            except OSError:  # removed by another process
+                self._total -= self._sizes.pop(entry)
+        entries.sort()
+        for mtime, entry in entries:
+            if self._total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            self._total -= self._sizes.pop(entry)
+
+    def clear(self):
+        """ Removes all entries. """
+        for fname in os.listdir(self.directory):
+            if fname.endswith(self.SUFFIX):
+                shutil.rmtree(os.path.join(self.directory, fname), ignore_errors=True)
+        self._sizes = {}
+        self._total = 0
+
+
+class WriteCache(object):
+    """ Byte ranges of the items of a netlist in the file it was last written to.
+
+    Every top level statement or subnetlist section of nsl is an item. Items
+    are marked dirty through the same statement notifications as
+    NetlistIndex. write renders the dirty items and copies the runs of
+    clean items from the previous file, so rewriting a large netlist after
+    a few changes costs the changed bytes plus a sequential copy. The
+    previous file is only used if its size and mtime are those it was
+    written with.
+    """
+    HEADER = '// Generated by PySpectre\n'
+    COPY_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, nsl):
+        self.nsl = nsl
+        self.length = len(nsl)
+        self.items = {}
+        self.dirty = set()
+        self.path = None
+        self.stat = None
+        self.offsets = None
+        self._ref = weakref.ref(self)
+        for i, item in enumerate(nsl):
+            if isinstance(item, NetlistStatement) and not item._subnetlist:
+                statements = (item,)
+            else:
+                statements = self._statements(item)
+            for ns in statements:
+                self.items[ns] = i
+                ns._add_index(self._ref)
+
+    @staticmethod
+    def _statements(item):
+        if isinstance(item, NetlistStatement):
+            yield item
+            for ns in WriteCache._statements(item._subnetlist):
+                yield ns
+        elif isinstance(item, list):
+            for subitem in item:
+                for ns in WriteCache._statements(subitem):
+                    yield ns
+
+    def replace(self, old, new):
+        """ Moves the statements of old to new and marks their item dirty. """
+        item = self.items.get(old)
+        if item is None:
+            return
+        for ns in self._statements(old):
+            self.items.pop(ns, None)
+        for ns in self._statements(new):
+            self.items[ns] = item
+            ns._add_index(self._ref)
+        self.dirty.add(item)
+
+    def update(self, ns):
+        """ Marks the item containing a modified statement dirty. """
+        item = self.items.get(ns)
+        if item is not None:
+            self.dirty.add(item)
+
+    def _previous_file(self):
+        if self.offsets is None:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime) != self.stat:
+            return None
+        return open(self.path, 'rb')
+
+    def write(self, path):
+        """ Writes nsl to path, reusing the clean items of the previous file. """
+        _flush_pending_columns()  # marks the scaled statements dirty
+        nsl = self.nsl
+        old = self._previous_file()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        offsets = []
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(self.HEADER)
+                pos = len(self.HEADER)
+                if old is None:
+                    dirty = xrange(len(nsl))
+                else:
+                    dirty = sorted(self.dirty) + [len(nsl)]
+                start = 0
+                for i in dirty:
+                    if start < i:  # copy the run of clean items
+                        begin, end = self.offsets[start], self.offsets[i]
+                        offsets.extend([offset - begin + pos for offset in self.offsets[start:i]])
+                        old.seek(begin)
+                        remaining = end - begin
+                        while remaining > 0:
+                            block = old.read(min(remaining, self.COPY_BLOCK_SIZE))
+                            fout.write(block)
+                            remaining -= len(block)
+                        pos += end - begin
+                    if i < len(nsl):
+                        item = nsl[i]
+                        if isinstance(item, NetlistStatement) and not item._subnetlist:
+                            text = str(item) + '\n'
+                        else:
+                            text = ''.join(PySpectreScript._section_lines([item]))
+                        offsets.append(pos)
+                        fout.write(text)
+                        pos += len(text)
+                    start = i + 1
+                offsets.append(pos)
+            if old is not None:
+                old.close()
+                old = None
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+                if os.name == 'nt':
+                    os.remove(path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0666 & ~umask)
+            os.rename(tmp_path, path)
+        except Exception:
+            if old is not None:
+                old.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        stat = os.stat(path)
+        self.path = path
+        self.stat = (stat.st_size, stat.st_mtime)
+        self.offsets = offsets
+        self.dirty.clear()
+
+
+class ParameterSplit(object):
+    """ Splits the top level parameters statements of a netlist into an include file.
+
+    The first top level parameters statement and those directly following
+    it are written to the parameters file, and the body is the netlist with
+    an include of the parameters file in their place. Later parameters
+    statements stay in the body, so that no statement changes its order.
+    Modifications of statements other than the split parameters statements
+    mark the body dirty through the same statement notifications as
+    NetlistIndex, so a sweep over parameter values rewrites only the
+    parameters file.
+    """
+    def __init__(self, nsl):
+        self.nsl = nsl
+        self.length = len(nsl)
+        self.parameters = []
+        for ns in nsl:
+            if isinstance(ns, NetlistStatement) and ns.name == 'parameters':
+                self.parameters.append(ns)
+            elif self.parameters:
+                break
+        self.body_dirty = True
+        self.path = None
+        self._parameters = set(self.parameters)
+        self._ref = weakref.ref(self)
+        for ns in WriteCache._statements(nsl):
+            ns._add_index(self._ref)
+
+    @staticmethod
+    def parameters_path(path):
+        """ Returns the path of the parameters file of the body at path. """
+        root, ext = os.path.splitext(path)
+        return root + '.params' + (ext or '.scs')
+
+    def replace(self, old, new):
+        new._add_index(self._ref)
+        if old in self._parameters:
+            self.parameters[self.parameters.index(old)] = new
+            self._parameters.discard(old)
+            self._parameters.add(new)
+        else:
+            self.body_dirty = True
+
+    def update(self, ns):
+        if ns not in self._parameters or ns.name != 'parameters':
+            self.body_dirty = True
+
+    def write(self, path):
+        """ Writes the parameters file and, if it changed, the body to path. """
+        _flush_pending_columns()
+        parameters_path = self.parameters_path(path)
+        with open(parameters_path, 'w') as fout:
+            fout.write(WriteCache.HEADER)
+            PySpectreScript._write_section(fout, self.parameters)
+        if not self.body_dirty and path == self.path and os.path.exists(path):
+            return
+        include = NetlistStatement('include', ['"%s"' % os.path.basename(parameters_path)])
+        body = []
+        for ns in self.nsl:
+            if ns in self._parameters:
+                if include is not None:
+                    body.append(include)
+                    include = None
+            else:
+                body.append(ns)
+        with open(path, 'w') as fout:
+            fout.write(WriteCache.HEADER)
+            PySpectreScript._write_section(fout, body)
+        self.path = path
+        self.body_dirty = False
+
+
+class Batch(object):
+    """ Edits of a PySpectreScript that are applied in one pass over nsl.
+
+    Returned by PySpectreScript.batch and applied when the with block is
+    left without an exception, or by calling apply. Removals and net
+    renames act on the statements of the script when the batch is applied,
+    added statements are inserted as given. Positions of added statements
+    refer to nsl before the batch, statements added at the same position
+    are inserted in the order of the calls.
+
+    Example:
+        with pss.batch() as b:
+            b.remove('C*')
+            b.add('R9 (a b) resistor r=1k', 3)
+            b.rename_nets({'net1': 'vin', 'net2': 'vout'})
+    """
+    def __init__(self, pss):
+        self.pss = pss
+        self.queries = []
+        self.inserts = []
+        self.renames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.apply()
+
+    def remove(self, name='', master='', node='', p_name='', p_val='', regex=False, descend=False):
+        """ Removes the matching statements like PySpectreScript.remove. """
+        if isinstance(name, Query):
+            self.queries.append(name)
+        else:
+            self.queries.append(Query(name, master, node, p_name, p_val, regex, descend))
+
+    def add(self, ns, index=None, deep_copy=True):
+        """ Inserts statements like PySpectreScript.add. """
+        self.inserts.append((index, PySpectreScript._statement_list(ns, deep_copy)))
+
+    def rename_nets(self, nets, descend=False):
+        """ Renames the nodes that are keys of the dictionary nets.
+
+        The statements are selected with descend like in PySpectreScript.search,
+        a string only selects the subnetlist sections it matches.
+        """
+        self.renames.append((dict(nets), Query(descend=descend)))
+
+    def _nets(self, section_name=None):
+        """ Returns the composition of the renames that apply to a section. """
+        composed = None
+        for nets, query in self.renames:
+            if section_name is None:
+                if isinstance(query.descend, str):
+                    continue
+            elif not query.matches_section(section_name):
+                continue
+            if composed is None:
+                composed = dict(nets)
+            else:
+                for key, value in composed.items():
+                    composed[key] = nets.get(value, value)
+                for key, value in nets.items():
+                    composed.setdefault(key, value)
+        return composed
+
+    def _rename(self, ns, nets, renamed, thawed, position):
+        for node in ns._nodes:
+            if node in nets:
+                break
+        else:
+            return ns
+        if ns._frozen:  # shared with a clone
+            new = copy.deepcopy(ns)
+            thawed.append((ns, new, position))
+            ns = new
+        else:
+            renamed.append(ns)
+        ns._set_nodes([nets.get(node, node) for node in ns._nodes])
+        return ns
+
+    def apply(self):
+        """ Applies the edits and clears the batch. """
+        pss = self.pss
+        nsl = pss.nsl
+        length = len(nsl)
+        inserts = {}
+        added = []
+        for index, statements in self.inserts:
+            if index is None:
+                index = length
+            elif index < 0:
+                index = max(index + length, 0)
+            inserts.setdefault(min(index, length), []).extend(statements)
+            added.extend(statements)
+        queries = self.queries
+        top_queries = [query for query in queries if not isinstance(query.descend, str)]
+        section_queries = [query for query in queries if query.descend]
+        top_nets = self._nets()
+        section_nets = {}
+        removed = []
+        renamed = []
+        thawed = []
+        new_nsl = []
+        for i, ns in enumerate(nsl):
+            if i in inserts:
+                new_nsl.extend(inserts[i])
+            if isinstance(ns, NetlistStatement):
+                matched = False
+                for query in top_queries:
+                    if query.matches(ns):
+                        matched = True
+                        break
+                if matched:
+                    removed.append(ns)
+                    continue
+                if top_nets:
+                    ns = self._rename(ns, top_nets, renamed, thawed, (i, -1))
+            elif isinstance(ns, list) and ns and (section_queries or self.renames):
+                section_name = ns[0]._nodes[0] if ns[0]._nodes else ''
+                if section_name not in section_nets:
+                    section_nets[section_name] = self._nets(section_name)
+                nets = section_nets[section_name]
+                section = []
+                for j, subns in enumerate(ns):
+                    matched = False
+                    for query in section_queries:
+                        if query.matches(subns):
+                            matched = True
+                            break
+                    if matched:
+                        removed.append(subns)
+                        continue
+                    if nets and isinstance(subns, NetlistStatement):
+                        subns = self._rename(subns, nets, renamed, thawed, (i, j))
+                    section.append(subns)
+                if len(section) != len(ns) or any(a is not b for a, b in zip(section, ns)):
+                    # a new list, the section may be shared with a clone
+                    if pss._private_sections is not None:
+                        pss._private_sections[id(section)] = section
+                    ns = section
+            new_nsl.append(ns)
+        if length in inserts:
+            new_nsl.extend(inserts[length])
+        nsl[:] = new_nsl
+        self.queries = []
+        self.inserts = []
+        self.renames = []
+        if not (removed or added or thawed or renamed):
+            return
+        if added or thawed:
+            pss._all_frozen = False
+        for ns in renamed:
+            ns._update_indexes()
+        if added or removed:
+            pss._structure_changed()
+            index = pss._index
+            if index is not None and index.nsl is nsl:
+                for ns in removed:
+                    index.discard(ns)
+                for old, new, position in thawed:
+                    index.replace(old, new)
+                for ns in NetlistIndex._statements(added):
+                    index.add(ns)
+                index.length = len(nsl)
+                index.invalidate_positions()
+        else:
+            # the positions are kept, the caches follow the copies like in _replace_statement
+            for old, new, position in thawed:
+                pss._replace_in_caches(old, new)
+            if pss._private_sections is not None:
+                pss._replaced.extend([position for old, new, position in thawed])
+        if thawed and pss._cow_parent is not None:
+            for old, new, position in thawed:
+                pss._cow_parent._replace_statement(old, new)
+
 
-    
 class PySpectreScript(object):
+    """ A Spectre netlist as a list of NetlistStatement objects.
+
+    Top-level statements are held in nsl, subckt and section definitions are
+    nested lists of statements. Searches on scripts with at least
+    index_threshold statements are answered through a NetlistIndex that is
+    built on the first search and kept up to date by the modification
+    methods. With enable_columns, vectorized Query constraints and scale are
+    evaluated on ParameterColumns with numpy. With enable_expressions,
+    parameter values that are expressions of the top level parameters are
+    evaluated by a ParameterEvaluator for numeric searches and scale. With
+    enable_incremental_write, write only renders the statements modified
+    since the last write, and with enable_parameter_sweep the leading top
+    level parameters statements are written to a separate include file so
+    that the rest of the netlist is only written when it changes. Setting
+    netlist_cache to a NetlistCache makes read reuse previously parsed
+    netlists and setting result_cache to a ResultCache makes run reuse the
+    results of identical simulations. With read_processes above one, netlists
+    of at least parallel_read_min_size bytes are parsed by a pool of
+    processes, and read_disable_gc pauses the garbage collector while
+    parsing, see read. hierarchy returns a HierarchyIndex for queries on the
+    flattened design. run_async and results_async start a simulation and
+    decode results without blocking, and the experimental sweep runs
+    analyses over a grid of parameter values in one simulation. clone returns
+    a copy-on-write copy of the script.
+    """
+    index_threshold = 64
+    read_block_size = 1 << 20
+    read_processes = 1
+    parallel_read_min_size = 32 << 20
+    read_disable_gc = False
+    netlist_cache = None
+    result_cache = None
+
     def __init__(self, path=''):
         self.nsl = []
         self.command_line_args = []
@@ -240,43 +2061,376 @@ class PySpectreScript(object):
         self.path_to_script_in = ''
         self.path_to_results = ''
         self.psf_results = {}
+        self.returncode = None
+        self._results_lock = threading.Lock()
+        self._index = None
+        self._columns = None
+        self._use_columns = False
+        self._evaluator = None
+        self._use_expressions = False
+        self._hierarchy = None
+        self._write_cache = None
+        self._incremental_write = False
+        self._parameter_split = None
+        self._parameter_sweep = False
+        self._cow_parent = None
+        self._private_sections = None
+        self._all_frozen = False
+        self._family = None  # the scripts cloned from each other
+        self._share = None  # marks the statements of this script shared with its family
+        self._borrows = False
+        self._replaced = []
+        self._structure_version = 0
+        self._index_source = None
+        self._dirty_positions = ()
         if path:
             self.read(path)
     
     #########################
     # Netlist Modifications #
     #########################
+    def query(self, name='', master='', node='', p_name='', p_val='', regex=False, descend=False,
+              vectorized=False):
+        """ Returns a compiled Query that can be passed to search and remove. """
+        return Query(name, master, node, p_name, p_val, regex, descend, vectorized)
+
     def search(self, name='', master='', node='', p_name='', p_val='', regex=False, descend=False):
+        """ Returns a PySpectreScript with the matching statements.
+
+        The conditions are those of NetlistStatement._ns_match, or name can be
+        a Query. Statements in subnetlist sections are searched if descend is
+        True or matches the section name.
+        """
+        if isinstance(name, Query):
+            query = name
+        else:
+            query = Query(name, master, node, p_name, p_val, regex, descend)
+        evaluator = self._get_evaluator()
+        if evaluator is not None and query._p_val_callable:
+            query = copy.copy(query)
+            query.values = evaluator.value
+        result = self._search(query)
+        # modifications of shared statements through the result are copied into self
+        result._cow_parent = self
+        return result
+
+    def _search(self, query):
+        columns = self._get_columns()
+        if columns is not None and query.values is None:
+            rows = columns.candidates(query)
+            if rows is not None:
+                nsl = PySpectreScript()
+                for row in rows:
+                    ns = columns.statements[row]
+                    if query.matches(ns):
+                        nsl.add(ns, deep_copy=False)
+                return nsl
+        if len(self.nsl) >= self.index_threshold and \
+                (query.name or query.master or query.node or query.p_name):
+            return self._search_index(query)
         nsl = PySpectreScript()
-        has_descend_str = isinstance(descend, str)
+        has_descend_str = isinstance(query.descend, str)
         for ns in self.nsl:
             if isinstance(ns, NetlistStatement) and not has_descend_str:
-                if ns._ns_match(name, master, node, p_name, p_val, regex):
+                if query.matches(ns):
                     nsl.add(ns, deep_copy=False)
-            elif isinstance(ns, list) and descend:
-                if has_descend_str: 
-                    descend_now = NetlistStatement.compare(descend, ns[0].nodes[0], regex)
-                else:
-                    descend_now = descend
-                if descend_now:
+            elif isinstance(ns, list) and query.descend:
+                if query.matches_section(ns[0]._nodes[0]):
                     for subns in ns:
-                        if subns._ns_match(name, master, node, p_name, p_val, regex):
+                        if query.matches(subns):
                             nsl.add(subns, deep_copy=False)
         return nsl
+
+    def reindex(self):
+        """ Drops the search index, columns and write caches, they are rebuilt when needed. """
+        self._index = None
+        self._columns = None
+        self._evaluator = None
+        self._hierarchy = None
+        self._write_cache = None
+        self._parameter_split = None
+
+    def enable_columns(self, enabled=True):
+        """ Turns the numpy ParameterColumns on or off. """
+        self._use_columns = enabled
+        self._columns = None
+
+    def enable_expressions(self, enabled=True):
+        """ Turns evaluating parameter expressions on or off, see ParameterEvaluator. """
+        self._use_expressions = enabled
+        self._evaluator = None
+
+    def evaluate(self, expression):
+        """ Returns the value of an expression of the top level parameters or None.
+
+        Example:
+            pss.evaluate('R0 * 1k / 42')
+        """
+        evaluator = self._get_evaluator()
+        if evaluator is None:
+            evaluator = ParameterEvaluator(self.nsl)
+        return evaluator.evaluate(expression)
+
+    def enable_incremental_write(self, enabled=True):
+        """ Turns the WriteCache of write on or off. """
+        self._incremental_write = enabled
+        self._write_cache = None
+
+    def enable_parameter_sweep(self, enabled=True):
+        """ Turns writing the parameters statements to a separate file on or off.
+
+        The file is named after the netlist with '.params' before the
+        extension, see ParameterSplit.
+        """
+        self._parameter_sweep = enabled
+        self._parameter_split = None
+
+    def hierarchy(self):
+        """ Returns the HierarchyIndex of the netlist, it is built once and kept up to date. """
+        hierarchy = self._hierarchy
+        if hierarchy is None or hierarchy.nsl is not self.nsl or hierarchy.length != len(self.nsl):
+            hierarchy = self._hierarchy = HierarchyIndex(self.nsl)
+        return hierarchy
+
+    def _get_parameter_split(self):
+        split = self._parameter_split
+        if split is None or split.nsl is not self.nsl or split.length != len(self.nsl):
+            split = self._parameter_split = ParameterSplit(self.nsl)
+        return split
+
+    def _get_write_cache(self):
+        write_cache = self._write_cache
+        if write_cache is None or write_cache.nsl is not self.nsl or write_cache.length != len(self.nsl):
+            write_cache = self._write_cache = WriteCache(self.nsl)
+        return write_cache
+
+    def _get_columns(self):
+        if not self._use_columns:
+            return None
+        columns = self._columns
+        if columns is None or columns.nsl is not self.nsl or columns.length != len(self.nsl):
+            columns = self._columns = ParameterColumns(self.nsl)
+        return columns
+
+    def _get_evaluator(self):
+        if not self._use_expressions:
+            if self._cow_parent is not None:  # a search result evaluates in its script
+                return self._cow_parent._get_evaluator()
+            return None
+        evaluator = self._evaluator
+        if evaluator is None or evaluator.nsl is not self.nsl or evaluator.length != len(self.nsl):
+            evaluator = self._evaluator = ParameterEvaluator(self.nsl)
+        return evaluator
+
+    def _get_index(self):
+        index = self._index
+        if index is None or index.nsl is not self.nsl or index.length != len(self.nsl):
+            index = self._index = NetlistIndex(self.nsl)
+        return index
+
+    def _search_index(self, query):
+        source = self._get_index_source()
+        index = source._get_index()
+        candidates = None
+        for field in NetlistIndex.FIELDS:
+            pattern = getattr(query, field)
+            if pattern:
+                found = index.candidates(field, pattern, query.regex, getattr(query, '_' + field))
+                if candidates is None:
+                    candidates = found
+                elif len(found) < len(candidates):
+                    candidates = found & candidates
+                else:
+                    candidates = candidates & found
+        positions = set()
+        for ns in candidates:
+            position = index.position(ns)
+            if position is not None:  # else no longer part of nsl
+                positions.add(position)
+        if source is not self:
+            positions.update(self._extra_positions(source))
+        nsl = PySpectreScript()
+        has_descend_str = isinstance(query.descend, str)
+        for i, j in sorted(positions):
+            if j < 0 and has_descend_str:
+                continue
+            if j >= 0 and not query.matches_section(self.nsl[i][0]._nodes[0]):
+                continue
+            ns = self._statement_at((i, j))
+            if isinstance(ns, NetlistStatement) and query.matches(ns):
+                nsl.add(ns, deep_copy=False)
+        return nsl
  
     def replace(self, old, new):
-        for ns in self.nsl:
-            ns.replace(old, new)
+        self._modify('replace', old, new)
 
     def change(self, key, value):
-        for ns in self.nsl:
-            ns.change(key, value)
+        self._modify('change', key, value)
 
     def scale(self, p_name, alpha):
-        for ns in self.nsl:
-            ns.scale(p_name, alpha)
+        evaluator = self._get_evaluator()
+        if evaluator is not None:
+            self._modify('scale', p_name, alpha, evaluator.value)
+            return
+        if self._private_sections is None:  # the columns write to the statements
+            columns = self._get_columns()
+            if columns is not None:
+                columns.scale(p_name, alpha)
+                return
+        self._modify('scale', p_name, alpha)
+
+    def clone(self):
+        """ Returns a copy of the script that shares its statements.
+
+        The shared statements keep belonging to the script they were cloned
+        from. They are copied by the first replace, change, scale, add_param
+        or del_param of either script, or of a search result of it, that
+        modifies them, and a subnetlist section is copied with its first
+        modified statement. Modifying a statement of the original directly
+        first gives the clones sharing it copies, and indexing or iterating
+        the clone copies the statements it hands out, so both scripts stay
+        editable. nsl of the clone holds the shared statements.
+        """
+        _flush_pending_columns()  # the clones share the statements with the scaled values
+        if self._family is None:
+            self._family = weakref.WeakSet([self])
+        if not self._all_frozen:
+            if self._share is None:
+                self._share = (weakref.ref(self), self._family)
+            for ns in NetlistIndex._statements(self.nsl):
+                if not ns._frozen:
+                    ns._frozen = self._share
+            self._all_frozen = True
+        source = self._get_index_source()
+        pss = PySpectreScript()
+        if source is self:
+            pss._index_source = (self, len(self._replaced), self._structure_version)
+        else:
+            pss._index_source = self._index_source
+            pss._dirty_positions = set(self._dirty_positions).union(self._replaced)
+        pss.nsl = list(self.nsl)
+        pss.command_line_args = list(self.command_line_args)
+        pss.path_to_script_in = self.path_to_script_in
+        pss.path_to_script_out = self.path_to_script_out
+        pss._use_columns = self._use_columns
+        pss._use_expressions = self._use_expressions
+        pss._incremental_write = self._incremental_write
+        pss._parameter_sweep = self._parameter_sweep
+        if 'result_cache' in self.__dict__:
+            pss.result_cache = self.result_cache
+        pss._private_sections = {}
+        pss._all_frozen = True
+        pss._family = self._family
+        pss._borrows = True
+        self._family.add(pss)
+        self._private_sections = {}
+        return pss
+
+    def _get_index_source(self):
+        """ Returns the script whose NetlistIndex is used for searches.
+
+        A clone uses the index of the script it was cloned from as long as
+        neither adds or removes statements, the statements at the positions
+        that one of them replaced since are checked in addition.
+        """
+        if self._index_source is not None:
+            source, offset, version = self._index_source
+            if source._structure_version == version and len(source.nsl) == len(self.nsl):
+                return source
+            self._index_source = None
+        return self
+
+    def _extra_positions(self, source):
+        """ Returns the positions where self and source may hold different statements. """
+        positions = set(self._dirty_positions)
+        positions.update(self._replaced)
+        positions.update(source._replaced[self._index_source[1]:])
+        return positions
+
+    def _statement_at(self, position):
+        i, j = position
+        if j < 0:
+            return self.nsl[i]
+        return self.nsl[i][j]
+
+    def _modify(self, method, *args):
+        """ Calls a NetlistStatement method on the top level statements. """
+        for i, ns in enumerate(self.nsl):
+            if isinstance(ns, NetlistStatement) and ns._frozen:
+                if not ns._modified_by(method, args):
+                    continue
+                ns = self._thaw(ns, (i, -1))
+            getattr(ns, method)(*args)
+
+    def _thaw(self, ns, position=None):
+        """ Replaces the frozen statement ns by a copy and returns the copy. """
+        new = copy.deepcopy(ns)
+        self._replace_statement(ns, new, position)
+        return new
+
+    def _replace_statement(self, old, new, position=None):
+        if position is None:
+            position = self._position(old)
+        if position is not None:
+            i, j = position
+            if j < 0:
+                self.nsl[i] = new
+            else:
+                section = self.nsl[i]
+                if self._private_sections is not None and id(section) not in self._private_sections:
+                    section = self.nsl[i] = list(section)
+                    self._private_sections[id(section)] = section
+                section[j] = new
+            self._all_frozen = False
+            if self._private_sections is not None:
+                self._replaced.append(position)
+            self._replace_in_caches(old, new)
+        if self._cow_parent is not None:
+            self._cow_parent._replace_statement(old, new)
+
+    def _replace_in_caches(self, old, new):
+        for cache in (self._index, self._columns, self._evaluator, self._hierarchy,
+                      self._write_cache, self._parameter_split):
+            if cache is not None and cache.nsl is self.nsl:
+                cache.replace(old, new)
+
+    def _position(self, ns):
+        """ Returns (index, subindex) of ns in nsl like NetlistIndex.position. """
+        if len(self.nsl) >= self.index_threshold:
+            source = self._get_index_source()
+            position = source._get_index().position(ns)
+            if source is self:
+                return position
+            if position is not None and self._statement_at(position) is ns:
+                return position
+            for position in self._extra_positions(source):
+                if self._statement_at(position) is ns:
+                    return position
+        for i, item in enumerate(self.nsl):
+            if item is ns:
+                return i, -1
+            if isinstance(item, list):
+                for j, subns in enumerate(item):
+                    if subns is ns:
+                        return i, j
+        return None
 
     def add(self, ns, index=None, deep_copy=True):
+        ns = self._statement_list(ns, deep_copy)
+        self._all_frozen = False
+        self._structure_changed()
+        if index is None:
+            self.nsl.extend(ns)
+        else: 
+            self.nsl[index:index] = ns
+        if self._index is not None and self._index.nsl is self.nsl:
+            for new_ns in NetlistIndex._statements(ns):
+                self._index.add(new_ns)
+            self._index.length = len(self.nsl)
+            self._index.invalidate_positions()
+
+    @staticmethod
+    def _statement_list(ns, deep_copy):
         if isinstance(ns, str):
             ns = [NetlistStatement.from_string(ns)]
         elif isinstance(ns, PySpectreScript):
@@ -285,39 +2439,78 @@ class PySpectreScript(object):
             ns = [ns]
         if deep_copy:
             ns = copy.deepcopy(ns)
-        if index is None:
-            self.nsl.extend(ns)
-        else: 
-            self.nsl[index:index] = ns
+        return ns
 
     def remove(self, name='', master='', node='', p_name='', p_val='', regex=False, descend=False):
-        for ns in list(self.nsl):
-            if isinstance(ns, NetlistStatement):
-                indices = []
-                if ns._ns_match(name, master, node, p_name, p_val, regex):
-                    self.nsl.remove(ns)
-            elif isinstance(ns, list) and descend:
-                for subns in list(ns):
-                    if subns._ns_match(name, master, node, p_name, p_val, regex):
-                        ns.remove(subns)
- 
+        """ Removes the matching statements, the arguments are those of search. """
+        batch = Batch(self)
+        batch.remove(name, master, node, p_name, p_val, regex, descend)
+        batch.apply()
+
+    def batch(self):
+        """ Returns a Batch of edits that are applied in one pass over nsl. """
+        return Batch(self)
+
+    def _structure_changed(self):
+        # positions of statements changed, drop the caches depending on them
+        self._columns = None
+        self._evaluator = None
+        self._hierarchy = None
+        self._write_cache = None
+        self._parameter_split = None
+        self._structure_version += 1
+        self._index_source = None
+
     def del_param(self, key):
-        for ns in self.nsl:
-            ns.del_param(key)
+        self._modify('del_param', key)
 
     def add_param(self, param_name, param_value):
-        for ns in self.nsl:
-            ns.add_param(param_name, param_value)
+        self._modify('add_param', param_name, param_value)
 
     ###############
     # Netlist I/O #
     ###############
     def read(self, path):
-        """ Parses netlist at path into a PySpectreScript object. """
+        """ Parses netlist at path into a PySpectreScript object.
+
+        If netlist_cache is set to a NetlistCache, the parsed netlist is
+        loaded from and stored in it. If read_processes is above one, large
+        netlists are parsed in parallel, see _parse_parallel.
+
+        With read_disable_gc set, the garbage collector is disabled while
+        parsing since every statement built is kept. This is process wide,
+        so it is only safe when no other thread allocates meanwhile.
+        """
         self.path_to_script_in = path
-        fin = open(path, 'r')
-        self.nsl = self._read_section(fin)
-        fin.close()
+        parse = self._parse
+        if self.read_processes > 1:
+            parse = lambda fin: self._parse_parallel(fin, self.read_processes,
+                                                     self.parallel_read_min_size)
+        gc_enabled = self.read_disable_gc and gc.isenabled()
+        if gc_enabled:
+            gc.disable()
+        try:
+            if self.netlist_cache is not None:
+                self.nsl = self.netlist_cache.get(path, parse)
+            else:
+                fin = open(path, 'r')
+                self.nsl = parse(fin)
+                fin.close()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self._index = None
+        self._columns = None
+        self._evaluator = None
+        self._hierarchy = None
+        self._write_cache = None
+        self._parameter_split = None
+        self._private_sections = None
+        self._all_frozen = False
+        self._replaced = []
+        self._structure_version += 1
+        self._index_source = None
+        self._dirty_positions = ()
 
     def write(self, path=''):
         """ Writes the netlist contents to file."""
@@ -334,13 +2527,149 @@ class PySpectreScript(object):
         dirname = os.path.dirname(self.path_to_script_out)
         if dirname and not os.path.exists(dirname):
             os.makedirs(dirname)
+        if self._parameter_sweep:
+            self._get_parameter_split().write(self.path_to_script_out)
+            return
+        if self._incremental_write:
+            self._get_write_cache().write(self.path_to_script_out)
+            return
         fout = open(self.path_to_script_out, 'w')
-        fout.write('// Generated by PySpectre\n')
+        fout.write(WriteCache.HEADER)
         self._write_section(fout, self.nsl)
         fout.close()
 
+    def resolve_includes(self, recursive=True):
+        """ Returns a PySpectreScript with the statements of the included files.
+
+        Top level include statements are resolved relative to the directory
+        of path_to_script_in and the files are parsed with read_include. The
+        statements are shared with every other script including the same
+        file and are copied by the modification methods, indexing and
+        iterating like those of a clone. If an include has a section
+        parameter, only the statements of that section are used. With
+        recursive, the includes of included files are resolved as well.
+        """
+        if self.path_to_script_in:
+            directory = os.path.dirname(os.path.abspath(self.path_to_script_in))
+        else:
+            directory = os.getcwd()
+        pss = PySpectreScript()
+        pss.nsl = self._resolve_includes(self.nsl, directory, recursive, set())
+        pss._private_sections = {}
+        pss._borrows = True
+        return pss
+
     def run(self, path_to_results='', verbose=True):
-        """ Write netlist and run. """
+        """ Write netlist and run.
+
+        If result_cache is set to a ResultCache that holds the results of
+        the netlist, they are copied to path_to_results instead.
+        """
+        self._prepare_run(path_to_results)
+        cache = self.result_cache
+        if cache is None:
+            run(self.path_to_script_out, self.path_to_results, self.command_line_args, verbose)
+            return
+        key = cache.key(self)
+        if cache.get(key, self.path_to_results):
+            return
+        if os.path.isdir(self.path_to_results):  # only keep results of this run
+            shutil.rmtree(self.path_to_results)
+        status = run(self.path_to_script_out, self.path_to_results, self.command_line_args, verbose)
+        if status == 0:
+            cache.put(key, self.path_to_results)
+
+    def run_async(self, path_to_results='', on_line=None, spectre='spectre'):
+        """ Writes the netlist and starts Spectre without waiting for it.
+
+        Returns a SimulationProcess, which streams the output of Spectre to
+        the log file next to the netlist and to on_line(line), and can be
+        waited for or cancelled.
+        """
+        self._prepare_run(path_to_results)
+        command = _spectre_command(spectre, self.path_to_script_out, self.path_to_results,
+                                   self.command_line_args)
+        process = SimulationProcess(command, self.path_to_script_out + '.log', on_line)
+        process.add_done_callback(lambda process: setattr(self, 'returncode', process.returncode))
+        return process
+
+    def sweep(self, parameters, analysis='dc', path_to_results='', verbose=True):
+        """ Runs the analyses for every combination of parameter values in one simulation.
+
+        Experimental: the names of the result files of the sweep points are
+        assumed to be those of SweepResults.POINT_PATTERN, which has not
+        been checked against every Spectre version.
+
+        parameters is an OrderedDict or a list of (name, values) pairs, the
+        keys of a plain dict are taken in sorted order. The top level
+        statements of the analysis type are put in nested Spectre sweep
+        statements, one per parameter, of a copy of the script, which is
+        written next to the netlist with a '.sweep' suffix and run once. A
+        tuple of names with a sequence of value tuples sweeps the parameters
+        together with a paramset. Returns a SweepResults, whose results are
+        arrays indexed by the positions of the values of the parameters.
+
+        Example:
+            sweep = pss.sweep([('LN', L_array), ('VDS', VDS_array)])
+            vgs, gm = sweep.results('dc.dc', 'M0:gm')  # gm[i, j] is at L_array[i], VDS_array[j]
+        """
+        if type(parameters) is dict:
+            parameters = [(name, parameters[name]) for name in sorted(parameters)]
+        elif isinstance(parameters, dict):  # ordered mappings keep their order
+            parameters = parameters.items()
+        names = [name for name, values in parameters]
+        values = [list(values) for name, values in parameters]
+        job = self.clone()
+        defined = set()
+        for ns in job.nsl:
+            if isinstance(ns, NetlistStatement) and ns.name == 'parameters':
+                defined.update(ns._parameters)
+        for name, points in zip(names, values):
+            for p_name in (name if isinstance(name, tuple) else (name,)):
+                if p_name not in defined:
+                    raise ValueError('%s is not a top level parameter' % p_name)
+            if not points:
+                raise ValueError('no values to sweep %s over' % (name,))
+        positions = [i for i, ns in enumerate(job.nsl)
+                     if isinstance(ns, NetlistStatement) and len(ns._nodes) == 1
+                     and ns._nodes[0] == analysis]
+        if not positions:
+            raise ValueError('no %s analysis to sweep' % analysis)
+        statements = [job.nsl[i] for i in positions]
+        for name, points in reversed(zip(names, values)):
+            statements = self._sweep_statements(name, points, statements)
+        swept = set(positions)
+        nsl = [ns for i, ns in enumerate(job.nsl) if i not in swept]
+        nsl[positions[0]:positions[0]] = statements
+        job.nsl = nsl
+        job._structure_changed()
+        # next to the netlist, so that relative includes resolve, like write
+        path = self.path_to_script_out or self.path_to_script_in or 'netlist.scs'
+        head, tail = os.path.split(path)
+        stem = tail.split('.')[0] or 'netlist'
+        job.path_to_script_out = os.path.join(head, stem + '.sweep.scs')
+        job.run(path_to_results or os.path.join(head, 'psf', stem + '.sweep'), verbose)
+        return SweepResults(job, names, values)
+
+    @staticmethod
+    def _sweep_statements(name, points, statements):
+        """ Returns the statements sweeping name over points around statements. """
+        if not isinstance(name, tuple):
+            values = '[%s]' % ' '.join(str(point) for point in points)
+            return [NetlistStatement(SweepResults.sweep_name(name), ['sweep'],
+                                     {'param': name, 'values': values}, statements)]
+        # the rows of a paramset are rendered as statements of their values
+        paramset = SweepResults.sweep_name(name) + '_values'
+        rows = [NetlistStatement(name[0], list(name[1:]))]
+        for point in points:
+            if len(point) != len(name):
+                raise ValueError('%r has not one value for each of %s' % (point, name))
+            rows.append(NetlistStatement(str(point[0]), [str(value) for value in point[1:]]))
+        return [NetlistStatement(paramset, ['paramset'], None, rows),
+                NetlistStatement(SweepResults.sweep_name(name), ['sweep'],
+                                 {'paramset': paramset}, statements)]
+
+    def _prepare_run(self, path_to_results):
         self.write(self.path_to_script_out)
         self.psf_results = {}
         if path_to_results:
@@ -349,9 +2678,14 @@ class PySpectreScript(object):
             head, tail = os.path.split(self.path_to_script_out)
             tail = tail.split('.')[0]
             self.path_to_results = os.path.join(head, 'psf', tail)
-        run(self.path_to_script_out, self.path_to_results, self.command_line_args, verbose)
 
-    def results(self, fname='', result=''):
+    def results(self, fname='', result='', start=None, stop=None, max_points=None, method='minmax'):
+        """ Lists result files, the results in a file or returns a result.
+
+        For swept results start and stop limit the returned values to sweep
+        parameter values in [start, stop], and max_points decimates them while
+        reading with method 'minmax' or 'lttb'.
+        """
         if not fname:
             return tuple(os.listdir(self.path_to_results))
         else:
@@ -364,12 +2698,28 @@ class PySpectreScript(object):
             if not result:
                 return self.psf_results[fname].getValueNames()
             else:
-                y = self.psf_results[fname].getValuesByName(result)
-                if self.psf_results[fname].sweeps:
-                    x = self.psf_results[fname].getSweepParamValues()
+                if self.psf_results[fname].sweeps and max_points:
+                    return self.psf_results[fname].getValuesByName(result, start=start, stop=stop,
+                                                                   max_points=max_points, method=method)
+                elif self.psf_results[fname].sweeps:
+                    y = self.psf_results[fname].getValuesByName(result, start=start, stop=stop)
+                    x = self.psf_results[fname].getSweepParamValues(start=start, stop=stop)
                     return x, y
                 else:
-                    return y
+                    return self.psf_results[fname].getValuesByName(result)
+
+    def results_async(self, fname='', result='', start=None, stop=None, max_points=None,
+                      method='minmax'):
+        """ Returns a ResultsRequest of results, which is decoded by a pool of threads.
+
+        The results of one script are decoded one at a time, those of
+        different scripts concurrently.
+        """
+        return ResultsRequest(self, (fname, result, start, stop, max_points, method))
+
+    def _locked_results(self, *args):
+        with self._results_lock:
+            return self.results(*args)
      
     ###################
     # Private Methods #
@@ -387,136 +2737,927 @@ class PySpectreScript(object):
         return len(self.nsl)
 
     def __iter__(self):
-        return iter(self.nsl)
+        if not self._root()._borrows:
+            return iter(self.nsl)
+        return (self._own(i) for i in xrange(len(self.nsl)))
 
     def __getitem__(self, index):
-        return self.nsl[index]
+        if not self._root()._borrows:
+            return self.nsl[index]
+        if isinstance(index, slice):
+            return [self._own(i) for i in xrange(*index.indices(len(self.nsl)))]
+        if index < 0:
+            index += len(self.nsl)
+        if not 0 <= index < len(self.nsl):
+            raise IndexError('PySpectreScript index out of range')
+        return self._own(index)
+
+    def _root(self):
+        """ Returns the script a search result was found in. """
+        pss = self
+        while pss._cow_parent is not None:
+            pss = pss._cow_parent
+        return pss
+
+    def _own(self, i):
+        """ Returns item i of nsl with the statements borrowed from other scripts copied. """
+        root = self._root()
+        item = self.nsl[i]
+        if isinstance(item, NetlistStatement):
+            if item._borrowed_by(root):
+                item = self._thaw(item, (i, -1))
+        elif isinstance(item, list):
+            for j, ns in enumerate(item):
+                if isinstance(ns, NetlistStatement) and ns._borrowed_by(root):
+                    self._thaw(ns, (i, j))
+            item = self.nsl[i]
+        return item
 
     @staticmethod
     def _write_section(fout, nsl):
         """Writes netlist and subnetlists to file recursively."""
+        fout.writelines(PySpectreScript._section_lines(nsl))
+
+    @staticmethod
+    def _section_lines(nsl):
+        """Yields the lines of a netlist and its subnetlists."""
         for ns in nsl:
             if isinstance(ns, list):  # found a subnetlist
-                fout.write('\n')
+                yield '\n'
                 # recurse to write the subnetlist
-                PySpectreScript._write_section(fout, ns)
-                fout.write('\n')
-            elif ns.subnetlist:
-                fout.write(str(ns) + ' {\n')
-                PySpectreScript._write_section(fout, ns.subnetlist)
-                fout.write('}\n')
+                for line in PySpectreScript._section_lines(ns):
+                    yield line
+                yield '\n'
+            elif ns._subnetlist:
+                yield str(ns) + ' {\n'
+                for line in PySpectreScript._section_lines(ns._subnetlist):
+                    yield line
+                yield '}\n'
             else: 
-                fout.write(str(ns) + '\n')
+                yield str(ns) + '\n'
 
     @staticmethod
-    def _strip_conts(line, had_backslash):
-        if PySpectreScript._has_backslash_continuation(line):
-            line = line[:-1]
-        if PySpectreScript._has_plus_cont(line, had_backslash):
-            line = line[1:]
-        return line
+    def _iter_lines(fin, block_size):
+        """ Yields the lines of fin without line breaks, reading it in blocks of block_size. """
+        rest = ''
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
 
     @staticmethod
-    def _has_backslash_continuation(stripped_line):
-        if stripped_line:
-            return stripped_line[-1] == '\\'
-        else:
-            return False
+    def _parse(fin, block_size=None):
+        """ Parses the netlist in the file object fin into a netlist statement list.
+
+        fin is read in blocks of block_size (read_block_size by default) in
+        a single pass and the subckt, section and curly brace subnetlists are
+        tracked on a stack instead of by recursion.
+        """
+        from_string = NetlistStatement.from_string
+        nsl = []
+        stack = []  # (parent nsl, statement owning a curly brace subnetlist or None)
+        ns_line = ''
+        had_backslash = False
+        for line in PySpectreScript._iter_lines(fin, block_size or PySpectreScript.read_block_size):
+            i = line.find('//')
+            if i >= 0:
+                line = line[:i]
+            line = line.strip()
+            if '(' in line or ')' in line:
+                # remove parentheses before the first '='
+                i = line.find('=')
+                if i < 0:
+                    line = line.replace('(', '').replace(')', '')
+                else:
+                    line = line[:i].replace('(', '').replace(')', '') + line[i:]
+            backslash = line[-1:] == '\\'
+            if had_backslash:
+                ns_line += line[:-1] if backslash else line
+                had_backslash = backslash
+                continue
+            if line[:1] == '+':
+                ns_line += line[1:-1] if backslash else line[1:]
+                had_backslash = backslash
+                continue
+            # start of a new statement
+            if ns_line:
+                nsl.append(from_string(ns_line))
+                ns_line = ''
+            had_backslash = backslash
+            segment = line[:-1] if backslash else line
+            if not segment:
+                continue
+            segment_name = segment.split(None, 1)[0]
+            if segment_name == 'subckt' or segment_name == 'section':
+                stack.append((nsl, None))
+                nsl = []
+                ns_line = segment
+                continue
+            if segment_name == 'ends' or segment_name == 'endsection':
+                nsl.append(from_string(segment))
+            elif segment[-1] == '{':
+                stack.append((nsl, from_string(segment[:-1].strip())))
+                nsl = []
+                had_backslash = False
+                continue
+            elif segment[-1] != '}':
+                ns_line = segment
+                continue
+            # end of subnetlist
+            if not stack:
+                return nsl
+            parent, ns = stack.pop()
+            if ns is None:
+                parent.append(nsl)
+            else:
+                ns.subnetlist = nsl
+                parent.append(ns)
+            nsl = parent
+            had_backslash = False
+        # end of file, parse last netlist statement and close open subnetlists
+        if ns_line:
+            nsl.append(from_string(ns_line))
+        while stack:
+            parent, ns = stack.pop()
+            if ns is None:
+                parent.append(nsl)
+            else:
+                ns.subnetlist = nsl
+                parent.append(ns)
+            nsl = parent
+        return nsl
+
+    # keywords that can open or close a subnetlist at the start of a line
+    _SCAN_PATTERN = re.compile(r'(?:^|\n)[ \t\r\f\v]*(?:s(?:ubckt|ection)|ends)')
 
     @staticmethod
-    def _has_plus_cont(stripped_line, had_backslash):
-        # the first character can be a '+' if the line is continuing
-        if stripped_line:
-            return (stripped_line[0] == '+') and (not had_backslash)
-        else:
-            return False
+    def _scan_line(line):
+        """ Returns the line without comment as _parse sees it and whether it continues. """
+        i = line.find('//')
+        if i >= 0:
+            line = line[:i]
+        line = line.strip()
+        if '(' in line or ')' in line:
+            i = line.find('=')
+            if i < 0:
+                line = line.replace('(', '').replace(')', '')
+            else:
+                line = line[:i].replace('(', '').replace(')', '') + line[i:]
+        return line, line[-1:] == '\\'
+
+    @staticmethod
+    def _split_points(data, n):
+        """ Returns up to n + 1 offsets splitting data into netlist parts.
+
+        Every part starts with a top level statement, so parsing the parts
+        with _parse and concatenating the results gives the nsl of data.
+        The depth of the subnetlists is tracked only on the lines matching
+        _SCAN_PATTERN or holding a curly brace or backslash, the other
+        lines can not change it.
+        """
+        scan_line = PySpectreScript._scan_line
+        event_ends = []  # line ends where the depth changed
+        event_depths = []
+        depth = 0
+        had_backslash = False
+        stop = len(data)
+        previous_end = -2
+        line_start = -1
+        positions = [match.end() - 1 for match in PySpectreScript._SCAN_PATTERN.finditer(data)]
+        for char in '{}\\':
+            i = data.find(char)
+            while i >= 0:
+                positions.append(i)
+                i = data.find(char, i + 1)
+        positions.sort()
+        for position in positions:
+            start = data.rfind('\n', 0, position) + 1
+            if start == line_start:
+                continue
+            line_start = start
+            end = data.find('\n', start)
+            if end < 0:
+                end = len(data)
+            if start != previous_end + 1:
+                had_backslash = False  # a plain line in between
+            previous_end = end
+            segment, backslash = scan_line(data[start:end])
+            if had_backslash or segment[:1] == '+':
+                had_backslash = backslash
+                continue
+            had_backslash = backslash
+            if backslash:
+                segment = segment[:-1]
+            if not segment:
+                continue
+            segment_name = segment.split(None, 1)[0]
+            if segment_name == 'subckt' or segment_name == 'section' or \
+                    (segment[-1] == '{' and segment_name != 'ends' and segment_name != 'endsection'):
+                if segment[-1] == '{':
+                    had_backslash = False
+                depth += 1
+            elif segment_name == 'ends' or segment_name == 'endsection' or segment[-1] == '}':
+                if depth == 0:  # _parse stops here
+                    stop = min(end + 1, len(data))
+                    break
+                depth -= 1
+                had_backslash = False
+            else:
+                continue
+            event_ends.append(end)
+            event_depths.append(depth)
+        points = [0]
+        for k in xrange(1, n):
+            x = data.find('\n', max(stop * k // n, points[-1] + 1) - 1) + 1
+            while 0 < x < stop:
+                i = bisect.bisect_left(event_ends, x) - 1
+                if i >= 0 and event_depths[i] != 0:
+                    # skip to the end of the subnetlist
+                    j = i + 1
+                    while j < len(event_depths) and event_depths[j] != 0:
+                        j += 1
+                    x = event_ends[j] + 1 if j < len(event_ends) else stop
+                    continue
+                end = data.find('\n', x)
+                if end < 0:
+                    end = stop
+                segment = scan_line(data[x:end])[0]
+                previous = scan_line(data[data.rfind('\n', 0, x - 1) + 1:x - 1])
+                if segment[:1] != '+' and not previous[1]:
+                    break
+                x = end + 1
+            if x <= 0 or x >= stop:
+                break
+            points.append(x)
+        points.append(stop)
+        return points
+
+    @staticmethod
+    def _parse_parallel(fin, processes, min_size=0, block_size=None):
+        """ Parses the netlist in fin like _parse with a pool of processes.
+
+        The netlist is split at top level statements by _split_points into
+        a few parts per process, the parts are parsed by the processes and
+        the results are concatenated in order. Netlists smaller than
+        min_size are parsed by _parse.
+        """
+        size = os.fstat(fin.fileno()).st_size
+        if processes <= 1 or size == 0 or size < min_size:
+            return PySpectreScript._parse(fin, block_size)
+        data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            points = PySpectreScript._split_points(data, 4 * processes)
+        finally:
+            data.close()
+        block_size = block_size or PySpectreScript.read_block_size
+        parts = [(fin.name, start, end, block_size) for start, end in zip(points[:-1], points[1:])]
+        pool = multiprocessing.Pool(min(processes, len(parts)))
+        try:
+            nsl = []
+            for packed in pool.imap(_parse_part, parts):
+                nsl.extend(NetlistCache.unpack(marshal.loads(packed)))
+        finally:
+            pool.close()
+            pool.join()
+        return nsl
 
     @staticmethod
-    def _read_section(fin, ns_line=''):
-        nsl = [] 
-        had_backslash = PySpectreScript._has_backslash_continuation(ns_line)
-        if had_backslash:
-            ns_line = PySpectreScript._strip_conts(ns_line, had_backslash)
+    def _parse_spice(fin):
+        """ Parses a SPICE netlist or model file such as the PTM model files.
+
+        Comment lines start with '*', continuation lines with '+' and may
+        follow blank lines. The leading '.' of control statements is
+        dropped, so '.model nmos nmos level=54' has the name 'model'. The
+        statements from '.lib name' to '.endl' form a section list like
+        the Spectre 'section name' to 'endsection'.
+        """
+        nsl = []
+        stack = [nsl]  # the statement lists of the open .lib sections
+
+        def append(line):
+            ns = NetlistStatement.from_string(line)
+            if ns.name == 'lib' and len(ns._nodes) == 1:
+                section = [ns]
+                stack[-1].append(section)
+                stack.append(section)
+            elif ns.name == 'endl' and len(stack) > 1:
+                stack.pop().append(ns)
+            else:
+                stack[-1].append(ns)
+
+        ns_line = ''
         for line in fin:
-            stripped_line = line.split('//')[0].strip() # remove and discard commments
-            split_line = stripped_line.split('=', 1)
-            split_line[0] = re.sub(r'[()]', '', split_line[0]) # remove parentheses
-            stripped_line = '='.join(split_line)
-            ns_segment = PySpectreScript._strip_conts(stripped_line, had_backslash)
-            if PySpectreScript._has_plus_cont(stripped_line, had_backslash) or had_backslash:
-                ns_line += ns_segment
-            else:  # start of a new statement
-                if ns_line:  # if not empty
-                    ns = NetlistStatement.from_string(ns_line)
-                    nsl.append(ns)
-                if ns_segment:
-                    segment_name = ns_segment.split()[0]
-                    if segment_name in ['subckt', 'section']:
-                        # found start of subnetlist, step into recursion
-                        sub_statements = PySpectreScript._read_section(fin, stripped_line)
-                        nsl.append(sub_statements)
-                    elif segment_name in ['ends', 'endsection']:
-                        # found end of subnetlist
-                        ns = NetlistStatement.from_string(ns_segment)
-                        nsl.append(ns)
-                        # step out of recursion
-                        return nsl
-                    elif ns_segment[-1] == '{':
-                        ns = NetlistStatement.from_string(ns_segment[:-1].strip())
-                        sub_statements = PySpectreScript._read_section(fin)
-                        ns.subnetlist = sub_statements
-                        nsl.append(ns)
-                    elif ns_segment[-1] == '}':
-                        return nsl
-                    else:
-                        # netlist statement saved, overwrite now
-                        ns_line = ns_segment
-                else:  # empty line and no line continuations
-                    ns_line = ''
-            # check for backslash continuation and save for operations on next line
-            had_backslash = PySpectreScript._has_backslash_continuation(stripped_line)
-        # end of file, parse last netlist statement
-        if ns_line:  # if not empty
-            ns = NetlistStatement.from_string(ns_line)
-            nsl.append(ns)
+            line = line.split('$')[0].strip()
+            if not line or line[0] == '*':
+                continue
+            if '(' in line or ')' in line:
+                i = line.find('=')
+                if i < 0:
+                    line = line.replace('(', '').replace(')', '')
+                else:
+                    line = line[:i].replace('(', '').replace(')', '') + line[i:]
+            if line[0] == '+':
+                ns_line += ' ' + line[1:]
+                continue
+            if ns_line:
+                append(ns_line)
+            ns_line = line[1:] if line[0] == '.' else line
+        if ns_line:
+            append(ns_line)
         return nsl
 
+    @staticmethod
+    def _include_target(ns):
+        """ Returns (path, section) of an include statement or None. """
+        if not isinstance(ns, NetlistStatement) or not ns._nodes:
+            return None
+        if ns.name == 'include' or ns.name == 'inc':
+            return ns._nodes[0].strip('"\''), ns._parameters.get('section')
+        if ns.name == 'lib' and len(ns._nodes) == 2:  # SPICE .lib file section
+            return ns._nodes[0].strip('"\''), ns._nodes[1]
+        return None
+
+    @staticmethod
+    def _resolve_includes(nsl, directory, recursive, visited):
+        resolved = []
+        for ns in nsl:
+            target = PySpectreScript._include_target(ns)
+            if target is None:
+                resolved.append(ns)
+                continue
+            path = os.path.normpath(os.path.join(directory, os.path.expanduser(target[0])))
+            if (path, target[1]) in visited:  # include cycle
+                continue
+            included = read_include(path)
+            if target[1] is not None:
+                included = PySpectreScript._section_statements(included, target[1])
+            if recursive:
+                visited.add((path, target[1]))
+                included = PySpectreScript._resolve_includes(
+                    included, os.path.dirname(path), recursive, visited)
+                visited.discard((path, target[1]))
+            resolved.extend(included)
+        return resolved
+
+    @staticmethod
+    def _section_statements(nsl, section):
+        """ Returns the statements between 'section name' and 'endsection name'.
+
+        The statements between '.lib name' and '.endl' of SPICE files are
+        returned the same way.
+        """
+        for ns in nsl:
+            if isinstance(ns, list) and ns and ns[0].name in ('section', 'lib') and \
+                    ns[0]._nodes and ns[0]._nodes[0] == section:
+                if ns[-1].name in ('endsection', 'endl'):
+                    return ns[1:-1]
+                return ns[1:]
+        raise ValueError('section %s not found' % section)
+
+
+class SimulationProcess(object):
+    """ A Spectre process started by PySpectreScript.run_async.
+
+    The process runs in a process group of its own, so that cancel stops
+    Spectre and any process it started. A thread appends the output of the
+    process to log_path and passes every line to on_line, if given. The
+    done callbacks are called with the SimulationProcess from that thread
+    once the process exited, before wait returns, so they must not wait for
+    the process themselves.
+    """
+    def __init__(self, command, log_path, on_line=None, kill_timeout=5.0):
+        self.command = command
+        self.log_path = log_path
+        self.kill_timeout = kill_timeout
+        self.returncode = None
+        self.cancelled = False
+        self._on_line = on_line
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         close_fds=True, preexec_fn=os.setsid)
+        self.pid = self._process.pid
+        self._thread = threading.Thread(target=self._follow)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _follow(self):
+        try:
+            with open(self.log_path, 'a') as log:
+                for line in iter(self._process.stdout.readline, ''):
+                    log.write(line)
+                    log.flush()
+                    if self._on_line is not None:
+                        self._on_line(line)
+        finally:
+            self._process.stdout.close()
+            self.returncode = self._process.wait()
+            try:
+                while True:
+                    with self._lock:
+                        callbacks, self._callbacks = self._callbacks, []
+                        if not callbacks:
+                            self._done.set()
+                            break
+                    for callback in callbacks:
+                        callback(self)
+            finally:
+                self._done.set()
+
+    def add_done_callback(self, callback):
+        """ Calls callback(self) when the process exited, right away if it already did. """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits for the process and returns its exit status, None on timeout. """
+        self._done.wait(timeout)
+        return self.returncode
+
+    def cancel(self):
+        """ Stops the process group with SIGTERM, or SIGKILL after kill_timeout seconds. """
+        if self.done():
+            return False
+        self.cancelled = True
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+            if not self._done.wait(self.kill_timeout):
+                os.killpg(self.pid, signal.SIGKILL)
+        except OSError:  # already exited
+            pass
+        self._done.wait()
+        return True
+
+
+class ResultsRequest(object):
+    """ Results of a script being decoded for PySpectreScript.results_async.
+
+    wait returns the results once they are decoded and raises the error of
+    the decoding if it failed. cancel drops a request that did not start
+    decoding yet.
+    """
+    def __init__(self, pss, args):
+        self.cancelled = False
+        self._value = None
+        self._exc_info = None
+        self._started = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        _results_pool().apply_async(self._decode, (pss, args))
+
+    def _decode(self, pss, args):
+        with self._lock:
+            if self.cancelled:
+                return
+            self._started = True
+        try:
+            self._value = pss._locked_results(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits for the results and returns them, None on timeout or if cancelled. """
+        self._done.wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def cancel(self):
+        """ Drops the request unless its decoding started, returns True if it was dropped. """
+        with self._lock:
+            if self._started or self.cancelled:
+                return False
+            self.cancelled = True
+        self._done.set()
+        return True
+
+
+class SimulationRunner(object):
+    """ Runs Spectre on many scripts concurrently.
+
+    submit writes the netlist of a script to a file of its own and starts
+    a Spectre process on it in the background, with results in a psf
+    directory of its own, so the scripts of one sweep do not overwrite each
+    other's netlists and results. At most processes simulations run at a
+    time. submit returns an AsyncResult whose get() returns the submitted
+    script, with path_to_results set to its results and returncode to
+    the exit status of Spectre. Unless keep_netlists is set, the netlist
+    and log of a job are removed once Spectre succeeded.
+
+    Example:
+        runner = SimulationRunner(8)
+        jobs = []
+        for L in L_array:
+            pss.search('parameters').change('LN', L)
+            jobs.append(runner.submit(pss))
+        for job in runner.as_completed(jobs):
+            vgs, data = job.get().results('dc.dc', 'M0:gm')
+        runner.close()
+    """
+    def __init__(self, processes=None, directory='', verbose=False, spectre='spectre',
+                 keep_netlists=False):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.directory = directory
+        self.verbose = verbose
+        self.spectre = spectre
+        self.keep_netlists = keep_netlists
+        self._pool = ThreadPool(self.processes)
+        self._jobs = 0
+        self._lock = threading.Lock()
+        self._finished = threading.Condition()
+        self._events = weakref.WeakKeyDictionary()  # AsyncResult -> set when its job ended
+
+    def submit(self, pss, path_to_results=''):
+        """ Starts simulating pss, returns an AsyncResult of the simulated script.
+
+        The netlist is written before submit returns, so pss can be modified
+        for the next job right away. It is written to directory, by default
+        that of the netlist of pss, so that relative includes still resolve.
+        """
+        with self._lock:
+            self._jobs += 1
+            job_id = self._jobs
+        job = pss.clone()
+        job.command_line_args = list(pss.command_line_args)
+        path = pss.path_to_script_out or pss.path_to_script_in or 'netlist.scs'
+        head, tail = os.path.split(path)
+        stem = tail.split('.')[0] or 'netlist'
+        directory = self.directory or head
+        job.write(os.path.join(directory, '%s.job%d.scs' % (stem, job_id)))
+        job.path_to_results = path_to_results or os.path.join(directory, 'psf', '%s.job%d' % (stem, job_id))
+        key = job.result_cache.key(job) if job.result_cache is not None else None
+        finished = threading.Event()
+        result = self._pool.apply_async(self._run_job, (job, key, finished))
+        self._events[result] = finished
+        return result
+
+    def map(self, scripts):
+        """ Simulates the scripts and returns the simulated scripts in the same order. """
+        return [job.get() for job in [self.submit(pss) for pss in scripts]]
+
+    def as_completed(self, jobs):
+        """ Yields the AsyncResults of jobs as they finish.
+
+        A job is yielded as soon as its simulation ended, its get() may wait
+        a moment for the pool to store the result.
+        """
+        pending = list(jobs)
+        while pending:
+            with self._finished:
+                done = [job for job in pending if self._ended(job)]
+                if not done:
+                    self._finished.wait(1.0)  # polls AsyncResults of other pools
+            for job in done:
+                pending.remove(job)
+                yield job
+
+    def _ended(self, job):
+        finished = self._events.get(job)
+        return job.ready() or (finished is not None and finished.is_set())
+
+    def _run_job(self, job, key, finished):
+        # the pool calls callbacks before the result is ready, so the end is signalled here
+        try:
+            self._run(job, key)
+            if job.returncode == 0 and not self.keep_netlists:
+                for path in (job.path_to_script_out, job.path_to_script_out + '.log'):
+                    if os.path.exists(path):
+                        os.remove(path)
+            return job
+        finally:
+            with self._finished:
+                finished.set()
+                self._finished.notify_all()
+
+    def _run(self, job, key=None):
+        job.psf_results = {}
+        cache = job.result_cache
+        if cache is not None:
+            if cache.get(key, job.path_to_results):
+                job.returncode = 0
+                return job
+            if os.path.isdir(job.path_to_results):
+                shutil.rmtree(job.path_to_results)
+        command = _spectre_command(self.spectre, job.path_to_script_out, job.path_to_results,
+                                   job.command_line_args)
+        if self.verbose:
+            job.returncode = subprocess.call(command)
+        else:
+            with open(job.path_to_script_out + '.log', 'a') as log:
+                job.returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        if cache is not None and job.returncode == 0:
+            cache.put(key, job.path_to_results)
+        return job
+
+    def close(self):
+        """ Waits for the submitted simulations and stops the threads running them. """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class SweepResults(object):
+    """ Results of PySpectreScript.sweep.
+
+    names are the swept parameters, values their values and shape the
+    number of values of each. Spectre writes the results of every
+    combination of values to files of their own, results reads them and
+    returns arrays indexed by the positions of the values, followed by
+    the axes of the result at one point.
+
+    Experimental: the result files of a point are expected to be named
+    'sweep_<name>-<position>_' for every swept parameter, outermost first,
+    followed by the name of the analysis file, for example
+    sweep_LN-001_sweep_VDS-000_dc.dc. POINT_PATTERN is the regular
+    expression of one parameter, adjust it if Spectre names them otherwise.
+    """
+    POINT_PATTERN = r'%s-(\d+)_'
+
+    def __init__(self, pss, names, values):
+        self.pss = pss
+        self.names = tuple(names)
+        self.values = tuple(values)
+        self.shape = tuple(len(points) for points in values)
+        self._files = None
+
+    @staticmethod
+    def sweep_name(name):
+        """ Returns the name of the sweep statement of a parameter or a tuple of parameters. """
+        if isinstance(name, tuple):
+            name = '_'.join(name)
+        return 'sweep_' + name
+
+    def _get_files(self):
+        """ Returns {fname: {index: point fname}} of the result files. """
+        if self._files is None:
+            pattern = re.compile(''.join(self.POINT_PATTERN % re.escape(self.sweep_name(name))
+                                         for name in self.names) + '(.+)$')
+            self._files = {}
+            for point_fname in self.pss.results():
+                match = pattern.match(point_fname)
+                if match:
+                    index = tuple(int(i) for i in match.groups()[:-1])
+                    self._files.setdefault(match.group(match.lastindex), {})[index] = point_fname
+        return self._files
+
+    def fname(self, fname, index):
+        """ Returns the file of the results of fname at the values with positions index. """
+        try:
+            return self._get_files()[fname][tuple(index)]
+        except KeyError:
+            raise ValueError('no results %s at %s' % (fname, tuple(index)))
+
+    def results(self, fname='', result=''):
+        """ Lists result files, the results in a file or returns a result.
+
+        For results of swept analyses, like dc.dc, returns the sweep values
+        at the first point and the array of the result.
+        """
+        import numpy
+        if not fname:
+            return tuple(sorted(self._get_files()))
+        if not result:
+            return self.pss.results(self.fname(fname, (0,) * len(self.shape)))
+        x = None
+        data = []
+        for index in numpy.ndindex(*self.shape):
+            value = self.pss.results(self.fname(fname, index), result)
+            if isinstance(value, tuple):
+                if x is None:
+                    x = value[0]
+                value = value[1]
+            data.append(value)
+        data = numpy.array(data)
+        data = data.reshape(self.shape + data.shape[1:])
+        if x is None:
+            return data
+        return x, data
+
+def _spectre_command(spectre, path, path_to_results, command_line_args):
+    """ Returns the arguments of a Spectre process like those run passes to the shell. """
+    command = [spectre, path, '-raw', path_to_results]
+    for args in command_line_args:
+        command.extend(args.split())
+    return command
+
+_results_pool_instance = None
+_results_pool_lock = threading.Lock()
+
+def _results_pool():
+    """ Returns the ThreadPool decoding results for PySpectreScript.results_async. """
+    global _results_pool_instance
+    with _results_pool_lock:
+        if _results_pool_instance is None:
+            _results_pool_instance = ThreadPool(multiprocessing.cpu_count())
+            atexit.register(_close_results_pool)
+        return _results_pool_instance
+
+def _close_results_pool():
+    """ Stops the threads of the results pool, the requests that did not start are dropped. """
+    global _results_pool_instance
+    with _results_pool_lock:
+        pool, _results_pool_instance = _results_pool_instance, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
 def run(path, path_to_results=None, command_line_args=None, verbose=True):
     command_str = 'spectre %s ' % path
     if path_to_results:
-        command_str += '-raw %s' % path_to_results
+        command_str += '-raw %s ' % path_to_results
     for command in command_line_args:
         command_str += command + ' '
     if not verbose:
         command_str += ' >> ' + path + '.log'
-    os.system(command_str)
+    return os.system(command_str)
+
+def _parse_part(part):
+    """ Parses a part of a netlist file for PySpectreScript._parse_parallel. """
+    path, start, end, block_size = part
+    with open(path, 'r') as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    nsl = PySpectreScript._parse(io.BytesIO(data), block_size)
+    return marshal.dumps(NetlistCache.pack(nsl))
+
+_include_cache = {}
+_include_cache_lock = threading.Lock()
+
+def read_include(path):
+    """ Returns the parsed statements of an included netlist or model file.
+
+    Every file is parsed once per process and shared by all callers, keyed
+    by absolute path, size and mtime. The statements are frozen like those
+    of PySpectreScript.clone, the modification methods of a script copy
+    them.
+    Files ending in .scs or starting with a '//' comment or a 'simulator
+    lang=spectre' statement are parsed as Spectre, other files as SPICE.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _include_cache_lock:
+        nsl = _include_cache.get(key)
+    if nsl is not None:
+        return nsl
+    with open(path, 'r') as fin:
+        if _is_spectre_file(path, fin):
+            nsl = PySpectreScript._parse(fin)
+        else:
+            nsl = PySpectreScript._parse_spice(fin)
+    for ns in NetlistIndex._statements(nsl):
+        ns._frozen = True
+    with _include_cache_lock:
+        for old_key in [k for k in _include_cache if k[0] == path and k != key]:
+            del _include_cache[old_key]
+        nsl = _include_cache.setdefault(key, nsl)
+    return nsl
+
+def _is_spectre_file(path, fin):
+    if path.endswith('.scs'):
+        return True
+    for line in fin:
+        line = line.strip()
+        if line:
+            break
+    else:
+        line = ''
+    fin.seek(0)
+    return line.startswith('//') or line.replace(' ', '').startswith('simulatorlang=spectre')
+
+def _interned(string):
+    """ Returns the interned copy of a str, other values unchanged. """
+    if type(string) is str:
+        return intern(string)
+    return string
+
+def _interned_tuple(strings):
+    """ Returns a tuple of the interned strings. """
+    try:
+        return tuple(map(intern, strings))
+    except TypeError:  # not str
+        return tuple(map(_interned, strings))
+
+_SCALE_FACTOR_DICT = {'P':1e15, 'T':1e12, 'G':1e9, 'M':1e6, 'K':1e3, 'k':1e3,
+                      '_':1, '%':1e-2, 'c':1e-2, 'm':1e-3, 'u':1e-6, 'n':1e-9,
+                      'p':1e-12, 'f':1e-15, 'a':1e-18, 'z':1e-21, 'y':1e-24}
+_NUMBER = re.compile(r'([-\+\d.]+)(.?)') # PTGMKk_%cmunpfazyeE
+_string_to_float_cache = {}
+_STRING_TO_FLOAT_CACHE_SIZE = 1 << 16
 
 def string_to_float(string):
     """ Can be used to convert a spectre string number to float.
 
+    Strings that are not a number, maybe an expression, are returned
+    unchanged. Results are memoized, netlists repeat the same values.
+
     string_to_float(string) """
-    _SCALE_FACTOR_DICT = {'P':1e15, 'T':1e12, 'G':1e9, 'M':1e6, 'K':1e3, 'k':1e3,
-                          '_':1, '%':1e-2, 'c':1e-2, 'm':1e-3, 'u':1e-6, 'n':1e-9,
-                          'p':1e-12, 'f':1e-15, 'a':1e-18, 'z':1e-21, 'y':1e-24}
     if (type(string) == float) or (type(string) == int): # already a float
         return float(string)
-    else:
-        match = re.search(r'(^[-\+\d.]+)(.?)', string) # PTGMKk_%cmunpfazyeE
-        if match:
-            base = float(match.group(1))
-            scale_factor = match.group(2)
-            if scale_factor:
-                if scale_factor.lower() == 'e': # check for exponential notation
-                    try:
-                        return float(string)
-                    except ValueError:
-                        return string
-                elif scale_factor in _SCALE_FACTOR_DICT:
-                    return base * _SCALE_FACTOR_DICT[scale_factor] 
-                else: # not a number, maybe a expression?
+    if type(string) is str:
+        try:
+            return _string_to_float_cache[string]
+        except KeyError:
+            pass
+        value = _string_to_float(string)
+        if len(_string_to_float_cache) >= _STRING_TO_FLOAT_CACHE_SIZE:
+            _string_to_float_cache.clear()
+        _string_to_float_cache[string] = value
+        return value
+    return _string_to_float(string)
+
+def _string_to_float(string):
+    match = _NUMBER.match(string)
+    if match:
+        base = float(match.group(1))
+        scale_factor = match.group(2)
+        if scale_factor:
+            if scale_factor.lower() == 'e': # check for exponential notation
+                try:
+                    return float(string)
+                except ValueError:
                     return string
-            else:  # no scale factor
-                return base
-        else:
-            return string
+            elif scale_factor in _SCALE_FACTOR_DICT:
+                return base * _SCALE_FACTOR_DICT[scale_factor] 
+            else: # not a number, maybe a expression?
+                return string
+        else:  # no scale factor
+            return base
+    else:
+        return string
+
+def string_to_float_array(seq):
+    """ Converts a sequence of spectre numbers to a numpy float array.
+
+    The strings are split into number and scale factor with numpy on
+    their bytes, the numbers are converted by numpy and multiplied by
+    the looked up scale factors. Values the fast path does not accept,
+    like units or expressions, fall back to the memoized string_to_float.
+    Values that are not a number, and None, are NaN. seq can be any
+    iterable, including a generator.
+
+    string_to_float_array(['1k', '130n', '5e7', '10%']) """
+    import numpy
+    values = {None: float('nan')}
+    def convert(string):
+        try:
+            return values[string]
+        except KeyError:
+            value = string_to_float(string)
+            if not isinstance(value, float):
+                value = float('nan')
+            values[string] = value
+            return value
+    strings = seq if isinstance(seq, list) else list(seq)
+    texts = numpy.array([string if type(string) is str else '' for string in strings], dtype=str)
+    n, width = len(texts), texts.itemsize
+    array = numpy.empty(n)
+    fast = numpy.zeros(n, dtype=bool)
+    if n and width:
+        scales = numpy.zeros(256)
+        for scale_factor, scale in _SCALE_FACTOR_DICT.items():
+            scales[ord(scale_factor)] = scale
+        number_chars = numpy.zeros(256, dtype=bool)
+        number_chars[[ord(char) for char in '0123456789.+-\0']] = True
+        chars = texts.view(numpy.uint8).reshape(n, width)
+        lengths = (chars != 0).sum(1)
+        rows = numpy.arange(n)
+        scale = scales[chars[rows, lengths - 1]]
+        scaled = scale != 0
+        mantissas = chars.copy()
+        mantissas[rows[scaled], lengths[scaled] - 1] = 0
+        exponent = (mantissas == ord('e')) | (mantissas == ord('E'))
+        # only numbers without a scale factor have an exponent, like in string_to_float
+        fast = ((number_chars[mantissas] | exponent).all(1) & (lengths > scaled) &
+                ~(scaled & exponent.any(1)))
+        try:
+            array[fast] = mantissas[fast].view('S%d' % width).ravel().astype(float)
+            array[fast] *= numpy.where(scaled, scale, 1.0)[fast]
+        except ValueError:  # misplaced signs or dots, string_to_float raises for them
+            fast[:] = False
+    for i in numpy.flatnonzero(~fast):
+        array[i] = convert(strings[i])
+    return array
 
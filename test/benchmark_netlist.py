@@ -0,0 +1,153 @@
+""" Synthetic netlists and benchmarks of the PySpectreScript netlist operations.
+
+For each size, a netlist with that many statements is generated and read,
+searched, changed, scaled, removed from and written in a separate process.
+The time, the throughput and the peak RSS of the process after each
+operation are reported.
+
+Usage: python benchmark_netlist.py [--json results.json] [size ...]
+
+With --json the results are appended to a JSON file to track them from run
+to run. The default sizes are 10000, 100000 and 1000000 statements.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from py_spectre import *
+
+def write_netlist(path, n, depth=6, fanout=4):
+    """ Writes a Spectre netlist of about n statements to path.
+
+    The netlist has a hierarchy of depth subckts, each instantiating the
+    one below fanout times, with devices using parameters, backslash and
+    '+' continuation lines, comments and a curly brace statistics block.
+    Instances of the cells, resistors, capacitors and transistors fill up
+    the top level to n statements.
+    """
+    with open(path, 'w') as fout:
+        fout.write('// Generated by benchmark_netlist.py\n')
+        fout.write('simulator lang=spectre\n')
+        fout.write('global 0 vdd!\n')
+        fout.write('parameters VDD=1.2 LN=130n LP=130n WN=1u \\\n    WP=2u RL=1k CL=10f\n')
+        fout.write('include "models.scs" section=tt\n')
+        fout.write('subckt inv (in out vdd vss)\n')
+        fout.write('parameters wn=WN wp=WP\n')
+        fout.write('MN0 (out in vss vss) nmos w=wn l=LN m=1\n')
+        fout.write('MP0 (out in vdd vdd) pmos w=wp \\\n    l=LP m=1\n')
+        fout.write('ends inv\n')
+        statements = 11
+        for level in xrange(1, depth + 1):
+            child = 'cell%d' % (level - 1) if level > 1 else 'inv'
+            fout.write('// Cell name: cell%d\n' % level)
+            fout.write('subckt cell%d (in out vdd vss)\n' % level)
+            for i in xrange(fanout):
+                node_in = 'in' if i == 0 else 'n%d' % i
+                node_out = 'out' if i == fanout - 1 else 'n%d' % (i + 1)
+                fout.write('X%d (%s %s vdd vss) %s\n' % (i, node_in, node_out, child))
+            fout.write('R0 (out vss) resistor r=RL\n+ m=1\n')
+            fout.write('ends cell%d\n' % level)
+            statements += fanout + 3
+        i = 0
+        while statements < n - 4:
+            if i % 100 == 0:
+                fout.write('// block %d\n' % (i // 100))
+                fout.write('X%d (n%d n%d vdd! 0) cell%d\n' % (i, i, i + 1, i % depth + 1))
+            elif i % 3 == 0:
+                fout.write('R%d (n%d n%d) resistor r=%dk \\\n    m=1\n' % (i, i, i + 1, i % 10 + 1))
+            elif i % 3 == 1:
+                fout.write('C%d (n%d 0) capacitor c=%df\n+ m=1\n' % (i, i, i % 10 + 1))
+            else:
+                fout.write('MN%d (n%d n%d 0 0) nmos w=%dn l=LN\n' % (i, i, i + 1, 200 + i % 800))
+            i += 1
+            statements += 1
+        fout.write('statistics {\n    process {\n        vary VDD dist=gauss std=0.01\n    }\n}\n')
+        fout.write('dc dc param=VDD start=0 stop=1.2 step=0.1\n')
+        fout.write('saveOptions options save=allpub\n')
+
+def peak_rss():
+    """ Returns the peak resident set size of this process in MB. """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes instead of kB
+        rss /= 1024
+    return rss / 1024.0
+
+def benchmark(n):
+    """ Returns (operation, seconds, items, unit, peak RSS in MB) for a netlist of n statements. """
+    directory = tempfile.mkdtemp()
+    results = []
+    def measure(operation, function, items=1, unit='ops'):
+        start = time.time()
+        value = function()
+        results.append((operation, time.time() - start, items, unit, peak_rss()))
+        return value
+    try:
+        path = os.path.join(directory, 'netlist.scs')
+        write_netlist(path, n)
+        size = os.path.getsize(path) / 1e6
+        pss = PySpectreScript()
+        measure('read', lambda: pss.read(path), size, 'MB')
+        statements = sum(len(item) if isinstance(item, list) else 1 for item in pss)
+        measure('search name (first, builds index)', lambda: pss.search('R3'))
+        measure('search name', lambda: pss.search('R%d' % (n // 2 // 3 * 3)))
+        found = measure('search name wildcard', lambda: pss.search('MN1*'))
+        measure('search master', lambda: pss.search(master='capacitor'))
+        measure('search parameter value', lambda: pss.search(p_name='w', p_val=lambda w: w > 900e-9))
+        measure('search node descend', lambda: pss.search(node='vdd', descend=True))
+        measure('change parameter', lambda: pss.search('parameters').change('VDD', '1.1'))
+        measure('change many statements', lambda: found.change('l', 'LP'), len(found))
+        resistors = pss.search(master='resistor')
+        measure('scale many statements', lambda: resistors.scale('r', 2), len(resistors))
+        measure('hierarchy count', lambda: pss.hierarchy().count('nmos'))
+        measure('write', lambda: pss.write(os.path.join(directory, 'out.scs')), size, 'MB')
+        pss.enable_incremental_write()
+        pss.write(os.path.join(directory, 'out.scs'))
+        pss.search('parameters').change('VDD', '1.0')
+        measure('incremental write', lambda: pss.write(os.path.join(directory, 'out.scs')))
+        removed = len(pss.search('C1*'))
+        measure('remove many statements', lambda: pss.remove('C1*'), removed)
+        results.insert(0, ('netlist', 0.0, statements, 'statements', peak_rss()))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def report(n, results):
+    print 'netlist of %d statements' % n
+    print '  %-40s %10s %14s %10s' % ('operation', 'time [ms]', 'throughput', 'RSS [MB]')
+    for operation, seconds, items, unit, rss in results:
+        if operation == 'netlist':
+            print '  %-40s %10s %14s %10.0f' % ('%d statements' % items, '', '', rss)
+            continue
+        throughput = '%.1f %s/s' % (items / seconds, unit) if seconds > 0 else '-'
+        print '  %-40s %10.1f %14s %10.0f' % (operation, seconds * 1e3, throughput, rss)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    json_path = None
+    if args[:1] == ['--json']:
+        json_path = args[1]
+        args = args[2:]
+    sizes = [int(arg) for arg in args] or [10000, 100000, 1000000]
+    record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': {}}
+    for n in sizes:
+        # a fresh process per size, so that the peak RSS is that of the size
+        pool = multiprocessing.Pool(1)
+        try:
+            results = pool.apply(benchmark, (n,))
+        finally:
+            pool.close()
+            pool.join()
+        report(n, results)
+        record['results'][n] = results
+    if json_path:
+        records = []
+        if os.path.exists(json_path):
+            with open(json_path) as fin:
+                records = json.load(fin)
+        records.append(record)
+        with open(json_path, 'w') as fout:
+            json.dump(records, fout, indent=1)
@@ -0,0 +1,54 @@
+""" Read throughput of PySpectreScript._parse against the recursive read_section.
+
+Usage: python benchmark_read.py [number of statements]
+"""
+import os
+import sys
+import tempfile
+import time
+from py_spectre import *
+from test_py_spectre import read_section
+
+def write_netlist(path, n):
+    with open(path, 'w') as fout:
+        fout.write('simulator lang=spectre\n')
+        fout.write('parameters LN=1u LP=2u VDS=1.2 // sweep parameters\n')
+        fout.write('subckt inv (in out vdd vss)\n')
+        fout.write('M0 (out in vss vss) nmos w=1u l=LN\n')
+        fout.write('M1 (out in vdd vdd) pmos w=2u \\\n  l=LP\n')
+        fout.write('ends inv\n')
+        for i in xrange(n):
+            if i % 10 == 0:
+                fout.write('// stage %d\n' % i)
+            if i % 3 == 0:
+                fout.write('I%d (n%d n%d vdd 0) inv\n' % (i, i, i+1))
+            elif i % 3 == 1:
+                fout.write('R%d (n%d n%d) resistor r=%dk\n+ m=1\n' % (i, i, i+1, i % 10 + 1))
+            else:
+                fout.write('C%d (n%d 0) capacitor c=%df\n' % (i, i, i % 10 + 1))
+        fout.write('dc dc param=VDS start=0 stop=1.2 step=0.1\n')
+
+def throughput(parse, path, repeat=3):
+    size = os.path.getsize(path) / 1e6
+    best = float('inf')
+    for _ in xrange(repeat):
+        with open(path) as fin:
+            start = time.time()
+            nsl = parse(fin)
+            best = min(best, time.time() - start)
+    return size / best, nsl
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fd, path = tempfile.mkstemp(suffix='.scs')
+    os.close(fd)
+    try:
+        write_netlist(path, n)
+        print 'netlist: %d statements, %.1f MB' % (n, os.path.getsize(path) / 1e6)
+        old, old_nsl = throughput(read_section, path)
+        new, new_nsl = throughput(PySpectreScript._parse, path)
+        assert repr(old_nsl) == repr(new_nsl)
+        print 'read_section: %6.2f MB/s' % old
+        print '_parse:       %6.2f MB/s (%.2fx)' % (new, new / old)
+    finally:
+        os.remove(path)
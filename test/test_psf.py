@@ -0,0 +1,420 @@
+import os
+import shutil
+import StringIO
+import struct
+import tempfile
+import unittest
+import numpy
+import psf
+
+def write_psf(path, x=None, traces=(), values=(), windowsize=None, buffersize=None):
+    """ Writes a small binary PSF file like the ones written by Spectre.
+
+    For a swept result x holds the sweep values and traces the traces as
+    (name, values) pairs or as (group name, [(name, values), ...]) groups.
+    Integer values are written as INT BYTE traces, which have no numpy dtype.
+    With windowsize the traces are written in windows of windowsize bytes
+    padded to buffers of buffersize bytes, then all traces must be grouped.
+    A result that is not swept has no x, values holds (name, value) pairs.
+    """
+    buf = bytearray()
+    def word(value):
+        buf.extend(struct.pack('>I', value))
+    def double(value):
+        buf.extend(struct.pack('>d', value))
+    def number(y, value):
+        buf.extend(struct.pack('>i' if y.dtype.kind == 'i' else '>d', value))
+    def typeid(y):
+        return byteid if y.dtype.kind == 'i' else floatid
+    def string(value):
+        word(len(value))
+        buf.extend(value + '\0' * ((4 - len(value)) % 4))
+    def begin(chunktype):
+        word(chunktype)
+        word(0)
+        return len(buf) - 4
+    def end(endpos):
+        struct.pack_into('>I', buf, endpos, len(buf))
+    def prop(name, value):
+        if isinstance(value, str):
+            word(33)
+            string(name)
+            string(value)
+        else:
+            word(34)
+            string(name)
+            word(value)
+    floatid, byteid, sweepid = 0x100, 0x101, 0x200
+    ids = iter(xrange(0x300, 0x10000))
+    traces = [(name, [(child, numpy.asarray(y)) for child, y in y_or_children], next(ids))
+              if isinstance(y_or_children, list) else (name, numpy.asarray(y_or_children), next(ids))
+              for name, y_or_children in traces]
+    childids = dict((id(y), next(ids)) for name, children, groupid in traces
+                    if isinstance(children, list) for child, y in children)
+    offsets = []
+    word(0x400)
+
+    offsets.append((0, len(buf)))
+    endpos = begin(21)
+    prop('PSF version', '1.00')
+    prop('PSF sweeps', 0 if x is None else 1)
+    prop('PSF sweep points', 0 if x is None else len(x))
+    prop('PSF traces', sum(len(y) if isinstance(y, list) else 1 for name, y, traceid in traces))
+    if windowsize:
+        prop('PSF window size', windowsize)
+        prop('PSF buffer size', buffersize)
+    end(endpos)
+
+    offsets.append((1, len(buf)))
+    endpos = begin(21)
+    endpos22 = begin(22)
+    word(16)
+    word(floatid)
+    string('V')
+    word(0)
+    word(11)
+    word(16)
+    word(byteid)
+    string('B')
+    word(0)
+    word(1)
+    end(endpos22)
+    word(19)
+    word(0)
+    word(1)
+    end(endpos)
+
+    if x is not None:
+        offsets.append((2, len(buf)))
+        endpos = begin(21)
+        word(16)
+        word(sweepid)
+        string('time')
+        word(floatid)
+        end(endpos)
+
+        offsets.append((3, len(buf)))
+        endpos = begin(21)
+        endpos22 = begin(22)
+        for name, y, traceid in traces:
+            if isinstance(y, list):
+                word(17)
+                word(traceid)
+                string(name)
+                word(len(y))
+                for child, childy in y:
+                    word(16)
+                    word(childids[id(childy)])
+                    string(child)
+                    word(typeid(childy))
+            else:
+                word(16)
+                word(traceid)
+                string(name)
+                word(typeid(y))
+        end(endpos22)
+        word(19)
+        word(0)
+        word(3)
+        end(endpos)
+
+    offsets.append((4, len(buf)))
+    endpos = begin(21)
+    if x is None:
+        endpos22 = begin(22)
+        for name, value in values:
+            word(16)
+            word(next(ids))
+            string(name)
+            word(floatid)
+            double(value)
+        end(endpos22)
+        word(19)
+        word(0)
+    elif windowsize:
+        word(20)
+        pad = (windowsize - (len(buf) + 4) % windowsize) % windowsize
+        word(pad)  # the first window starts on a window boundary
+        buf.extend('\0' * pad)
+        i = 0
+        while i < len(x):
+            bufferstart = len(buf)
+            word(16)
+            word(sweepid)
+            n = min(len(x) - i, ((len(buf) // windowsize + 1) * windowsize - len(buf)) // 8)
+            for value in x[i:i + n]:
+                double(value)
+            for name, children, groupid in traces:
+                for child, y in children:
+                    buf.extend('\0' * (windowsize - (4 if y.dtype.kind == 'i' else 8) * n))
+                    for value in y[i:i + n]:
+                        number(y, value)
+            buf.extend('\0' * ((buffersize - (len(buf) - bufferstart)) % buffersize))
+            i += n
+    else:
+        for i, value in enumerate(x):
+            word(16)
+            word(sweepid)
+            double(value)
+            for name, y, traceid in traces:
+                if isinstance(y, list):
+                    word(17)
+                    word(traceid)
+                    for child, childy in y:
+                        number(childy, childy[i])
+                else:
+                    word(16)
+                    word(traceid)
+                    number(y, y[i])
+    word(4)
+    end(endpos)
+
+    datasize = len(buf)
+    for section, offset in offsets:
+        word(section)
+        word(offset)
+    buf.extend('Clarissa')
+    word(datasize)
+    with open(path, 'wb') as fout:
+        fout.write(buf)
+
+class PSFTestCase(unittest.TestCase):
+    """ Tests for the PSF reader on generated PSF files. """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.x = numpy.linspace(0, 1e-9, 81)
+        self.inp = numpy.sin(self.x * 5e9)
+        self.inn = -numpy.cos(self.x * 3e9)
+        self.i = self.x * 1e6
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_sweep(self, name='sweep'):
+        write_psf(self.path(name), self.x, [('V', [('INP', self.inp), ('INN', self.inn)]),
+                                            ('I0.M1:ids', self.i)])
+        return self.path(name)
+
+    def write_windowed(self, name='windowed', buffersize=260):
+        # buffers that are not a multiple of the window size shift the windows, so
+        # some windows only have room for a few sweep points or for none
+        write_psf(self.path(name), self.x, [('V', [('INP', self.inp), ('INN', self.inn)])],
+                  windowsize=64, buffersize=buffersize)
+        return self.path(name)
+
+    def open(self, path, **kwargs):
+        reader = psf.PSFReader(path, **kwargs)
+        reader.open()
+        return reader
+
+    def test_trace_name_table(self):
+        names = ['a', 'a.b', 'a.', 'ab', 'a:b', 'b.a', 'a.b.c', 'a.a', '', 'I0.M1:d', 'I0.M1:g']
+        table = psf.TraceNameTable([(name, (i,)) for i, name in enumerate(names)])
+        self.assertEqual(len(table), len(names))
+        self.assertEqual(table.getNames(), tuple(names))
+        self.assertEqual([table.getName(i) for i in range(len(names))], names)
+        for i, name in enumerate(names):
+            self.assertEqual(table[name], (i,))
+        for name in ['b', 'a.c', 'a..', 'I0.M1:s', 'I0.M1', 'a.b.c.d', 'aa']:
+            self.assertFalse(name in table)
+            self.assertEqual(table.get(name), None)
+            self.assertRaises(KeyError, table.__getitem__, name)
+        self.assertEqual(sorted(table.keys()), sorted(names))
+        self.assertEqual(dict(table.items()), dict((name, (i,)) for i, name in enumerate(names)))
+        # the last of duplicate names is found, like in the dict the table replaced
+        self.assertEqual(psf.TraceNameTable([('x', (0,)), ('x', (1,))])['x'], (1,))
+
+        reader = self.open(self.write_sweep())
+        self.assertEqual(reader.getValueNames(), ('INP', 'INN', 'I0.M1:ids'))
+        self.assertEqual(reader.traces.getTraceIndexByName('INN'), (0, 1))
+        self.assertEqual(reader.traces.getTraceIndexByName('I0.M1:ids'), (1,))
+        group, trace = reader.traces.children
+        for chunk in group.children + [trace]:
+            self.assertFalse('name' in chunk.__dict__)  # only the table holds the names
+        self.assertEqual(group.getNames(), ['INP', 'INN'])
+        self.assertEqual(str(trace.name), 'I0.M1:ids')
+        self.assertTrue('"INN" "V"' in reader.toPSFasc())
+        numpy.testing.assert_array_equal(reader.getValuesByName('INN'), self.inn)
+        numpy.testing.assert_array_equal(reader.getValuesByName('I0.M1:ids'), self.i)
+
+    def test_sweep_range(self):
+        ranges = [(None, None), (3e-10, 6e-10), (None, 2e-10), (5.9e-10, None), (6e-10, 6e-10),
+                  (2e-9, None)]
+        for path in (self.write_sweep(), self.write_windowed(), self.write_windowed('aligned', 256)):
+            reader = self.open(path)
+            for start, stop in ranges:
+                mask = numpy.ones(len(self.x), dtype=bool)
+                if start is not None:
+                    mask &= self.x >= start
+                if stop is not None:
+                    mask &= self.x <= stop
+                numpy.testing.assert_array_equal(
+                    reader.getSweepParamValues(0, start=start, stop=stop), self.x[mask])
+                numpy.testing.assert_array_equal(
+                    reader.getValuesByName('INN', start=start, stop=stop), self.inn[mask])
+
+    def test_windowed_load(self):
+        reader = self.open(self.write_windowed())
+        windows = reader.values.children
+        # the file has 19 windows, the 14th has no room for a sweep point and is skipped
+        self.assertEqual(len(windows), 18)
+        self.assertTrue(all(window.n > 0 for window in windows))
+        self.assertEqual(sum(window.n for window in windows), len(self.x))
+        for window in windows:
+            self.assertFalse(window.loaded)
+            self.assertTrue(window.firstparamvalue <= window.lastparamvalue)
+        # the sweep parameter values are read without decoding the windows
+        x = sum([window.getSweepParamValues() for window in windows], [])
+        numpy.testing.assert_array_equal(x, self.x)
+        self.assertTrue(all(type(value) is float for value in x))
+        numpy.testing.assert_array_equal(reader.getSweepParamValues(0, start=3e-10, stop=6e-10),
+                                         self.x[(self.x >= 3e-10) & (self.x <= 6e-10)])
+        self.assertFalse(any(window.loaded for window in windows))
+        # load decodes the whole window like a read that is not lazy
+        for window in windows:
+            window.load()
+        self.assertEqual(sum([window.getSweepParamValues() for window in windows], []), x)
+        inp = numpy.concatenate([[value.getValue() for value in window.children[0].children[0]]
+                                 for window in windows])
+        numpy.testing.assert_array_equal(inp, self.inp)
+        # loaded windows give the same traces as windows that are read directly
+        numpy.testing.assert_array_equal(reader.getValuesByName('INN'), self.inn)
+        self.assertEqual(reader.toPSFasc().split('VALUE')[1].count('"time"'), len(self.x))
+
+    def test_decimation(self):
+        simple = self.open(self.write_sweep())
+        windowed = self.open(self.write_windowed())
+        for max_points in (2, 3, 10, 25):
+            x, y = simple.getValuesByName('INP', max_points=max_points, method='minmax')
+            self.assertTrue(len(x) <= max_points)
+            self.assertTrue(numpy.all(numpy.diff(x) > 0))
+            self.assertEqual((y.min(), y.max()), (self.inp.min(), self.inp.max()))
+            # windows are streamed through and give the same points
+            decimated = windowed.getValuesByName('INP', max_points=max_points, method='minmax')
+            numpy.testing.assert_array_equal(decimated[0], x)
+            numpy.testing.assert_array_equal(decimated[1], y)
+        for max_points in (3, 4, 10, 25):
+            x, y = simple.getValuesByName('INP', max_points=max_points, method='lttb')
+            self.assertTrue(len(x) <= max_points)
+            self.assertEqual((x[0], x[-1], y[0], y[-1]), (self.x[0], self.x[-1], self.inp[0], self.inp[-1]))
+            self.assertTrue(numpy.all(numpy.in1d(y, self.inp)))
+            decimated = windowed.getValuesByName('INP', max_points=max_points, method='lttb')
+            numpy.testing.assert_array_equal(decimated[0], x)
+            numpy.testing.assert_array_equal(decimated[1], y)
+        x, y = simple.getValuesByName('INP', max_points=100, method='lttb', start=5e-10)
+        numpy.testing.assert_array_equal(x, self.x[self.x >= 5e-10])
+        numpy.testing.assert_array_equal(y, self.inp[self.x >= 5e-10])
+        for method, max_points in (('minmax', 1), ('lttb', 1), ('lttb', 2)):
+            self.assertRaises(ValueError, simple.getValuesByName, 'INP', max_points=max_points,
+                              method=method)
+            self.assertRaises(ValueError, psf.DECIMATORS[method], [(self.x, self.inp)],
+                              self.x[0], self.x[-1], max_points)
+        self.assertRaises(ValueError, simple.getValuesByName, 'INP', max_points=10, method='mean')
+
+    def test_read_windows(self):
+        path = self.write_windowed()
+        for threads in (None, 1, 3, 64):
+            reader = self.open(path, threads=threads)
+            values = reader.getValuesByNames(['INP', 'INN'])
+            numpy.testing.assert_array_equal(values['INP'], self.inp)
+            numpy.testing.assert_array_equal(values['INN'], self.inn)
+            values = reader.getValuesByNames(['INN'], start=2e-10, stop=7e-10)
+            mask = (self.x >= 2e-10) & (self.x <= 7e-10)
+            numpy.testing.assert_array_equal(values['INN'], self.inn[mask])
+            # windows are stitched together in order from any subset of windows
+            windows = reader.values.children[3:11]
+            x, ys = reader.values.readWindows(windows, [(0, 1), (0, 0)])
+            first = sum(window.n for window in reader.values.children[:3])
+            last = first + sum(window.n for window in windows)
+            numpy.testing.assert_array_equal(x, self.x[first:last])
+            numpy.testing.assert_array_equal(ys[0], self.inn[first:last])
+            numpy.testing.assert_array_equal(ys[1], self.inp[first:last])
+            x, ys = reader.values.readWindows([], [(0, 0)])
+            self.assertEqual((len(x), len(ys[0])), (0, 0))
+            # the threads use files of their own, the position of the reader's file is kept
+            position = reader.file.tell()
+            reader.values.readWindows(reader.values.children, [(0, 0)])
+            self.assertEqual(reader.file.tell(), position)
+
+    def test_read_windows_without_dtype(self):
+        # the INT BYTE values are decoded one by one and the floats read as a block after them
+        steps = numpy.arange(len(self.x), dtype=numpy.int32) % 100
+        write_psf(self.path('mixed'), self.x, [('V', [('STEP', steps), ('INN', self.inn)])],
+                  windowsize=64, buffersize=260)
+        reader = self.open(self.path('mixed'))
+        self.assertEqual(reader.traces.getWindowLayout(64), ({(0,): 0, (0, 0): 0, (0, 1): 64}, 128))
+        values = reader.getValuesByNames(['STEP', 'INN'])
+        numpy.testing.assert_array_equal(values['STEP'], steps)
+        numpy.testing.assert_array_equal(values['INN'], self.inn)
+        x, ys = reader.values.readWindows(reader.values.children, [(0, 0), (0, 1)])
+        numpy.testing.assert_array_equal(x, self.x)
+        numpy.testing.assert_array_equal(ys[0], steps)
+        numpy.testing.assert_array_equal(ys[1], self.inn)
+        numpy.testing.assert_array_equal(reader.getValuesByName('INN', start=2e-10),
+                                         self.inn[self.x >= 2e-10])
+
+    def test_truncated(self):
+        paths = [self.write_sweep(), self.write_windowed()]
+        write_psf(self.path('op'), values=[('VIN', 1.0), ('VOUT', 2.5), ('I0.M1:ids', 1e-6)])
+        paths.append(self.path('op'))
+        for path in paths:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+            reader = self.open(path)
+            names = reader.getValueNames()
+            values_start = reader.values.fileoffset
+            truncated = self.path('truncated')
+            for size in range(values_start - 40, len(data), 13):
+                with open(truncated, 'wb') as fout:
+                    fout.write(data[:size])
+                reader = psf.PSFReader(truncated)
+                self.assertRaises(psf.PSFInvalid, reader.open)
+                reader = psf.PSFReader(truncated)
+                if size < values_start:
+                    if size < values_start - 8:  # ends in the trace or type section
+                        self.assertRaises(psf.PSFInvalid, reader.open, recover=True)
+                    continue
+                reader.open(recover=True)
+                self.assertTrue(reader.truncated)
+                if reader.values is None:  # ends before the first chunk of the values section
+                    self.assertTrue(size < values_start + 12)
+                    continue
+                if path.endswith('op'):
+                    recovered = reader.values.getValueNames()
+                    self.assertEqual(recovered, names[:len(recovered)])
+                    for name in recovered:
+                        self.assertEqual(reader.getValuesByName(name), self.open(path).getValuesByName(name))
+                    continue
+                x = reader.getSweepParamValues()
+                self.assertTrue(len(x) <= len(self.x))
+                numpy.testing.assert_array_equal(x, self.x[:len(x)])
+                numpy.testing.assert_array_equal(reader.getValuesByName('INN'), self.inn[:len(x)])
+            # all sweep points of a complete values section are recovered from a file without trailer
+            with open(truncated, 'wb') as fout:
+                fout.write(data[:struct.unpack('>I', data[-4:])[0]])
+            reader = psf.PSFReader(truncated)
+            reader.open(recover=True)
+            self.assertEqual(reader.getValueNames(), names)
+
+    def test_seek_next_section(self):
+        words = [21, 0, 22, 21, 200, 22, 21, 40, 16, 21, 52, 22, 0, 0]
+        fin = StringIO.StringIO(struct.pack('>%dI' % len(words), *words))
+        # the first candidates end before they start, after the file or have the wrong first chunk
+        self.assertTrue(psf.PSFReader._seekNextSection(fin, 56, [22]))
+        self.assertEqual(fin.tell(), 36)
+        fin.seek(0)
+        self.assertTrue(psf.PSFReader._seekNextSection(fin, 56, [16]))
+        self.assertEqual(fin.tell(), 24)
+        fin.seek(0)
+        self.assertTrue(psf.PSFReader._seekNextSection(fin, 56, [22], bounded=False))
+        self.assertEqual(fin.tell(), 0)
+        self.assertFalse(psf.PSFReader._seekNextSection(fin, 30, [22]))
+        # only errors of reads past the end of the file are taken for truncation
+        for error in (ValueError, KeyError, AssertionError):
+            self.assertFalse(issubclass(error, psf.TruncationErrors))
+
+if __name__ == '__main__':
+    unittest.main()
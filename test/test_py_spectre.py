@@ -1,8 +1,92 @@
 from py_spectre import * 
+import collections
+import copy
+import gc
+import math
+import multiprocessing
 import random
+import re
+import shutil
+import signal
+import StringIO
 import sys
+import tempfile
+import time
 import unittest
 
+# The original recursive line reader, kept as the reference for PySpectreScript._parse
+def _strip_conts(line, had_backslash):
+    if _has_backslash_continuation(line):
+        line = line[:-1]
+    if _has_plus_cont(line, had_backslash):
+        line = line[1:]
+    return line
+
+def _has_backslash_continuation(stripped_line):
+    if stripped_line:
+        return stripped_line[-1] == '\\'
+    else:
+        return False
+
+def _has_plus_cont(stripped_line, had_backslash):
+    # the first character can be a '+' if the line is continuing
+    if stripped_line:
+        return (stripped_line[0] == '+') and (not had_backslash)
+    else:
+        return False
+
+def read_section(fin, ns_line=''):
+    nsl = []
+    had_backslash = _has_backslash_continuation(ns_line)
+    if had_backslash:
+        ns_line = _strip_conts(ns_line, had_backslash)
+    for line in fin:
+        stripped_line = line.split('//')[0].strip() # remove and discard commments
+        split_line = stripped_line.split('=', 1)
+        split_line[0] = re.sub(r'[()]', '', split_line[0]) # remove parentheses
+        stripped_line = '='.join(split_line)
+        ns_segment = _strip_conts(stripped_line, had_backslash)
+        if _has_plus_cont(stripped_line, had_backslash) or had_backslash:
+            ns_line += ns_segment
+        else:  # start of a new statement
+            if ns_line:  # if not empty
+                ns = NetlistStatement.from_string(ns_line)
+                nsl.append(ns)
+                ns_line = ''
+            if ns_segment:
+                segment_name = ns_segment.split()[0]
+                if segment_name in ['subckt', 'section']:
+                    # found start of subnetlist, step into recursion
+                    sub_statements = read_section(fin, stripped_line)
+                    nsl.append(sub_statements)
+                    had_backslash = False
+                    continue
+                elif segment_name in ['ends', 'endsection']:
+                    # found end of subnetlist
+                    ns = NetlistStatement.from_string(ns_segment)
+                    nsl.append(ns)
+                    # step out of recursion
+                    return nsl
+                elif ns_segment[-1] == '{':
+                    ns = NetlistStatement.from_string(ns_segment[:-1].strip())
+                    sub_statements = read_section(fin)
+                    ns.subnetlist = sub_statements
+                    nsl.append(ns)
+                elif ns_segment[-1] == '}':
+                    return nsl
+                else:
+                    # netlist statement saved, overwrite now
+                    ns_line = ns_segment
+            else:  # empty line and no line continuations
+                ns_line = ''
+        # check for backslash continuation and save for operations on next line
+        had_backslash = _has_backslash_continuation(stripped_line)
+    # end of file, parse last netlist statement
+    if ns_line:  # if not empty
+        ns = NetlistStatement.from_string(ns_line)
+        nsl.append(ns)
+    return nsl
+
 class NetlistStatementTestCase(unittest.TestCase):
     """ Tests for py_spectre NetlistStatement class. """
     def test_from_string(self):
@@ -184,6 +268,50 @@ class NetlistStatementTestCase(unittest.TestCase):
         self.assertFalse(name_master_and_params._ns_match(p_name='*', p_val=constraint3))
         self.assertFalse(name_master_and_params._ns_match(p_name='*', p_val=constraint4))
 
+    def test_compact_representation(self):
+        R1 = NetlistStatement.from_string('R1 n1 vss resistor r=1k')
+        R2 = NetlistStatement.from_string('R2 n1 vss resistor r=2k')
+        self.assertFalse(hasattr(R1, '__dict__'))
+        self.assertTrue(R1.nodes[0] is R2.nodes[0])
+        self.assertTrue(R1.parameters.keys()[0] is R2.parameters.keys()[0])
+        save = NetlistStatement('save', ['n1'])
+        save_copy = copy.deepcopy(save)
+        save.parameters['x'] = '1'
+        save.subnetlist.append(R1)
+        save.nodes.append('n2')
+        self.assertEqual(str(save), 'save n1 n2  x=1')
+        self.assertEqual(str(save_copy), 'save n1 ')
+        self.assertEqual((save_copy.parameters, save_copy.subnetlist), ({}, []))
+        nodes = R1.nodes
+        R1.change('n1', 'n3')
+        R1.master = 'res'
+        self.assertEqual(nodes, ['n3', 'vss', 'res'])
+        R2.replace('n1', 'n4')
+        self.assertEqual(R2.nodes, ['n4', 'vss', 'resistor'])
+
+    def test_string_to_float(self):
+        strings = ['1k', '130n', '5e7', '10%', '-2.5m', '1e-3', '3', 'R0*2', '1kOhm', '5e', None]
+        expected = [1e3, 130e-9, 5e7, 0.1, -2.5e-3, 1e-3, 3.0, 'R0*2', 1e3, '5e']
+        for string, value in zip(strings, expected) * 2:
+            self.assertEqual(string_to_float(string), value)
+        array = string_to_float_array(strings)
+        self.assertEqual(len(array), len(strings))
+        for value, expected_value in zip(array, expected + [None]):
+            if isinstance(expected_value, float):
+                self.assertEqual(value, expected_value)
+            else:
+                self.assertTrue(math.isnan(value))
+        generated = string_to_float_array(string for string in strings)
+        self.assertEqual(str(generated), str(array))
+        # the values converted by numpy agree with the ones that fall back to string_to_float
+        column = ['%s%s' % (number, suffix) for number in ('-3', '0.5', '+.25', '7.', '1e2', '2E-3')
+                  for suffix in ('', 'k', '_', 'M', 'uA', 'e1', 'x')]
+        expected = [string_to_float(string) for string in column]
+        expected = [value if isinstance(value, float) else float('nan') for value in expected]
+        self.assertEqual(str(string_to_float_array(column).tolist()), str(expected))
+        self.assertEqual(len(string_to_float_array([])), 0)
+        self.assertRaises(ValueError, string_to_float_array, ['1k', '1-2'])
+
 
 class PySpectreScriptTestCase(unittest.TestCase):
     """ Tests for py_spectre PySpectreScript class. """
@@ -291,6 +419,445 @@ class PySpectreScriptTestCase(unittest.TestCase):
         self.assertEqual(len(pss.search('I5', descend='spectre_test_RC')), 0)
         self.assertEqual(len(pss.search('I5', descend='spectre_test_RCRC')), 1)
 
+    def test_parse(self):
+        netlist = ('R1 (a b) resistor r=1 \\\n  w=2\n+ l=3 // comment\n'
+                   'subckt foo (x y)\nR2 (x y) resistor r=(2)\nends foo\nR3 a b c\n'
+                   'X1 (a) foo {\nR4 (a 0) resistor r=4\n}\nR5 a b resistor r=5\n')
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        for block_size in (5, 1 << 20):
+            nsl = PySpectreScript._parse(StringIO.StringIO(netlist), block_size)
+            self.assertEqual(repr(nsl), repr(read_section(StringIO.StringIO(netlist))))
+            self.assertEqual(len(nsl), 5)
+            self.assertEqual(nsl[0].parameters, {'r': '1', 'w': '2', 'l': '3'})
+            self.assertEqual(len(nsl[1]), 3)
+            self.assertEqual(len(nsl[3].subnetlist), 1)
+            with open(path_to_script) as fin:
+                nsl = PySpectreScript._parse(fin, block_size)
+            with open(path_to_script) as fin:
+                self.assertEqual(repr(nsl), repr(read_section(fin)))
+
+    def test_parse_parallel(self):
+        netlist = ('R1 (a b) resistor r=1 \\\n  w=2\n+ l=3 // comment {\n'
+                   'subckt foo (x y)\nR2 (x y) resistor r=(2)\nX0 (x) bar {\nR0 x 0 r=1\n}\nends foo\n'
+                   'R3 a b c \\\nsubckt\n// ends\nX1 (a) foo {\nR4 (a 0) resistor r=4\n}\n'
+                   'section s1\nR6 a b resistor r=6\n+ w=1\nendsection s1\n') * 20
+        netlist += 'R5 a b resistor r=5\nends\nR7 a b resistor r=7\n'
+        nsl = PySpectreScript._parse(StringIO.StringIO(netlist))
+        for n in xrange(2, 20):
+            points = PySpectreScript._split_points(netlist, n)
+            parts = []
+            for start, end in zip(points[:-1], points[1:]):
+                parts.extend(PySpectreScript._parse(StringIO.StringIO(netlist[start:end])))
+            self.assertEqual(repr(parts), repr(nsl))
+        self.assertEqual(len(PySpectreScript._split_points(netlist, 20)), 21)
+        out_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(out_dir, 'netlist.scs')
+            with open(path, 'w') as fout:
+                fout.write(netlist)
+            pss = PySpectreScript()
+            pss.read_processes = 2
+            pss.parallel_read_min_size = 0
+            pss.read(path)
+            self.assertEqual(repr(pss.nsl), repr(nsl))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_netlist_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        path_to_script = os.path.join(cache_dir, 'spectre_test0.scs')
+        shutil.copy('./spectre_scripts/spectre_test0.scs', path_to_script)
+        try:
+            PySpectreScript.netlist_cache = cache = NetlistCache(os.path.join(cache_dir, 'cache'))
+            pss = PySpectreScript(path_to_script)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            pss_cached = PySpectreScript(path_to_script)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(repr(pss.nsl), repr(pss_cached.nsl))
+            self.assertEqual(len(pss_cached.search('R*', descend=True)), 3)
+            os.utime(path_to_script, (0, 0))  # touched, same contents
+            PySpectreScript(path_to_script)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            with open(path_to_script, 'a') as fout:
+                fout.write('R9 (a b) resistor r=1\n')
+            self.assertEqual(len(PySpectreScript(path_to_script).search('R9')), 1)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            pss.read_disable_gc = True
+            pss.read(path_to_script)
+            self.assertTrue(gc.isenabled())
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertEqual(os.listdir(cache.directory), [])
+        finally:
+            PySpectreScript.netlist_cache = None
+            shutil.rmtree(cache_dir)
+
+    def test_resolve_includes(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        pss_includes = pss.resolve_includes()
+        models = pss_includes.search('model')
+        self.assertEqual([ns.nodes for ns in models], [['nmos', 'nmos'], ['pmos', 'pmos']])
+        self.assertEqual(models[0].parameters['level'], '54')
+        self.assertEqual(models[0].parameters['vth0'], '0.3782')
+        self.assertEqual(len(pss_includes.search(p_name='vth0', p_val=lambda v: v < 0)), 1)
+        self.assertEqual(len(pss_includes.search('include')), 0)
+        self.assertEqual(len(pss_includes), len(pss) + 1)
+        # the model statements are parsed once and shared
+        other = PySpectreScript('./spectre_scripts/gmid_sweep.scs').resolve_includes()
+        self.assertTrue(other.search('model').nsl[0] is pss.resolve_includes().search('model').nsl[0])
+        # modifying the resolved statements does not change the shared ones
+        other.search('model').change('level', '14')
+        self.assertEqual(models[0].parameters['level'], '54')
+        self.assertEqual(pss.resolve_includes().search('model')[0].parameters['level'], '54')
+
+    def test_resolve_spice_lib_sections(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'models.lib'), 'w') as fout:
+                fout.write('* PTM style corner library\n'
+                           '.lib tt\n.param toxe=1.2n\n'
+                           '.model nmos nmos level=54\n+ vth0=0.4 toxe=toxe\n.endl tt\n\n'
+                           '.lib ss\n.param toxe=1.3n\n'
+                           '.model nmos nmos level=54\n+ vth0=0.5 toxe=toxe\n.endl ss\n')
+            with open(os.path.join(directory, 'corners.sp'), 'w') as fout:
+                fout.write("* slow corner\n.lib 'models.lib' ss\n")
+            path_to_script = os.path.join(directory, 'netlist.scs')
+            with open(path_to_script, 'w') as fout:
+                fout.write('include "models.lib" section=tt\nM0 (d g 0 0) nmos\n')
+            pss = PySpectreScript(path_to_script).resolve_includes()
+            self.assertEqual([ns.name for ns in pss], ['param', 'model', 'M0'])
+            self.assertEqual(pss.search('model')[0].parameters['vth0'], '0.4')
+            with open(path_to_script, 'w') as fout:
+                fout.write('include "corners.sp"\nM0 (d g 0 0) nmos\n')
+            pss = PySpectreScript(path_to_script).resolve_includes()
+            self.assertEqual(pss.search('model')[0].parameters['vth0'], '0.5')
+            self.assertEqual(pss.search('param')[0].parameters['toxe'], '1.3n')
+            self.assertRaises(ValueError, PySpectreScript._section_statements,
+                              read_include(os.path.join(directory, 'models.lib')), 'ff')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_search_index(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        queries = [dict(name='R*'), dict(name='C0', descend=True),
+                   dict(name='R.*?', regex=True), dict(name='I5', descend='spectre_test_RC*'),
+                   dict(node='VIP', descend=True), dict(node='0'), dict(node='VO?'),
+                   dict(master='res*', descend=True), dict(master='ideal_balun'),
+                   dict(p_name='r', p_val=lambda R: R < 2e3, descend=True),
+                   dict(p_name='_par0', p_val='R1', descend=True), dict(p_name='*', descend=True)]
+        def search_ids(threshold, query):
+            pss.index_threshold = threshold
+            return [id(ns) for ns in pss.search(**query)]
+        def assert_same_results():
+            for query in queries:
+                self.assertEqual(search_ids(0, query), search_ids(len(pss) + 1, query))
+        assert_same_results()
+        pss.search('R0', descend=True).change('name', 'R9')
+        pss.search(node='VIP').change('VIP', 'VIPX')
+        pss.search('*').add_param('w', '1u')
+        pss.add('Rz VIP 0 resistor r=1k', 3)
+        pss.remove('C1')
+        assert_same_results()
+        self.assertEqual(len(pss.search('R9', descend=True)), 2)
+        self.assertEqual(len(pss.search(node='VIP')), 1)
+        pss.search('*').replace('VIPX', 'VIP')
+        pss.search('*').del_param('w')
+        assert_same_results()
+        self.assertEqual(len(pss.search(node='VIP')), 3)
+
+    def test_query(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        query = pss.query(name='R*', master='resistor', p_name='r', p_val=lambda R: R < 2e3)
+        self.assertEqual(len(pss.search(query)), 2)
+        self.assertEqual(len(pss.search(query).search(query)), 2)
+        query = Query(master='cap*', descend=True)
+        self.assertEqual(len(pss.search(query)), 3)
+        self.assertEqual(len(pss.search(Query('R0', descend='spectre_test_RC'))), 1)
+        self.assertEqual(len(pss.search(Query('R0', descend='spectre_test_RCRC'))), 0)
+        pss.remove(query)
+        self.assertEqual(len(pss.search(master='capacitor', descend=True)), 0)
+
+    def test_columns(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        pss_columns = PySpectreScript(path_to_script)
+        pss_columns.enable_columns()
+        constraints = [lambda R: R < 2e3, lambda R: R > 500, lambda R: R > 2e3]
+        for constraint in constraints:
+            for descend in (False, True, 'spectre_test_RC'):
+                self.assertEqual(str(pss.search(p_name='r', p_val=constraint, descend=descend)),
+                                 str(pss_columns.search(pss_columns.query(p_name='r', p_val=constraint,
+                                                                          descend=descend, vectorized=True))))
+                self.assertEqual(str(pss.search(p_name='r', p_val=constraint, descend=descend)),
+                                 str(pss_columns.search(p_name='r', p_val=constraint, descend=descend)))
+        self.assertEqual(len(pss_columns.search(p_name='c', p_val=lambda C: C > 100e-15, descend=True)), 2)
+        # predicates that only take a float are not called with the column
+        self.assertEqual(len(pss_columns.search(p_name='r', p_val=lambda R: 500 < float(R) < 2e3)), 2)
+        pss.search(p_name='r').scale('r', 3)
+        pss.search(p_name='c').scale('c', 2)
+        pss.search(p_name='c').scale('c', 0.5)
+        pss_columns.scale('r', 3)
+        pss_columns.scale('c', 2)
+        pss_columns.scale('c', 0.5)
+        self.assertEqual(str(pss), str(pss_columns))
+        pss_columns.search('R1')[0].change('r', '5k')
+        self.assertEqual(len(pss_columns.search(p_name='r', p_val=lambda R: R > 4e3)), 1)
+        # rebuilding the columns does not pile up references to the dead ones
+        for _ in range(3):
+            pss_columns.reindex()
+            pss_columns.search(Query(p_name='r', p_val=lambda R: R > 4e3, vectorized=True))
+        self.assertEqual(len(pss_columns.search('R1')[0]._indexes), 1)
+        # the scaled values are written back when the parameters are read, through any accessor
+        position = [getattr(ns, 'name', None) for ns in pss.nsl].index('R1')
+        accessors = [lambda scaled: scaled[position], lambda scaled: list(scaled)[position],
+                     lambda scaled: scaled.nsl[position], lambda scaled: scaled.search('R1')[0],
+                     lambda scaled: scaled.search('R1').nsl[0], lambda scaled: scaled.clone()[position]]
+        for accessor in accessors:
+            scaled = PySpectreScript(path_to_script)
+            scaled.enable_columns()
+            scaled.scale('r', 3)
+            self.assertEqual(accessor(scaled).parameters['r'], pss.search('R1')[0].parameters['r'])
+            self.assertTrue(' r=3000.0' in str(scaled.search('R0')[0]))
+
+    def test_expressions(self):
+        netlist = ('parameters R0=2 VDS=0.6 W=1u\n'
+                   'parameters VGS=VDS*2 R1=R0 * 1k / 42 LOOP=LOOP+1\n'
+                   'subckt foo (x y)\nparameters R0=5\nR9 (x y) resistor r=R0\nends foo\n'
+                   'R1 (a b) resistor r=R1\nR2 (b c) resistor r=2*R0 + 1k\n'
+                   'M1 (d g s b) nmos w=max(W, 2u) l=VDS > 1 ? 1u : 0.5u\n')
+        pss = PySpectreScript()
+        pss.nsl = PySpectreScript._parse(StringIO.StringIO(netlist))
+        self.assertAlmostEqual(Expression.compile('R0 * 1k / 42').evaluate({'R0': 2}), 2e3 / 42)
+        self.assertAlmostEqual(Expression.compile('-2**2 + 2^3^2 + sqrt(M_PI*M_PI)').evaluate({}),
+                               -4 + 2**9 + math.pi)
+        self.assertEqual(Expression.compile('1/2').evaluate({}), 0.5)
+        self.assertRaises(ValueError, Expression.compile, 'R0 *')
+        self.assertAlmostEqual(pss.evaluate('R1'), 2e3 / 42)
+        self.assertEqual(pss.evaluate('LOOP'), None)
+        pss.enable_expressions()
+        self.assertEqual(len(pss.search(p_name='r', p_val=lambda R: R > 1e3)), 1)
+        self.assertEqual(len(pss.search(p_name='r', p_val=lambda R: R > 40)), 2)
+        self.assertEqual(len(pss.search(p_name='w', p_val=lambda W: W == 2e-6)), 1)
+        self.assertEqual(len(pss.search(p_name='r', p_val=lambda R: R == 5, descend=True)), 0)
+        evaluator = pss._evaluator
+        pss.search('parameters').change('R0', '4.2')
+        self.assertTrue(pss._evaluator is evaluator)
+        self.assertAlmostEqual(evaluator.values['R1'], 100)
+        self.assertAlmostEqual(evaluator.values['VGS'], 1.2)
+        self.assertEqual(len(pss.search(p_name='r', p_val=lambda R: R == 100)), 1)
+        pss.search('parameters').change('VDS', '1.5')
+        self.assertAlmostEqual(evaluator.values['VGS'], 3)
+        self.assertEqual(len(pss.search(p_name='l', p_val=lambda L: L == 1e-6)), 1)
+        pss.search(p_name='r').scale('r', 2)
+        self.assertEqual(pss.search('R1')[0].parameters['r'], '(R1)*2')
+        self.assertEqual(len(pss.search(p_name='r', p_val=lambda R: R == 200)), 1)
+        self.assertEqual(pss.search('R9', descend=True)[0].parameters['r'], 'R0')
+        clone = pss.clone()
+        clone.search('parameters').change('R0', '42')
+        self.assertAlmostEqual(clone.evaluate('R1'), 1e3)
+        self.assertAlmostEqual(pss.evaluate('R1'), 100)
+
+    def test_hierarchy(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        hierarchy = pss.hierarchy()
+        self.assertEqual(hierarchy.count('resistor'), 4)
+        self.assertEqual(hierarchy.count('spectre_test_RC'), 2)
+        self.assertEqual(hierarchy.count('*', cell='spectre_test_RC'), 2)
+        self.assertEqual(hierarchy.total('r', master='resistor'), 2e3)
+        self.assertEqual(hierarchy.total('c', master='cap*'), 2e-12)
+        self.assertEqual(list(hierarchy.paths(master='resistor')), ['I1.I5.R0', 'I1.I4.R0', 'R1', 'R0'])
+        self.assertEqual(list(hierarchy.paths('I1.*.C0')), ['I1.I5.C0', 'I1.I4.C0'])
+        self.assertRaises(KeyError, hierarchy.count, 'resistor', 'foo')
+        pss.search('R1').change('master', 'capacitor')
+        self.assertTrue(pss.hierarchy() is hierarchy)
+        self.assertEqual(hierarchy.count('resistor'), 3)
+        netlist = 'subckt cell0 a b\nM0 (a b b b) nmos w=1u\nends cell0\n'
+        for depth in xrange(1, 64):
+            netlist += 'subckt cell%d a b\nX0 (a b) cell%d\nX1 (b a) cell%d\nends cell%d\n' % (
+                depth, depth - 1, depth - 1, depth)
+        netlist += 'X0 (a b) cell63\n'
+        pss = PySpectreScript()
+        pss.nsl = PySpectreScript._parse(StringIO.StringIO(netlist))
+        self.assertEqual(pss.hierarchy().count('nmos'), 2 ** 63)
+        self.assertAlmostEqual(pss.hierarchy().total('w', cell='cell10'), 2 ** 10 * 1e-6)
+        self.assertEqual(len(list(pss.hierarchy().paths(master='cell60'))), 8)
+        self.assertEqual(len(list(pss.hierarchy().paths('X0.X1.*', master='cell60'))), 4)
+
+    def test_incremental_write(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        out_dir = tempfile.mkdtemp()
+        path_full = os.path.join(out_dir, 'full.scs')
+        path_incremental = os.path.join(out_dir, 'incremental.scs')
+        pss = PySpectreScript(path_to_script)
+        pss_incremental = PySpectreScript(path_to_script)
+        pss_incremental.enable_incremental_write()
+        def assert_same_output():
+            pss.write(path_full)
+            pss_incremental.write(path_incremental)
+            with open(path_full) as full, open(path_incremental) as incremental:
+                self.assertEqual(full.read(), incremental.read())
+        try:
+            assert_same_output()
+            for script in (pss, pss_incremental):
+                script.search('parameters').change('R', '2k')
+                script.search('R0', descend=True).change('r', '5k')
+                script.search('I5', descend=True).replace('I5', 'I6')
+            assert_same_output()
+            self.assertEqual(pss_incremental._write_cache.dirty, set())
+            assert_same_output()
+            for script in (pss, pss_incremental):
+                script.add('Rz VIP 0 resistor r=1k', 3)
+                script.search('C*').scale('c', 2)
+            assert_same_output()
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_parameter_sweep(self):
+        path_to_script = './spectre_scripts/gmid_sweep.scs'
+        out_dir = tempfile.mkdtemp()
+        path_out = os.path.join(out_dir, 'gmid_sweep.scs')
+        path_params = os.path.join(out_dir, 'gmid_sweep.params.scs')
+        pss = PySpectreScript(path_to_script)
+        pss.enable_parameter_sweep()
+        try:
+            pss.write(path_out)
+            body = PySpectreScript(path_out)
+            self.assertEqual(len(body.search('parameters')), 0)
+            self.assertEqual(body.search('include')[0].nodes, ['"gmid_sweep.params.scs"'])
+            self.assertEqual(len(PySpectreScript(path_params)), 1)
+            with open(path_out, 'a') as fout:
+                fout.write('// not rewritten\n')
+            pss.search('parameters').change('VDS', '0.5')
+            pss.write(path_out)
+            self.assertEqual(PySpectreScript(path_params)[0].parameters['VDS'], '0.5')
+            self.assertTrue(open(path_out).read().endswith('// not rewritten\n'))
+            pss.search('include').replace('130nm', '90nm')
+            pss.write(path_out)
+            self.assertFalse(open(path_out).read().endswith('// not rewritten\n'))
+            self.assertEqual(len(PySpectreScript(path_out).search('include', node='*90nm*')), 1)
+            # parameters statements after other statements keep their place in the body
+            pss = PySpectreScript()
+            pss.nsl = PySpectreScript._parse(StringIO.StringIO(
+                'parameters A=1\nparameters B=A\ninclude "defaults.scs"\nparameters C=D\nR0 (a b) resistor r=C\n'))
+            pss.enable_parameter_sweep()
+            pss.write(path_out)
+            self.assertEqual([str(ns) for ns in PySpectreScript(path_params)],
+                             [str(ns) for ns in pss[:2]])
+            body = PySpectreScript(path_out)
+            self.assertEqual([ns.name for ns in body], ['include', 'include', 'parameters', 'R0'])
+            pss.search('parameters').change('C', '2')
+            pss.write(path_out)
+            self.assertEqual(PySpectreScript(path_out)[2].parameters['C'], '2')
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_clone(self):
+        default_threshold = PySpectreScript.index_threshold
+        for index_threshold in (default_threshold, 0):
+            PySpectreScript.index_threshold = index_threshold
+            try:
+                self._check_clone()
+            finally:
+                PySpectreScript.index_threshold = default_threshold
+
+    def _check_clone(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        pss_str = str(pss)
+        clones = [pss.clone() for _ in range(3)]
+        clones[0].search('parameters').change('R', '2k')
+        clones[0].search('R0', descend=True).change('r', '5k')
+        clones[0].search('C*').scale('c', 2)
+        clones[1].search('*', descend=True).replace('VIP', 'VIPX')
+        clones[1].search('R*').add_param('m', '2')
+        clones[1].search('R1').del_param('m')
+        clones[2].remove('I5', descend=True)
+        self.assertEqual(str(pss), pss_str)
+        self.assertEqual(str(clones[2].search('R*', descend=True)), str(pss.search('R*', descend=True)))
+        self.assertEqual(len(clones[2].search('I5', descend=True)), 0)
+        self.assertEqual(len(pss.search('I5', descend=True)), 1)
+        self.assertEqual(clones[0].search('parameters')[0].parameters['R'], '2k')
+        self.assertEqual([ns.parameters['r'] for ns in clones[0].search('R0', descend=True)], ['5k', '5k'])
+        self.assertEqual([ns.parameters['r'] for ns in pss.search('R0', descend=True)], ['_par0', '1K'])
+        self.assertEqual(len(clones[1].search(node='VIPX', descend=True)), 4)
+        self.assertEqual(len(pss.search(node='VIP', descend=True)), 4)
+        self.assertEqual([ns.parameters.get('m') for ns in clones[1].search('R*')], [None, '2'])
+        # unmodified statements are shared, modified ones are copies
+        self.assertTrue(clones[0].search('R1').nsl[0] is pss.search('R1').nsl[0])
+        self.assertTrue(clones[0].search('I1').nsl[0] is pss.search('I1').nsl[0])
+        self.assertFalse(clones[0].search('C0').nsl[0] is pss.search('C0').nsl[0])
+        # the original copies shared statements too
+        pss.search('parameters').change('R', '3k')
+        self.assertEqual(clones[1].search('parameters')[0].parameters['R'], '1k')
+        self.assertEqual(pss.search('parameters')[0].parameters['R'], '3k')
+        # statements handed out by a clone are its own copies
+        master = pss.search('I1')[0].master
+        copied = clones[1].search('I1')[0]
+        copied.add_param('m', '2')
+        copied.master = 'foo'
+        self.assertEqual(pss.search('I1')[0].master, master)
+        self.assertEqual(len(pss.search('I1', p_name='m')), 0)
+        self.assertEqual(clones[1].search('I1')[0].master, 'foo')
+        # the original stays editable directly and gives the clones copies first
+        for ns in pss:
+            if isinstance(ns, NetlistStatement) and ns.name == 'I1':
+                ns.add_param('m', '4')
+        self.assertEqual(pss.search('I1')[0].parameters['m'], '4')
+        self.assertEqual(clones[0].search('I1')[0].parameters.get('m'), None)
+        self.assertEqual(clones[1].search('I1')[0].parameters['m'], '2')
+
+    def test_batch(self):
+        path_to_script = './spectre_scripts/spectre_test0.scs'
+        pss = PySpectreScript(path_to_script)
+        pss_clone = pss.clone()
+        pss_str = str(pss)
+        length = len(pss)
+        with pss.batch() as b:
+            b.remove('C*')
+            b.remove('I5', descend=True)
+            b.remove('R0', descend='spectre_test_RC')
+            b.add('Rz VIP 0 resistor r=1k', 3)
+            b.add('Ry VIM 0 resistor r=1k', 3)
+            b.rename_nets({'VIP': 'VIPX', 'VAM': 'VAMX'})
+            b.rename_nets({'VIP': 'VIPY'}, descend='spectre_test_RCRC')
+        self.assertEqual(len(pss), length)
+        self.assertEqual([ns.name for ns in pss[3:5]], ['Rz', 'Ry'])
+        self.assertEqual(len(pss.search('C*', descend=True)), 1)
+        self.assertEqual(len(pss.search('I5', descend=True)), 0)
+        # a string descend only selects the sections it matches, like in search
+        self.assertEqual(len(pss.search('R0', descend='spectre_test_RC')), 0)
+        self.assertEqual(pss.search('R0')[0].nodes, ['VIPX', 'VAP', 'resistor'])
+        self.assertEqual(pss.search('R1')[0].nodes, ['VIM', 'VAMX', 'resistor'])
+        self.assertEqual(pss.search('I4', descend=True)[0].nodes, ['VIPY', 'VOP', 'VSS', 'spectre_test_RC'])
+        self.assertEqual(len(pss.search(node='VIPY', descend='spectre_test_RCRC')), 2)
+        self.assertEqual(len(pss.search(node='VIPY')), 0)
+        self.assertEqual(len(pss.search(node='VIPX', descend=True)), 2)
+        self.assertEqual(pss.search('Rz')[0].nodes[0], 'VIP')
+        self.assertEqual(str(pss_clone), pss_str)
+        self.assertEqual(len(pss_clone.search(node='VIP', descend=True)), 4)
+        # without added or removed statements the caches follow the copies of the renamed ones
+        pss_clone.enable_columns()
+        query = Query(node='VIMX', p_name='r', p_val=lambda R: R > 0, vectorized=True)
+        self.assertEqual(len(pss_clone.search(query)), 0)
+        with pss_clone.batch() as b:
+            b.rename_nets({'VIM': 'VIMX'})
+        self.assertEqual([ns.name for ns in pss_clone.search(query)], ['R1'])
+        self.assertEqual(len(pss.search(node='VIMX', descend=True)), 0)
+        with pss.batch() as b:
+            b.remove('R*')
+        self.assertEqual(len(pss.search('R*')), 0)
+        try:
+            with pss.batch() as b:
+                b.remove('*')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(len(pss), length - 4)
+
     def test_replace(self):
         path_to_script = './spectre_scripts/spectre_test0.scs'
         pss = PySpectreScript(path_to_script)
@@ -431,6 +998,243 @@ class PySpectreScriptTestCase(unittest.TestCase):
         pss.remove('Z*')
         self.assertEqual(pss_str, str(pss))
 
+    def test_simulation_runner(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            # stands in for spectre: stores the netlist as the results, fails with arguments
+            spectre = os.path.join(out_dir, 'spectre')
+            with open(spectre, 'w') as fout:
+                fout.write('#!/bin/sh\nmkdir -p "$3"\ncp "$1" "$3/netlist"\n[ -z "$4" ]\n')
+            os.chmod(spectre, 0755)
+            pss = PySpectreScript('./spectre_scripts/spectre_test0.scs')
+            pss.path_to_script_out = os.path.join(out_dir, 'test.scs')
+            resistances = ['1k', '2k', '3k', '4k']
+            with SimulationRunner(3, spectre=spectre) as runner:
+                jobs = []
+                for R in resistances:
+                    pss.search('parameters').change('R', R)
+                    jobs.append(runner.submit(pss))
+                pss.command_line_args = ['+aps']
+                jobs.append(runner.submit(pss))
+                start = time.time()
+                self.assertEqual(len(list(runner.as_completed(jobs))), 5)
+                self.assertTrue(time.time() - start < 1.0)  # not waiting for the poll
+                self.assertEqual(len(runner.map([pss, pss])), 2)
+            for R, job in zip(resistances, jobs):
+                simulated = job.get()
+                self.assertEqual(simulated.returncode, 0)
+                self.assertEqual(simulated.results(), ('netlist',))
+                with open(os.path.join(simulated.path_to_results, 'netlist')) as fin:
+                    self.assertTrue(' R=%s' % R in fin.read())
+            # the submitted script stays editable through indexing and iteration
+            pss[2].change('R', '5k')
+            for ns in pss[:4]:
+                if ns.name == 'parameters':
+                    ns.add_param('C', '1p')
+            self.assertEqual((pss[2].parameters['R'], pss[2].parameters['C']), ('5k', '1p'))
+            self.assertEqual(pss.search('parameters', p_name='C').nsl, [pss[2]])
+            self.assertNotEqual(jobs[-1].get().returncode, 0)
+            self.assertEqual(len(set(job.get().path_to_results for job in jobs)), 5)
+            # only the netlists and logs of the failed jobs are kept
+            self.assertEqual(sorted(name for name in os.listdir(out_dir) if '.job' in name),
+                             ['test.job%d.scs%s' % (i, ext) for i in (5, 6, 7) for ext in ('', '.log')])
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_run_async(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            # stands in for spectre: prints two lines, writes results and runs until killed
+            spectre = os.path.join(out_dir, 'spectre')
+            with open(spectre, 'w') as fout:
+                fout.write('#!/bin/sh\necho start "$1"\nmkdir -p "$3"\ntouch "$3/dc.dc"\necho done\n'
+                           '[ -z "$4" ] || sleep 60\n')
+            os.chmod(spectre, 0755)
+            pss = PySpectreScript('./spectre_scripts/spectre_test0.scs')
+            pss.path_to_script_out = os.path.join(out_dir, 'test.scs')
+            lines = []
+            process = pss.run_async(on_line=lines.append, spectre=spectre)
+            self.assertEqual(process.wait(10), 0)
+            self.assertEqual(lines, ['start %s\n' % pss.path_to_script_out, 'done\n'])
+            with open(pss.path_to_script_out + '.log') as fin:
+                self.assertEqual(fin.readlines(), lines)
+            self.assertEqual(pss.returncode, 0)
+            request = pss.results_async()
+            self.assertEqual(request.wait(10), ('dc.dc',))
+            self.assertTrue(request.done())
+            self.assertFalse(request.cancel())
+            # requests queued behind busy threads can be cancelled
+            with pss._results_lock:
+                busy = [pss.results_async() for _ in range(multiprocessing.cpu_count())]
+                queued = pss.results_async()
+                self.assertFalse(queued.done())
+                self.assertTrue(queued.cancel())
+                self.assertTrue(queued.done())
+                self.assertEqual(queued.wait(), None)
+            self.assertEqual([request.wait(10) for request in busy], [('dc.dc',)] * len(busy))
+            self.assertRaises(IOError, pss.results_async('missing.dc', 'V').wait, 10)
+            pss.command_line_args = ['+aps']
+            process = pss.run_async(spectre=spectre)
+            self.assertEqual(process.wait(0.5), None)
+            self.assertTrue(process.cancel())
+            self.assertTrue(process.done())
+            self.assertTrue(process.cancelled)
+            self.assertEqual(process.returncode, -signal.SIGTERM)
+            self.assertFalse(process.cancel())
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_result_cache(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            # stands in for spectre: counts the simulations and stores the netlist as the results
+            spectre = os.path.join(out_dir, 'spectre')
+            with open(spectre, 'w') as fout:
+                fout.write('#!/bin/sh\necho x >> "%s"\nmkdir -p "$3"\ncp "$1" "$3/netlist"\n'
+                           % os.path.join(out_dir, 'count'))
+            os.chmod(spectre, 0755)
+            def simulations():
+                with open(os.path.join(out_dir, 'count')) as fin:
+                    return len(fin.readlines())
+            with open(os.path.join(out_dir, 'models.scs'), 'w') as fout:
+                fout.write('model nch bsim4 vth0=0.4\n')
+            pss = PySpectreScript()
+            pss.add('simulator lang=spectre')
+            pss.add('parameters R=1k')
+            pss.add('include "models.scs"')
+            pss.add('R0 (a 0) resistor r=R')
+            pss.path_to_script_out = os.path.join(out_dir, 'test.scs')
+            cache = ResultCache(os.path.join(out_dir, 'cache'))
+            pss.result_cache = cache
+            with SimulationRunner(2, spectre=spectre) as runner:
+                first = runner.submit(pss).get()
+                self.assertEqual((simulations(), cache.hits, cache.misses), (1, 0, 1))
+                second = runner.submit(pss).get()
+                self.assertEqual((simulations(), cache.hits, cache.misses), (1, 1, 1))
+                self.assertEqual(second.returncode, 0)
+                self.assertNotEqual(first.path_to_results, second.path_to_results)
+                self.assertEqual(second.results(), ('netlist',))
+                pss.search('parameters').change('R', '2k')
+                runner.submit(pss).get()
+                self.assertEqual(simulations(), 2)
+                with open(os.path.join(out_dir, 'models.scs'), 'a') as fout:
+                    fout.write('model pch bsim4 vth0=-0.4\n')
+                runner.submit(pss).get()
+                self.assertEqual(simulations(), 3)
+                pss.command_line_args = ['+aps']
+                runner.submit(pss).get()
+                self.assertEqual(simulations(), 4)
+                runner.submit(pss).get()
+                self.assertEqual((simulations(), cache.hits, cache.misses), (4, 2, 4))
+            entries = [f for f in os.listdir(cache.directory) if f.endswith(ResultCache.SUFFIX)]
+            self.assertEqual(len(entries), 4)
+            cache.max_bytes = 1
+            cache.evict()
+            self.assertEqual(os.listdir(cache.directory), [])
+            # run uses the cache too, spectre is found on the PATH
+            path = os.environ['PATH']
+            os.environ['PATH'] = out_dir + os.pathsep + path
+            try:
+                cache.max_bytes = 10 << 20
+                pss.run(verbose=False)
+                pss.run(verbose=False)
+            finally:
+                os.environ['PATH'] = path
+            self.assertEqual((simulations(), cache.hits, cache.misses), (5, 3, 5))
+            self.assertEqual(pss.results(), ('netlist',))
+            cache.clear()
+            self.assertEqual(os.listdir(cache.directory), [])
+            # nested SPICE includes are part of the key, include paths only as written
+            with open(os.path.join(out_dir, 'models.scs'), 'a') as fout:
+                fout.write('include "corner.sp"\n')
+            with open(os.path.join(out_dir, 'corner.sp'), 'w') as fout:
+                fout.write(".lib 'ptm.lib' tt\n")
+            with open(os.path.join(out_dir, 'ptm.lib'), 'w') as fout:
+                fout.write('.lib tt\n.model nmos nmos level=54 vth0=0.4\n.endl tt\n')
+            key = cache.key(pss)
+            checkout = os.path.join(out_dir, 'checkout')
+            os.mkdir(checkout)
+            for fname in ('models.scs', 'corner.sp', 'ptm.lib'):
+                shutil.copy2(os.path.join(out_dir, fname), checkout)
+            pss.path_to_script_out = os.path.join(checkout, 'test.scs')
+            self.assertEqual(cache.key(pss), key)
+            # another spelling of the same include path
+            pss.search('include').change('"models.scs"', '"../checkout/./models.scs"')
+            self.assertEqual(cache.key(pss), key)
+            with open(os.path.join(checkout, 'ptm.lib'), 'a') as fout:
+                fout.write('.lib ss\n.model nmos nmos level=54 vth0=0.5\n.endl ss\n')
+            self.assertNotEqual(cache.key(pss), key)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_sweep(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            # stands in for spectre: stores the netlist and writes the result files of a 2 x 3 sweep
+            spectre = os.path.join(out_dir, 'spectre')
+            with open(spectre, 'w') as fout:
+                fout.write('#!/bin/sh\necho x >> "%s"\nmkdir -p "$3"\ncp "$1" "$3/netlist"\n'
+                           'for i in 000 001; do for j in 000 001 002; do\n'
+                           'touch "$3/sweep_LN-${i}_sweep_VDS-${j}_dc.dc"\ndone; done\n'
+                           % os.path.join(out_dir, 'count'))
+            os.chmod(spectre, 0755)
+            pss = PySpectreScript()
+            pss.add('simulator lang=spectre')
+            pss.add('parameters LN=130n LP=130n VDS=1')
+            pss.add('M0 (d g 0 0) nmos l=LN')
+            pss.add('dc dc param=VGS start=0 stop=1 step=0.1')
+            pss.add('saveOptions options save=allpub')
+            pss.path_to_script_out = os.path.join(out_dir, 'test.scs')
+            netlist = str(pss)
+            path = os.environ['PATH']
+            os.environ['PATH'] = out_dir + os.pathsep + path
+            try:
+                ordered = pss.sweep(collections.OrderedDict([('VDS', [0, 1]), ('LN', ['130n'])]),
+                                    verbose=False)
+                self.assertEqual(ordered.names, ('VDS', 'LN'))
+                self.assertEqual(pss.sweep({'VDS': [0, 1], 'LN': ['130n']}, verbose=False).names,
+                                 ('LN', 'VDS'))
+                # a script that was read and never written is swept next to its netlist
+                loaded_path = os.path.join(out_dir, 'loaded.scs')
+                with open(loaded_path, 'w') as fout:
+                    fout.write(str(pss))
+                loaded = PySpectreScript(loaded_path).sweep({'VDS': [0, 1]}, verbose=False)
+                self.assertEqual(loaded.pss.path_to_script_out, os.path.join(out_dir, 'loaded.sweep.scs'))
+                self.assertEqual(loaded.pss.path_to_results, os.path.join(out_dir, 'psf', 'loaded.sweep'))
+                self.assertTrue(os.path.exists(loaded.pss.path_to_script_out))
+                os.remove(os.path.join(out_dir, 'count'))
+                sweep = pss.sweep([('LN', ['130n', '230n']), ('VDS', [0, 0.5, 1])], verbose=False)
+            finally:
+                os.environ['PATH'] = path
+            with open(os.path.join(out_dir, 'count')) as fin:
+                self.assertEqual(len(fin.readlines()), 1)
+            self.assertEqual(str(pss), netlist)
+            self.assertEqual(sweep.pss.path_to_script_out, os.path.join(out_dir, 'test.sweep.scs'))
+            self.assertEqual(sweep.pss.path_to_results, os.path.join(out_dir, 'psf', 'test.sweep'))
+            self.assertEqual(sweep.names, ('LN', 'VDS'))
+            self.assertEqual(sweep.shape, (2, 3))
+            self.assertEqual(sweep.results(), ('dc.dc',))
+            self.assertEqual(sweep.fname('dc.dc', (1, 2)), 'sweep_LN-001_sweep_VDS-002_dc.dc')
+            self.assertRaises(ValueError, sweep.fname, 'dc.dc', (2, 0))
+            with open(os.path.join(sweep.pss.path_to_results, 'netlist')) as fin:
+                lines = [line.split() for line in fin if line.strip()]
+            self.assertEqual(lines[4:9], [['sweep_LN', 'sweep', 'param=LN', 'values=[130n', '230n]', '{'],
+                                          ['sweep_VDS', 'sweep', 'param=VDS', 'values=[0', '0.5', '1]', '{'],
+                                          ['dc', 'dc', 'param=VGS', 'start=0', 'step=0.1', 'stop=1'],
+                                          ['}'], ['}']])
+            self.assertEqual(lines[9], ['saveOptions', 'options', 'save=allpub'])
+            # parameters swept together and errors
+            statements = PySpectreScript._sweep_statements(('LN', 'LP'), [(1, 2), (3, 4)], [])
+            self.assertEqual([line.split() for line in PySpectreScript._section_lines(statements)],
+                             [['sweep_LN_LP_values', 'paramset', '{'], ['LN', 'LP'], ['1', '2'],
+                              ['3', '4'], ['}'], ['sweep_LN_LP', 'sweep', 'paramset=sweep_LN_LP_values']])
+            self.assertRaises(ValueError, PySpectreScript._sweep_statements, ('LN', 'LP'), [(1,)], [])
+            self.assertRaises(ValueError, pss.sweep, {'WN': [1, 2]})
+            self.assertRaises(ValueError, pss.sweep, {'LN': []})
+            self.assertRaises(ValueError, pss.sweep, {'LN': [1, 2]}, analysis='tran')
+        finally:
+            shutil.rmtree(out_dir)
+
     def test_run_write_read_results(self):
         run_scripts = True
         path_to_script = './spectre_scripts/spectre_test0.scs'